@@ -0,0 +1,412 @@
+#!/usr/bin/python
+
+##########################################################################
+# Copyright (c) 2015, Salesforce.com, Inc.
+# All rights reserved.
+#
+# Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#
+# Neither the name of Salesforce.com nor the names of its
+# contributors may be used to endorse or promote products
+# derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+##########################################################################
+
+"""
+**blklatency.py**
+
+Block device latency distributions, a companion of the diskstats
+plugin. diskstats reports await_read/await_write, the average latency
+of all IOs completed in a collection interval, which hides the slow
+tail behind the many fast IOs of the same interval.
+
+Per-IO latencies need tracing (blktrace, BPF), so this plugin samples
+the read and write counters of /proc/diskstats on a short period
+(SampleInterval seconds, 0.1 by default) in a background thread, and
+records the average latency of the IOs completed in each sample window
+in per-device histograms, weighted by the number of those IOs. The
+percentiles are thus those of short-window average latencies: a stall
+of a few hundred milliseconds shows at p99/p999 instead of being
+averaged over the whole interval.
+
+Histograms use HDR-style log-linear buckets: each power of two of
+microseconds is split in 2^SUB_BITS linear sub-buckets, so a recorded
+value is off by less than 1/2^SUB_BITS (6%) of itself, from 1us to
+hours, in a fixed array of counts. A record is one bucket index
+computation and one array increment; histograms of the same layout are
+merged by adding their counts.
+
+The recorded values are coarser than the histogram: /proc/diskstats
+accounts time in milliseconds, so the average of a window is
+ms * 1000 // ios microseconds, a multiple of 1ms / ios. A window with a
+few fast IOs on an SSD records 0 or at least 1000us / ios (a single
+200us read is recorded as 0 or 1ms), and on lightly loaded fast devices
+p50 is quantized accordingly; percentiles are exact to the bucket only
+when windows hold many IOs or latencies of several milliseconds.
+
+At every read interval the histograms of the interval are taken from
+the sampler, and per device (plugin_instance) the following are
+dispatched, in seconds like diskstats await_*, from the upper bound of
+the percentile's bucket:
+
+- await_read_p50, await_read_p99, await_read_p999
+- await_write_p50, await_write_p99, await_write_p999
+- await_rw_p50, await_rw_p99, await_rw_p999: merged read and write
+  histogram
+
+Devices are those of /sys/block but loop, ram, zram and sr devices,
+re-listed every DEV_SCAN_INTERVAL seconds so that hotplugged disks are
+sampled too, or those selected by DiskFilter, with the same syntax as
+diskstats ('!' patterns exclude devices, see devfilter).
+
+"""
+
+import collectd
+import platform
+import os
+import re
+import socket
+import threading
+import time
+from array import array
+
+import devfilter
+import dispatcher
+import procreader
+
+os_name = platform.system()
+host_name = socket.gethostbyaddr(socket.gethostname())[0]
+host_types = ['app', 'db', 'ffx', 'indexer', 'search', 'other']
+host_type = 'other'
+
+DISKSTATS_FNAME = '/proc/diskstats'
+SYS_BLOCK_DIR = '/sys/block'
+
+METRIC_PLUGIN = 'blklatency'
+METRIC_TYPE = 'gauge'
+BATCH_DISPATCH = 'BatchDispatch'
+
+# config keys
+SAMPLE_INTERVAL = 'SampleInterval'
+DISK_FILTER = 'DiskFilter'
+
+sample_interval = 0.1
+device_filter_regexes = None
+re_default_exclude = re.compile(r'^(loop|ram|zram|sr)\d*')
+
+# seconds between listings of SYS_BLOCK_DIR for the default devices
+DEV_SCAN_INTERVAL = 10
+
+# /proc/diskstats columns of reads completed, time reading (ms), writes
+# completed and time writing (ms)
+COL_READS = 3
+COL_READ_MS = 6
+COL_WRITES = 7
+COL_WRITE_MS = 10
+
+percentiles = [0.5, 0.99, 0.999]
+percentile_names = ['p50', 'p99', 'p999']
+blklatency_metrics = ['await_%s_%s' % (op, p) for op in ['read', 'write', 'rw']
+                      for p in percentile_names]
+
+# python 2 arrays have no 'q'; 'l' is 64 bits on LP64 Linux
+try:
+   STATS_TYPECODE = array('q').typecode
+except ValueError:
+   STATS_TYPECODE = 'l'
+
+# histogram layout: values in microseconds, 2^SUB_BITS buckets per power
+# of two, values from 2^MAX_VALUE_BITS us (19 hours) in the last bucket
+SUB_BITS = 4
+SUB_BUCKETS = 1 << SUB_BITS
+MAX_VALUE_BITS = 36
+MAX_VALUE = (1 << MAX_VALUE_BITS) - 1
+NUM_BUCKETS = (MAX_VALUE_BITS - SUB_BITS + 1) * SUB_BUCKETS
+
+config = {}
+
+sampler = None
+
+metric_dispatcher = dispatcher.Dispatcher(METRIC_PLUGIN, host_name, METRIC_TYPE)
+metric_dispatcher.register_type(METRIC_PLUGIN, blklatency_metrics)
+
+def get_host_type():
+   for i in host_types:
+      if i in host_name:
+         host_type = i
+
+def bucket_index(value):
+   """
+   Returns: histogram bucket of a value in microseconds
+   """
+   if value < SUB_BUCKETS:
+      return value if value > 0 else 0
+   if value > MAX_VALUE:
+      value = MAX_VALUE
+   shift = value.bit_length() - SUB_BITS - 1
+   return (shift << SUB_BITS) + (value >> shift)
+
+def bucket_value(index):
+   """
+   Returns: largest value in microseconds of a histogram bucket
+   """
+   if index < SUB_BUCKETS:
+      return index
+   shift = (index >> SUB_BITS) - 1
+   top = index - (shift << SUB_BITS)
+   return ((top + 1) << shift) - 1
+
+class LatencyHistogram(object):
+   """
+   Log-linear histogram of latencies in microseconds.
+   """
+   __slots__ = ('counts', 'total')
+
+   def __init__(self):
+      self.counts = array(STATS_TYPECODE, [0]) * NUM_BUCKETS
+      self.total = 0
+
+   def record(self, value, count=1):
+      """
+      Add count samples of value microseconds.
+      """
+      self.counts[bucket_index(value)] += count
+      self.total += count
+
+   def merge(self, other):
+      """
+      Add the samples of another histogram.
+      """
+      if other.total == 0:
+         return
+      counts = self.counts
+      for i, n in enumerate(other.counts):
+         if n:
+            counts[i] += n
+      self.total += other.total
+
+   def percentiles(self, fractions):
+      """
+      Args:
+           fractions: ascending fractions of samples, e.g. [0.5, 0.99]
+
+      Returns: upper bound in microseconds of the bucket holding each
+               fraction of the samples, None for all if there are none
+      """
+      if self.total == 0:
+         return [None] * len(fractions)
+      # rank of the sample each fraction falls on, 1 based
+      ranks = [max(1, int(-(-f * self.total // 1))) for f in fractions]
+      vals = []
+      seen = 0
+      k = 0
+      for i, n in enumerate(self.counts):
+         if not n:
+            continue
+         seen += n
+         while k < len(ranks) and ranks[k] <= seen:
+            vals.append(bucket_value(i))
+            k += 1
+         if k == len(ranks):
+            break
+      return vals
+
+def get_default_devices():
+   """
+   Returns: devices of SYS_BLOCK_DIR but loop, ram, zram and sr devices
+   """
+   try:
+      names = os.listdir(SYS_BLOCK_DIR)
+   except OSError:
+      return []
+   return sorted(n for n in names if not re_default_exclude.match(n))
+
+class LatencySampler(threading.Thread):
+   """
+   Samples /proc/diskstats every interval seconds and records the average
+   read and write latency of each sample window per device.
+
+   Args:
+        interval: seconds between samples
+        patterns: DiskFilter patterns, or None for the default devices
+   """
+   def __init__(self, interval, patterns=None):
+      threading.Thread.__init__(self, name='blklatency-sampler')
+      self.daemon = True
+      self.interval = interval
+      # default devices, and when SYS_BLOCK_DIR was last listed
+      self.devs = set()
+      self.devs_ts = None
+      self.filter = devfilter.DeviceFilter(patterns,
+                                           lambda dev: dev in self.devs)
+      self.stopped = threading.Event()
+      self.lock = threading.Lock()
+      # a reader of its own: the shared one of DISKSTATS_FNAME is used by
+      # the diskstats plugin from collectd's read threads
+      self.reader = procreader.ProcReader(DISKSTATS_FNAME)
+      # device -> (reads, ms reading, writes, ms writing) of the last sample
+      self.counters = {}
+      # device -> (read, write) histograms of the current interval
+      self.hists = {}
+
+   def refresh_devices(self):
+      """
+      List the default devices again if DEV_SCAN_INTERVAL elapsed, so
+      that disks added or removed are picked up.
+      """
+      now = time.time()
+      if self.devs_ts is not None and now - self.devs_ts < DEV_SCAN_INTERVAL:
+         return
+      self.devs_ts = now
+      devs = set(get_default_devices())
+      if devs != self.devs:
+         collectd.info('blklatency: devices: %s' % (sorted(devs)))
+         self.devs = devs
+         self.filter.clear()
+
+   def sample(self):
+      if self.filter.include is None:
+         self.refresh_devices()
+      text = self.reader.text()
+      if text is None:
+         return
+      counters = {}
+      with self.lock:
+         hists = self.hists
+         for line in text.splitlines():
+            fields = line.split()
+            if len(fields) <= COL_WRITE_MS or \
+                  not self.filter.match(fields[2]):
+               continue
+            dev = fields[2]
+            cur = (int(fields[COL_READS]), int(fields[COL_READ_MS]),
+                   int(fields[COL_WRITES]), int(fields[COL_WRITE_MS]))
+            counters[dev] = cur
+            pre = self.counters.get(dev)
+            if pre is None:
+               continue
+            dev_hists = hists.get(dev)
+            if dev_hists is None:
+               dev_hists = (LatencyHistogram(), LatencyHistogram())
+               hists[dev] = dev_hists
+            record_window(dev_hists[0], cur[0] - pre[0], cur[1] - pre[1])
+            record_window(dev_hists[1], cur[2] - pre[2], cur[3] - pre[3])
+      # devices that went away are dropped with their last counters
+      self.counters = counters
+
+   def run(self):
+      while not self.stopped.is_set():
+         try:
+            self.sample()
+         except Exception as e:
+            collectd.error('blklatency: sampler: %s' % (e))
+         self.stopped.wait(self.interval)
+
+   def stop(self):
+      self.stopped.set()
+
+   def take(self):
+      """
+      Returns: device -> (read, write) histograms recorded since the last
+               call
+      """
+      with self.lock:
+         hists = self.hists
+         self.hists = {}
+      return hists
+
+def record_window(hist, ios, ms):
+   """
+   Record the average latency of the ios completed in a sample window,
+   weighted by their number. Windows where a counter went backwards
+   (device reset, 32 bit wrap of the ms counters) are skipped.
+   """
+   if ios > 0 and ms >= 0:
+      hist.record(ms * 1000 // ios, ios)
+
+def calc_device_metrics(read_hist, write_hist):
+   """
+   Returns: values in blklatency_metrics order, in seconds
+   """
+   rw_hist = LatencyHistogram()
+   rw_hist.merge(read_hist)
+   rw_hist.merge(write_hist)
+   vals = []
+   for hist in (read_hist, write_hist, rw_hist):
+      vals.extend(v / 1e6 if v is not None else None
+                  for v in hist.percentiles(percentiles))
+   return vals
+
+def collect_blklatency():
+   if sampler is None:
+      return
+   for dev, (read_hist, write_hist) in sorted(sampler.take().items()):
+      metric_dispatcher.add(dev, METRIC_PLUGIN, blklatency_metrics,
+                            calc_device_metrics(read_hist, write_hist))
+   metric_dispatcher.flush()
+
+def configer(ObjConfiguration):
+   global sample_interval, device_filter_regexes
+   collectd.info('blklatency plugin: configuring host: %s' % (host_name))
+   for child in ObjConfiguration.children:
+      config[child.key] = child.values
+
+   if SAMPLE_INTERVAL in config:
+      sample_interval = float(config[SAMPLE_INTERVAL][0])
+   if DISK_FILTER in config:
+      device_filter_regexes = [r for r in config[DISK_FILTER] if r] or None
+   collectd.info('blklatency plugin: sample interval: %s, device filter: %s'
+                 % (sample_interval, device_filter_regexes))
+
+def initer():
+   global sampler
+   get_host_type()
+   collectd.info('blklatency plugin: host of type: %s' % (host_type))
+   if BATCH_DISPATCH in config:
+      metric_dispatcher.set_batch(dispatcher.is_true(config[BATCH_DISPATCH][0]))
+   sampler = LatencySampler(sample_interval, device_filter_regexes)
+   sampler.start()
+
+def reader(input_data=None):
+   collect_blklatency()
+
+def writer(metric, data=None):
+   for i in metric.values:
+      collectd.debug('%s (%s): %f' % (metric.plugin, metric.type, i))
+
+def shutdown():
+   global sampler
+   collectd.info('blklatency plugin shutting down')
+   if sampler is not None:
+      sampler.stop()
+      sampler.join(max(1.0, 2 * sample_interval))
+      sampler.reader.close()
+      sampler = None
+
+#== Callbacks ==#
+if (os_name == 'Linux'):
+   collectd.register_config(configer)
+   collectd.register_init(initer)
+   collectd.register_read(reader)
+   collectd.register_write(writer)
+   collectd.register_shutdown(shutdown)
+else:
+   collectd.warning('blklatency plugin currently works for Linux only')
@@ -57,17 +57,31 @@ Here are the fields interpretation in each row:
 2. Zone name (Normal, DMA32, DMA, etc.)
 3. Col. 3 to end: page order or buckets on contiguous memory sizes: 4K, 8K, 16K, 32K, 64K, 128K, 256K, 512K, 1024K, and 2048K
 
+From the previous interval's snapshot, the plugin also derives per
+node/zone:
+
+- free_pages_<size>K_per_sec: change rate of free blocks of each order
+- total_free_pages: free memory in 4K pages, sum of blocks * 2^order
+- total_free_pages_per_sec: change rate of total_free_pages
+- pct_fragment_<size>K: unusable free space index of an order, i.e. the
+  percentage of free memory in blocks too small for an allocation of
+  that order; 0 when all free memory is usable, 100 when none is. Orders
+  are set with FragmentOrders (default 3, the largest order the kernel
+  does not consider costly, and 9, a 2M transparent huge page)
+
 """
 
 import collectd
 import platform
-import os
 import socket
 import time
 import re
 import sys
 import traceback
 
+import dispatcher
+import procreader
+
 os_name = platform.system()
 host_name = socket.gethostbyaddr(socket.gethostname())[0]
 host_types = ['app', 'db', 'ffx', 'indexer', 'search', 'other']
@@ -76,16 +90,23 @@ host_type = 'other'
 BUDDY_FNAME = '/proc/buddyinfo'
 METRIC_PLUGIN = 'buddyinfo'
 METRIC_TYPE = 'gauge'
+BATCH_DISPATCH = 'BatchDispatch'
 
 buddy_fields = ['numa_node',
                  'zone_name',
                  'bucket_free_pages'
                 ]
 buddy_metrics = ['bucket_free_pages_per_sec',
+                  'total_free_pages',
                   'total_free_pages_per_sec',
-                  'pct_fragment_per_sec'
+                  'pct_fragment'
                  ]
 
+# config keys
+FRAGMENT_ORDERS = 'FragmentOrders'
+
+fragment_orders = [3, 9]
+
 white_list = []
 node_list = []
 zone_list = []
@@ -93,6 +114,12 @@ zone_list = []
 stats_cache = {}
 stats_current = {}
 
+config = {}
+
+# free pages of all orders of a zone are a single 'buddyinfo' record with
+# BatchDispatch; the record type is registered once white_list is known
+metric_dispatcher = dispatcher.Dispatcher(METRIC_PLUGIN, host_name, METRIC_TYPE)
+
 re_buddyinfo=re.compile(r'^\s*Node\s+(?P<node>\d+)'
                         r',\s+zone\s+(?P<zone>\S+)\s+(?P<pages>.*)$')
 
@@ -105,37 +132,36 @@ def init_stats_cache():
    global white_list
 
    try:
-      if os.path.exists(BUDDY_FNAME):
+      text = procreader.get_reader(BUDDY_FNAME).text()
+      if text is not None:
          num_buckets = 0
-         with open(BUDDY_FNAME) as f:
-            for line in f:
-               match = re_buddyinfo.search(line)
-               if not match:
-                  collectd.error('buddyinfo: unknown line pattern: %s' % (line))
-                  continue;
-               if 'node' in match.groupdict():
-                  node = match.group('node')
-               else:
-                  collectd.error('node not found in buddyinfo')
-                  return
-               if 'zone' in match.groupdict():
-                  zone = match.group('zone')
-               else:
-                  collectd.error('zone not found in buddyinfo')
-                  return
-               if 'pages' in match.groupdict():
-                  free_pages = match.group('pages').strip().split()
-               else:
-                  collectd.error('pages not found in buddyinfo')
-                  return
-               num_buckets = len(free_pages)
-               if node not in node_list:
-                  node_list.append(node)
-               if zone not in zone_list:
-                  zone_list.append(zone)
-               stats_cache[(node, zone, 'val')] = free_pages
-               stats_cache[(node, zone, 'ts')] = time.time()
-         f.close()
+         for line in text.splitlines():
+            match = re_buddyinfo.search(line)
+            if not match:
+               collectd.error('buddyinfo: unknown line pattern: %s' % (line))
+               continue;
+            if 'node' in match.groupdict():
+               node = match.group('node')
+            else:
+               collectd.error('node not found in buddyinfo')
+               return
+            if 'zone' in match.groupdict():
+               zone = match.group('zone')
+            else:
+               collectd.error('zone not found in buddyinfo')
+               return
+            if 'pages' in match.groupdict():
+               free_pages = [int(v) for v in match.group('pages').split()]
+            else:
+               collectd.error('pages not found in buddyinfo')
+               return
+            num_buckets = len(free_pages)
+            if node not in node_list:
+               node_list.append(node)
+            if zone not in zone_list:
+               zone_list.append(zone)
+            stats_cache[(node, zone, 'val')] = free_pages
+            stats_cache[(node, zone, 'ts')] = time.time()
          for i in range(0, num_buckets):
             white_list.append('free_pages_' + str(4*2**i) + 'K')
          collectd.info('buddyinfo: node_list : %s' % (node_list))
@@ -151,41 +177,36 @@ def init_stats_cache():
 
 def collect_buddyinfo():
    try:
-      if os.path.exists(BUDDY_FNAME):
-         with open(BUDDY_FNAME) as f:
-            for line in f:
-               match = re_buddyinfo.search(line)
-               if not match:
-                  continue;
-               if 'node' in match.groupdict():
-                  node = match.group('node')
-               else:
-                  collectd.error('node not found in buddyinfo')
-                  return
-               if 'zone' in match.groupdict():
-                  zone = match.group('zone')
-               else:
-                  collectd.error('zone not found in buddyinfo')
-                  return
-               if 'pages' in match.groupdict():
-                  free_pages = match.group('pages').strip().split()
-               else:
-                  collectd.error('pages not found in buddyinfo')
-                  return
-               stats_current[(node, zone, 'val')] = free_pages
-               stats_current[(node, zone, 'ts')] = time.time()
-               key_val = dict(zip(white_list, free_pages))
-               metric = collectd.Values()
-               metric.host = host_name
-               metric.plugin = METRIC_PLUGIN
-               metric.plugin_instance = node
-               metric.type = METRIC_TYPE
-               for k in range(0, len(white_list)):
-                  metric.type_instance = 'zone_' + zone + '.'
-                  metric.type_instance += white_list[k]
-                  metric.values = [free_pages[k]]
-                  metric.dispatch()
-            f.close()
+      text = procreader.get_reader(BUDDY_FNAME).text()
+      if text is not None:
+         ts = time.time()
+         for line in text.splitlines():
+            match = re_buddyinfo.search(line)
+            if not match:
+               continue;
+            if 'node' in match.groupdict():
+               node = match.group('node')
+            else:
+               collectd.error('node not found in buddyinfo')
+               return
+            if 'zone' in match.groupdict():
+               zone = match.group('zone')
+            else:
+               collectd.error('zone not found in buddyinfo')
+               return
+            if 'pages' in match.groupdict():
+               free_pages = [int(v) for v in match.group('pages').split()]
+            else:
+               collectd.error('pages not found in buddyinfo')
+               return
+            stats_current[(node, zone, 'val')] = free_pages
+            stats_current[(node, zone, 'ts')] = ts
+            metric_dispatcher.add(node, METRIC_PLUGIN, white_list, free_pages,
+                                  'zone_' + zone, 'zone_' + zone + '.')
+            names, vals = calc_metrics(node, zone)
+            metric_dispatcher.dispatch_values(node, names, vals,
+                                              'zone_' + zone + '.')
+         metric_dispatcher.flush()
       else:
          collectd.error('buddyinfo: procfs path: %s does not exist'
                        % (BUDDY_FNAME))
@@ -194,11 +215,82 @@ def collect_buddyinfo():
       collectd.error('Exception during buddyinfo collection: %s\n%s' %
                      (str(e), traceback.format_tb(exc_traceback)))
 
+def get_total_free_pages(free_pages):
+   """
+   Returns: free memory in pages, from free blocks per order
+   """
+   return sum(n << order for order, n in enumerate(free_pages))
+
+def get_unusable_index(free_pages, order, total=None):
+   """
+   Unusable free space index of an order: fraction of free memory in
+   blocks smaller than 2^order pages, which cannot satisfy an allocation
+   of that order (1 when there is no free memory at all, as in the
+   kernel's unusable_free_index()).
+   """
+   if total is None:
+      total = get_total_free_pages(free_pages)
+   if total == 0:
+      return 1.0
+   usable = sum(n << i for i, n in enumerate(free_pages) if i >= order)
+   return float(total - usable) / total
+
+def calc_zone_metrics(cur, pre, time_delta):
+   """
+   Derive the buddy metrics of a zone.
+
+   Args:
+        cur: free blocks per order
+        pre: free blocks per order at the previous interval, or None
+        time_delta: seconds between pre and cur
+
+   Returns: (names, values); rates are None without a usable previous
+            snapshot
+   """
+   total = get_total_free_pages(cur)
+   names = ['total_free_pages']
+   vals = [total]
+   for order in fragment_orders:
+      if order < len(cur):
+         names.append('pct_fragment_' + str(4*2**order) + 'K')
+         vals.append(100.0 * get_unusable_index(cur, order, total))
+
+   rates_valid = pre is not None and len(pre) == len(cur) and time_delta > 0
+   names.append('total_free_pages_per_sec')
+   if rates_valid:
+      vals.append((total - get_total_free_pages(pre)) / time_delta)
+   else:
+      vals.append(None)
+   for order in range(0, len(cur)):
+      names.append('free_pages_' + str(4*2**order) + 'K_per_sec')
+      if rates_valid:
+         vals.append((cur[order] - pre[order]) / time_delta)
+      else:
+         vals.append(None)
+   return names, vals
+
+def calc_metrics(node, zone):
+   pre = stats_cache.get((node, zone, 'val'))
+   time_delta = 0
+   if pre is not None:
+      time_delta = stats_current[(node, zone, 'ts')] - \
+                   stats_cache[(node, zone, 'ts')]
+   return calc_zone_metrics(stats_current[(node, zone, 'val')], pre,
+                            time_delta)
+
 def swap_current_cache():
-   stats_cache = stats_current.copy()
+   global stats_cache, stats_current
+   stats_cache, stats_current = stats_current, stats_cache
 
 def configer(ObjConfiguration):
+   global fragment_orders
    collectd.info('buddyinfo plugin: configuring host: %s' % (host_name))
+   for child in ObjConfiguration.children:
+      config[child.key] = child.values
+
+   if FRAGMENT_ORDERS in config:
+      fragment_orders = [int(o) for o in config[FRAGMENT_ORDERS]]
+   collectd.info('buddyinfo plugin: fragment orders: %s' % (fragment_orders))
 
 def initer():
    get_host_type()
@@ -206,6 +298,9 @@ def initer():
    collectd.info('buddyinfo initer: white list: %s' % (white_list))
    init_stats_cache()
    collectd.info('buddyinfo init: stats_cache: %s' % (stats_cache))
+   metric_dispatcher.register_type(METRIC_PLUGIN, white_list)
+   if BATCH_DISPATCH in config:
+      metric_dispatcher.set_batch(dispatcher.is_true(config[BATCH_DISPATCH][0]))
 
 def reader(input_data=None):
    collect_buddyinfo()
@@ -217,6 +312,7 @@ def writer(metric, data=None):
 
 def shutdown():
    collectd.info('buddyinfo plugin shutting down')
+   procreader.close_reader(BUDDY_FNAME)
 
 #== Callbacks ==#
 if (os_name == 'Linux'):
@@ -0,0 +1,460 @@
+#!/usr/bin/python
+
+##########################################################################
+# Copyright (c) 2015, Salesforce.com, Inc.
+# All rights reserved.
+#
+# Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#
+# Neither the name of Salesforce.com nor the names of its
+# contributors may be used to endorse or promote products
+# derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+##########################################################################
+
+"""
+**cpustats.py**
+
+Per-CPU utilization, softirq and interrupt rates from /proc/stat,
+/proc/softirqs and /proc/interrupts, to find interrupt and softirq
+imbalance behind network latency.
+
+All three files are matrices of per-CPU counters:
+
+- /proc/stat: one 'cpuN' row per online CPU with user, nice, system,
+  idle, iowait, irq, softirq, steal, guest and guest_nice time in ticks
+- /proc/softirqs: one row per softirq (NET_RX, TIMER, ...), one column
+  per online CPU
+- /proc/interrupts: one row per IRQ (numbered IRQs with their device
+  name, and architecture ones such as LOC or NMI), one column per
+  online CPU
+
+Each file is parsed into a flat row-major integer array, and deltas of
+the whole matrix against the previous snapshot are computed in a single
+vectorized step, with numpy when it is installed, or in one pass over
+array('q') buffers otherwise. When the rows or CPUs of a file change (a CPU goes offline, a
+driver allocates new MSI vectors), its previous snapshot is dropped and
+rates resume at the next interval.
+
+Metrics (plugin_instance / type_instance):
+
+- all / pct_<field>, pct_busy: utilization of all CPUs
+- cpuN / pct_<field>, pct_busy: utilization of each CPU; with CpuTopN,
+  only the N busiest CPUs
+- cpuN / interrupts_per_sec, softirqs_per_sec: total rates of each CPU
+- softirq / <softirq>_per_sec: rate of each softirq over all CPUs
+- irq / <irq>_per_sec: rate of each IRQ over all CPUs
+- cpuN / softirq_<softirq>_per_sec and cpuN / irq_<irq>_per_sec: rate
+  of a softirq or IRQ on one CPU
+
+A 192 CPU host has thousands of softirq and IRQ cells, so per IRQ and
+per cell rates are only reported for the IrqTopN / SoftirqTopN highest
+rates (10 by default, 0 for all) that are at least IrqThreshold /
+SoftirqThreshold per second (0 by default).
+
+"""
+
+import collectd
+import platform
+import heapq
+import re
+import socket
+import time
+from array import array
+
+try:
+   import numpy
+except ImportError:
+   numpy = None
+
+import dispatcher
+import procreader
+
+os_name = platform.system()
+host_name = socket.gethostbyaddr(socket.gethostname())[0]
+host_types = ['app', 'db', 'ffx', 'indexer', 'search', 'other']
+host_type = 'other'
+
+STAT_FNAME = '/proc/stat'
+SOFTIRQS_FNAME = '/proc/softirqs'
+INTERRUPTS_FNAME = '/proc/interrupts'
+
+METRIC_PLUGIN = 'cpustats'
+METRIC_TYPE = 'gauge'
+BATCH_DISPATCH = 'BatchDispatch'
+
+# config keys
+CPU_TOP_N = 'CpuTopN'
+IRQ_TOP_N = 'IrqTopN'
+IRQ_THRESHOLD = 'IrqThreshold'
+SOFTIRQ_TOP_N = 'SoftirqTopN'
+SOFTIRQ_THRESHOLD = 'SoftirqThreshold'
+
+cpu_top_n = 0
+irq_top_n = 10
+irq_threshold = 0.0
+softirq_top_n = 10
+softirq_threshold = 0.0
+
+# /proc/stat cpu fields; guest and guest_nice are already part of user
+# and nice, so they are parsed but not part of the total
+stat_fields = ['user', 'nice', 'system', 'idle', 'iowait', 'irq',
+               'softirq', 'steal', 'guest', 'guest_nice']
+NUM_TIME_FIELDS = 8
+IDLE = 3
+IOWAIT = 4
+cpu_metrics = ['pct_' + f for f in stat_fields[:NUM_TIME_FIELDS]] + \
+              ['pct_busy']
+
+# softirq and interrupt counts are 32 bit per CPU counters
+COUNTER_WRAP = 2**32
+
+# python 2 arrays have no 'q'; 'l' is 64 bits on LP64 Linux
+try:
+   STATS_TYPECODE = array('q').typecode
+except ValueError:
+   STATS_TYPECODE = 'l'
+
+re_irq_name = re.compile(r'[^\w.-]')
+
+config = {}
+
+# utilization of a CPU is a single 'cpustats' record with BatchDispatch
+metric_dispatcher = dispatcher.Dispatcher(METRIC_PLUGIN, host_name, METRIC_TYPE)
+metric_dispatcher.register_type(METRIC_PLUGIN, cpu_metrics)
+
+class CounterMatrix(object):
+   """
+   Current and previous snapshots of a matrix of counters, stored as
+   flat row-major arrays.
+
+   Args:
+        wrap: counter wrap-around value, or None for 64 bit counters
+   """
+   def __init__(self, wrap=None):
+      self.wrap = wrap
+      self.rows = []
+      self.cols = []
+      self.cur = new_snapshot([])
+      self.pre = None
+      self.cur_ts = None
+      self.pre_ts = None
+
+   def update(self, rows, cols, vals, ts):
+      """
+      Store a new snapshot. The previous one is kept only if rows and
+      cols did not change.
+
+      Args:
+           rows: row labels
+           cols: column labels
+           vals: len(rows) * len(cols) counters, row-major
+           ts: time of the snapshot
+      """
+      if rows == self.rows and cols == self.cols:
+         self.pre = self.cur
+         self.pre_ts = self.cur_ts
+         self.cur = new_snapshot(vals)
+      else:
+         self.rows = rows
+         self.cols = cols
+         self.cur = new_snapshot(vals)
+         self.pre = None
+         self.pre_ts = None
+      self.cur_ts = ts
+
+   def deltas(self):
+      """
+      Returns: deltas of all cells against the previous snapshot, in one
+               step over both arrays, or None without a previous snapshot
+      """
+      if self.pre is None:
+         return None
+      if numpy is not None:
+         return self.deltas_numpy().tolist()
+      wrap = self.wrap
+      if wrap is None:
+         return [c - p if c >= p else 0 for c, p in zip(self.cur, self.pre)]
+      return [c - p if c >= p else c - p + wrap
+              for c, p in zip(self.cur, self.pre)]
+
+   def rates(self):
+      """
+      Returns: per second rates of all cells, or None
+      """
+      if self.pre is None or self.cur_ts <= self.pre_ts:
+         return None
+      scale = 1.0 / (self.cur_ts - self.pre_ts)
+      if numpy is not None:
+         return (self.deltas_numpy(False) * scale).tolist()
+      wrap = self.wrap if self.wrap is not None else 0
+      return [(c - p if c >= p else c - p + wrap) * scale
+              for c, p in zip(self.cur, self.pre)]
+
+   def deltas_numpy(self, clip=True):
+      """
+      numpy version of deltas(): negative deltas are wrapped if the
+      counters wrap, otherwise set to 0 if clip is set.
+      """
+      deltas = self.cur - self.pre
+      if self.wrap is not None:
+         return numpy.where(deltas < 0, deltas + self.wrap, deltas)
+      if clip:
+         return numpy.maximum(deltas, 0)
+      return deltas
+
+def new_snapshot(vals):
+   """
+   Returns: vals as a numpy int64 array if numpy is installed, an
+            array('q') otherwise
+   """
+   if numpy is not None:
+      return numpy.array(vals, dtype=numpy.int64)
+   return array(STATS_TYPECODE, vals)
+
+stat_matrix = CounterMatrix()
+softirq_matrix = CounterMatrix(COUNTER_WRAP)
+irq_matrix = CounterMatrix(COUNTER_WRAP)
+
+def get_host_type():
+   for i in host_types:
+      if i in host_name:
+         host_type = i
+
+def parse_stat(text):
+   """
+   Parse the cpu rows of /proc/stat.
+
+   Returns: (rows, cols, vals) with rows 'all' and 'cpuN', cols
+            stat_fields and missing fields of older kernels as 0
+   """
+   rows = []
+   vals = []
+   num_fields = len(stat_fields)
+   for line in text.splitlines():
+      if not line.startswith('cpu'):
+         continue
+      fields = line.split()
+      rows.append('all' if fields[0] == 'cpu' else fields[0])
+      counters = [int(v) for v in fields[1:num_fields + 1]]
+      vals.extend(counters)
+      if len(counters) < num_fields:
+         vals.extend([0] * (num_fields - len(counters)))
+   return rows, stat_fields, vals
+
+def parse_cpu_matrix(text):
+   """
+   Parse /proc/softirqs or /proc/interrupts: a 'CPU0 CPU1 ...' header,
+   then one row per softirq or IRQ. Rows with fewer counters than CPUs
+   (ERR and MIS in /proc/interrupts) are padded with 0; the device name
+   of numbered IRQs is appended to their row label.
+
+   Returns: (rows, cols, vals) with cols 'cpuN'
+   """
+   lines = text.splitlines()
+   if not lines:
+      return [], [], []
+   cols = [c.lower() for c in lines[0].split()]
+   num_cols = len(cols)
+   rows = []
+   vals = []
+   for line in lines[1:]:
+      label, sep, rest = line.partition(':')
+      if not sep:
+         continue
+      label = label.strip()
+      fields = rest.split()
+      try:
+         counters = [int(v) for v in fields[:num_cols]]
+      except ValueError:
+         counters = []
+         for v in fields[:num_cols]:
+            if not v.isdigit():
+               break
+            counters.append(int(v))
+      if label.isdigit() and len(fields) > len(counters):
+         label = label + '_' + fields[-1]
+      rows.append(re_irq_name.sub('_', label))
+      vals.extend(counters)
+      if len(counters) < num_cols:
+         vals.extend([0] * (num_cols - len(counters)))
+   return rows, cols, vals
+
+def select_cells(rates, top_n, threshold):
+   """
+   Returns: indexes of the top_n highest rates (all if top_n is 0) that
+            are at least threshold, highest first
+   """
+   if top_n > 0:
+      indexes = heapq.nlargest(top_n, range(len(rates)),
+                               key=rates.__getitem__)
+   else:
+      indexes = sorted(range(len(rates)), key=rates.__getitem__,
+                       reverse=True)
+   return [i for i in indexes if rates[i] >= threshold and rates[i] > 0]
+
+def calc_utilization(matrix):
+   """
+   Returns: [(row, values in cpu_metrics order)] from the tick deltas of
+            /proc/stat, or [] without a previous snapshot
+   """
+   deltas = matrix.deltas()
+   if deltas is None:
+      return []
+   num_fields = len(matrix.cols)
+   util = []
+   for r, row in enumerate(matrix.rows):
+      start = r * num_fields
+      row_deltas = deltas[start:start + NUM_TIME_FIELDS]
+      total = sum(row_deltas)
+      if total <= 0:
+         continue
+      vals = [100.0 * d / total for d in row_deltas]
+      vals.append(100.0 - vals[IDLE] - vals[IOWAIT])
+      util.append((row, vals))
+   return util
+
+def dispatch_utilization():
+   util = calc_utilization(stat_matrix)
+   cpus = [u for u in util if u[0] != 'all']
+   if cpu_top_n > 0 and len(cpus) > cpu_top_n:
+      # busiest CPUs by pct_busy
+      cpus = heapq.nlargest(cpu_top_n, cpus, key=lambda u: u[1][-1])
+   for row, vals in [u for u in util if u[0] == 'all'] + cpus:
+      metric_dispatcher.add(row, METRIC_PLUGIN, cpu_metrics, vals)
+
+def dispatch_cpu_matrix(matrix, kind, top_n, threshold):
+   """
+   Dispatch the rates of a softirq or interrupt matrix: per CPU and per
+   row totals, and the selected per row and per cell rates.
+
+   Args:
+        matrix: CounterMatrix of /proc/softirqs or /proc/interrupts
+        kind: 'softirq' or 'irq'
+        top_n: number of highest rows and cells to report, 0 for all
+        threshold: minimum rate of reported rows and cells
+   """
+   rates = matrix.rates()
+   if rates is None:
+      return
+   rows = matrix.rows
+   cols = matrix.cols
+   num_cols = len(cols)
+   row_rates = [sum(rates[r * num_cols:(r + 1) * num_cols])
+                for r in range(len(rows))]
+   col_rates = [sum(rates[c::num_cols]) for c in range(num_cols)]
+
+   total_name = 'softirqs_per_sec' if kind == 'softirq' else \
+                'interrupts_per_sec'
+   for c, col in enumerate(cols):
+      metric_dispatcher.dispatch_values(col, [total_name], [col_rates[c]])
+
+   # softirqs are a handful of rows, all of them are reported
+   if kind == 'softirq':
+      row_indexes = range(len(rows))
+   else:
+      row_indexes = select_cells(row_rates, top_n, threshold)
+   metric_dispatcher.dispatch_values(kind,
+                                     [rows[r] + '_per_sec' for r in row_indexes],
+                                     [row_rates[r] for r in row_indexes])
+
+   for i in select_cells(rates, top_n, threshold):
+      r, c = divmod(i, num_cols)
+      metric_dispatcher.dispatch_values(cols[c],
+                                        [kind + '_' + rows[r] + '_per_sec'],
+                                        [rates[i]])
+
+def collect_file(fname, matrix, parse, ts):
+   text = procreader.get_reader(fname).text()
+   if text is None:
+      collectd.error('cpustats: procfs path: %s does not exist' % (fname))
+      return
+   rows, cols, vals = parse(text)
+   matrix.update(rows, cols, vals, ts)
+
+def collect_cpustats():
+   ts = time.time()
+   collect_file(STAT_FNAME, stat_matrix, parse_stat, ts)
+   collect_file(SOFTIRQS_FNAME, softirq_matrix, parse_cpu_matrix, ts)
+   collect_file(INTERRUPTS_FNAME, irq_matrix, parse_cpu_matrix, ts)
+
+def dispatch_metrics():
+   dispatch_utilization()
+   dispatch_cpu_matrix(softirq_matrix, 'softirq', softirq_top_n,
+                       softirq_threshold)
+   dispatch_cpu_matrix(irq_matrix, 'irq', irq_top_n, irq_threshold)
+   metric_dispatcher.flush()
+
+def configer(ObjConfiguration):
+   global cpu_top_n, irq_top_n, irq_threshold
+   global softirq_top_n, softirq_threshold
+   collectd.info('cpustats plugin: configuring host: %s' % (host_name))
+   for child in ObjConfiguration.children:
+      config[child.key] = child.values
+
+   if CPU_TOP_N in config:
+      cpu_top_n = int(config[CPU_TOP_N][0])
+   if IRQ_TOP_N in config:
+      irq_top_n = int(config[IRQ_TOP_N][0])
+   if IRQ_THRESHOLD in config:
+      irq_threshold = float(config[IRQ_THRESHOLD][0])
+   if SOFTIRQ_TOP_N in config:
+      softirq_top_n = int(config[SOFTIRQ_TOP_N][0])
+   if SOFTIRQ_THRESHOLD in config:
+      softirq_threshold = float(config[SOFTIRQ_THRESHOLD][0])
+   collectd.info('cpustats plugin: cpu top %d, irq top %d >= %.1f/s, '
+                 'softirq top %d >= %.1f/s' %
+                 (cpu_top_n, irq_top_n, irq_threshold,
+                  softirq_top_n, softirq_threshold))
+
+def initer():
+   get_host_type()
+   collectd.info('cpustats plugin: host of type: %s' % (host_type))
+   if BATCH_DISPATCH in config:
+      metric_dispatcher.set_batch(dispatcher.is_true(config[BATCH_DISPATCH][0]))
+   collect_cpustats()
+   collectd.info('cpustats init: %d cpus, %d softirqs, %d irqs' %
+                 (len(softirq_matrix.cols), len(softirq_matrix.rows),
+                  len(irq_matrix.rows)))
+
+def reader(input_data=None):
+   collect_cpustats()
+   dispatch_metrics()
+
+def writer(metric, data=None):
+   for i in metric.values:
+      collectd.debug('%s (%s): %f' % (metric.plugin, metric.type, i))
+
+def shutdown():
+   collectd.info('cpustats plugin shutting down')
+   procreader.close_reader(STAT_FNAME)
+   procreader.close_reader(SOFTIRQS_FNAME)
+   procreader.close_reader(INTERRUPTS_FNAME)
+
+#== Callbacks ==#
+if (os_name == 'Linux'):
+   collectd.register_config(configer)
+   collectd.register_init(initer)
+   collectd.register_read(reader)
+   collectd.register_write(writer)
+   collectd.register_shutdown(shutdown)
+else:
+   collectd.warning('cpustats plugin currently works for Linux only')
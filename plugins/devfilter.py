@@ -0,0 +1,111 @@
+#!/usr/bin/python
+
+##########################################################################
+# Copyright (c) 2015, Salesforce.com, Inc.
+# All rights reserved.
+#
+# Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#
+# Neither the name of Salesforce.com nor the names of its
+# contributors may be used to endorse or promote products
+# derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+##########################################################################
+
+
+"""
+**devfilter.py**
+
+DiskFilter device selection shared by the diskstats and blklatency
+plugins, and by the InterfaceFilter of the netdev plugin.
+
+DiskFilter patterns are regular expressions matched against the start
+of device names; a pattern starting with '!' excludes the devices it
+matches:
+
+- DiskFilter "^sd[a-z]+$" "^nvme[0-9]+n[0-9]+$" "!^sdz$"
+
+All include patterns are combined into one compiled alternation and all
+exclude patterns into another, so a device name is matched at most
+twice whatever the number of patterns. Without include patterns, the
+plugin's default selection applies, minus the excludes. Decisions are
+memoized per device name, so re-selecting devices after a hotplug is a
+dict lookup for the devices already seen.
+
+"""
+
+import re
+
+# bounded, as device names come and go (containers, LVM snapshots)
+CACHE_SIZE = 4096
+
+def compile_patterns(patterns):
+   """
+   Args:
+        patterns: DiskFilter patterns, or None
+
+   Returns: (include, exclude) compiled alternations, None when there is
+            no pattern of the kind
+   """
+   include = [p for p in patterns or [] if not p.startswith('!')]
+   exclude = [p[1:] for p in patterns or [] if p.startswith('!')]
+   def alternation(regexes):
+      if not regexes:
+         return None
+      return re.compile('|'.join('(?:%s)' % (r) for r in regexes))
+   return alternation(include), alternation(exclude)
+
+class DeviceFilter(object):
+   """
+   Compiled DiskFilter with memoized decisions.
+
+   Args:
+        patterns: DiskFilter patterns, or None
+        default: function of a device name, True for the devices selected
+                 when there is no include pattern
+   """
+   def __init__(self, patterns, default):
+      self.include, self.exclude = compile_patterns(patterns)
+      self.default = default
+      self.cache = {}
+
+   def match(self, devname):
+      """
+      Returns: True if devname is selected
+      """
+      selected = self.cache.get(devname)
+      if selected is None:
+         if len(self.cache) >= CACHE_SIZE:
+            self.cache.clear()
+         if self.include is not None:
+            selected = self.include.match(devname) is not None
+         else:
+            selected = bool(self.default(devname))
+         if selected and self.exclude is not None:
+            selected = self.exclude.match(devname) is None
+         self.cache[devname] = selected
+      return selected
+
+   def clear(self):
+      """
+      Forget memoized decisions, e.g. when the default selection changed.
+      """
+      self.cache.clear()
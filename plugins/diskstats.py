@@ -41,6 +41,11 @@ In addition to collecting raw stats, plugin can cache
 current value to determine time series derivatives (such as, iops, device
 utilization, etc.) at next collection interval.
 
+By default (BatchMode true) previous and current stats of all devices are
+kept in two (devices x fields) arrays and derived metrics of all devices
+are computed in one pass, using numpy when it is installed. BatchMode false
+selects the per-device calc_metrics() path.
+
 /proc/diskstats output shows one device stats per line and
 each line looks like this:
 
@@ -89,14 +94,62 @@ Documentation/iostat.txt (ignores first 3 fileds):
     last update of this field.  This can provide an easy measure of both
     I/O completion time and the backlog that may be accumulating.
 
+Kernels 4.18+ append discard fields, and 5.5+ flush fields:
+
+- Field 12 -- # of discards completed
+- Field 13 -- # of discards merged
+- Field 14 -- # of sectors discarded
+- Field 15 -- # of milliseconds spent discarding
+- Field 16 -- # of flush requests completed
+- Field 17 -- # of milliseconds spent flushing
+
+The number of columns is detected from /proc/diskstats at init, and the
+fields present are collected as raw stats. From them, iops_discard,
+bytes_ps_discard, await_discard, iops_flush and await_flush are derived;
+on older kernels these metrics are not dispatched.
+
+With Topology true, partitions, device-mapper (LVM) and md devices are
+collected along with whole disks, and the stacking of devices is read
+from /sys/block/<dev>/slaves at init and whenever /proc/diskstats
+changes. Every top level dm or md device (one with no holders) is then
+also reported with type_instance 'members': the metrics of the leaf
+devices under it, whole disks or partitions, from their own counters
+summed in the same /proc/diskstats read, with io_time averaged so that
+util_pct is the mean utilization of the members. A partition member is
+not resolved to its disk, whose counters also hold the IO of the disk's
+other partitions, so a DiskFilter must select the partitions used by
+volumes. Comparing a volume with its members shows RAID or mirror write
+amplification and member imbalance. Physical disks need no rollup: the
+kernel accounts the IO of partitions to their disk.
+
+Devices that are added or removed while collectd runs (hot-swapped
+disks, new NVMe namespaces, LVM volumes) are picked up without a
+restart: every read compares the major, minor and name of all lines of
+/proc/diskstats with the previous read, and only when they differ is
+the device list selected again. Cached stats of the remaining devices
+are kept, and a new device gets its first derived metrics one interval
+after it appears, from a baseline taken when it was found. Hotplug false
+keeps the device list of init.
+
 """
 
 import collectd
+import array
+import os
 import platform
 import socket
 import time
 import re
 
+try:
+   import numpy
+except ImportError:
+   numpy = None
+
+import devfilter
+import dispatcher
+import procreader
+
 ### Globals ###
 OS_NAME = platform.system()
 HOST_NAME = socket.gethostbyaddr(socket.gethostname())[0]
@@ -107,109 +160,481 @@ diskstat_fields = ['major', 'minor', 'device',
                    'writes_completed', 'writes_merged',
                    'sectors_written', 'time_spent_writing_ms',
                    'inflight_ios', 'io_time_ms',
-                   'weighted_time_spent_io']
+                   'weighted_time_spent_io',
+                   'discards_completed', 'discards_merged',
+                   'sectors_discarded', 'time_spent_discarding_ms',
+                   'flushes_completed', 'time_spent_flushing_ms']
 diskstat_metrics = ['iops_read', 'iops_write', 'iops_rw',
                     'bytes_ps_read', 'bytes_ps_write', 'bytes_ps_rw',
                     'bytes_per_read', 'bytes_per_write', 'bytes_per_rw',
                     'await_read', 'await_write', 'await_rw',
-                    'util_pct', 'avgqu_sz', 'svc_tm']
+                    'util_pct', 'avgqu_sz', 'svc_tm',
+                    'iops_discard', 'bytes_ps_discard', 'await_discard',
+                    'iops_flush', 'await_flush']
 config = {}
 dev_list = []
 device_filter_regexes = []
+
+# DiskFilter compiled with devfilter, and the (DiskFilter, Topology) it
+# was compiled for
+device_filter = None
+device_filter_key = None
+
+# default device selection, see is_default_dev()
+re_default_skip = re.compile(r'loop|ram|sr')
+re_default_stacked = re.compile(r'[hs]d[a-z]+\d|md\d|dm-\d')
+
+# major, minor and name at the start of a /proc/diskstats line
+re_dev_fingerprint = re.compile(br'\s*\d+\s+\d+\s+\S+')
+
 filtered_metrics = []
 
 DISKSTATS_FNAME = '/proc/diskstats'
+SYS_BLOCK_DIR = '/sys/block'
 METRIC_PLUGIN = 'diskstats_telemetry'
 METRIC_TYPE = 'gauge'
 DISK_FILTER = 'DiskFilter'
 METRIC_FILTER = 'Filter'
+BATCH_MODE = 'BatchMode'
+BATCH_DISPATCH = 'BatchDispatch'
+TOPOLOGY = 'Topology'
+HOTPLUG = 'Hotplug'
+ROLLUP_INSTANCE = 'members'
+
+# multi-value types in telemetry_types.db for BatchDispatch
+RAW_TYPE = 'diskstats_raw'
+METRICS_TYPE = 'diskstats'
+COUNTER_WIDTH = 'CounterWidth'
+
+# raw fields of every known /proc/diskstats layout, and the number of
+# them in each layout: base (11), discards (4.18+, 15), flushes (5.5+, 17)
+all_raw_field_names = diskstat_fields[3:]
+raw_field_layouts = [11, 15, 17]
+
+# raw fields of the running kernel, set by set_raw_fields()
+raw_field_names = all_raw_field_names[:raw_field_layouts[0]]
+NR_RAW_FIELDS = len(raw_field_names)
+
+# column of each counter in raw_field_names
+F_READS = raw_field_names.index('reads_completed')
+F_SECTORS_READ = raw_field_names.index('sectors_read')
+F_TIME_READING = raw_field_names.index('time_spent_reading_ms')
+F_WRITES = raw_field_names.index('writes_completed')
+F_SECTORS_WRITTEN = raw_field_names.index('sectors_written')
+F_TIME_WRITING = raw_field_names.index('time_spent_writing_ms')
+F_INFLIGHT = raw_field_names.index('inflight_ios')
+F_IO_TIME = raw_field_names.index('io_time_ms')
+F_WEIGHTED_IO_TIME = raw_field_names.index('weighted_time_spent_io')
+F_DISCARDS = all_raw_field_names.index('discards_completed')
+F_SECTORS_DISCARDED = all_raw_field_names.index('sectors_discarded')
+F_TIME_DISCARDING = all_raw_field_names.index('time_spent_discarding_ms')
+F_FLUSHES = all_raw_field_names.index('flushes_completed')
+F_TIME_FLUSHING = all_raw_field_names.index('time_spent_flushing_ms')
+
+metric_dispatcher = dispatcher.Dispatcher(METRIC_PLUGIN, HOST_NAME, METRIC_TYPE)
+metric_dispatcher.register_type(RAW_TYPE, all_raw_field_names)
+metric_dispatcher.register_type(METRICS_TYPE, diskstat_metrics)
+
+# counters printed as unsigned int (32-bit) by the kernel; the wrap
+# modulus of each column is set by init_counter_widths(). inflight_ios
+# is a gauge, not a counter: it does not wrap, and its delta, negative
+# whenever in-flight IO drops, is not used by any metric
+time_fields = ['time_spent_reading_ms', 'time_spent_writing_ms',
+               'io_time_ms', 'weighted_time_spent_io',
+               'time_spent_discarding_ms', 'time_spent_flushing_ms']
+counter_widths = {}
+counter_bits = []
+counter_wrap = []
+counter_wrap_numpy = None
+
+# (line number, name, name as bytes) of each monitored device in
+# /proc/diskstats and the (file name, line count, dev_list, dev_list
+# length) it was built for
+dev_index = []
+dev_index_key = (None, -1, None, -1)
 
 # previous and current stats for derivative metrics
 dev_stats_cache = {}
 dev_stats_current = {}
 
+# batch mode keeps previous and current stats of all devices in two
+# (devices x raw_field_names) arrays, numpy if available, and swaps them
+batch_mode = True
+NAN = float('nan')
+dev_rows = {}
+dev_snap_blank = None
+dev_snap_cache = None
+dev_snap_current = None
+dev_snap_cache_ts = 0.0
+dev_snap_current_ts = 0.0
+
+# device topology: top level dm/md device -> leaf devices under it
+topology_enabled = False
+volume_members = {}
+
+# major, minor and name of every /proc/diskstats line when dev_list was
+# last selected; None until initer() has built dev_list
+hotplug_enabled = True
+dev_fingerprint = None
+
 # we should get it from /sys/block/fioa/queue/pysical_block_size
 dev_blk_sz = 512
 one_K = 1024
 
 def get_dev_list():
-   if device_filter_regexes is not None and len(device_filter_regexes) > 0:
-      get_filtered_dev_list()
-   else:
-      get_default_dev_list()
+   lines = procreader.decode_lines(read_diskstats_lines())
+   dev_list.extend(select_dev_list(lines))
 
+def select_dev_list(lines):
+   """
+   This function determines a device list for this plugin monitoring.
 
-def get_filtered_dev_list():
-   with open(DISKSTATS_FNAME) as f:
-      for line in f:
-         fields = line.split()
-         fields = [fl.strip() for fl in fields]
-         devname = fields[2]
-         for regex in device_filter_regexes:
-            if re.match(regex, devname):
-               dev_list.append(devname)
-               continue
+   Devices are selected with the DiskFilter patterns if any, otherwise
+   with the default rules (see is_default_dev()). Each device name is
+   evaluated once and the decision memoized by device_filter.
 
+   Args:
+        lines: lines of /proc/diskstats
 
-def get_default_dev_list():
+   Returns:
+        List of devices to monitor, in line order
    """
-   This function determines a device list for this plugin monitoring.
+   update_device_filter()
+   devs = []
+   seen = set()
+   for line in lines:
+      fields = line.split(None, 3)
+      if len(fields) < 3:
+         continue
+      devname = fields[2]
+      if devname not in seen and is_monitored_dev(devname):
+         seen.add(devname)
+         devs.append(devname)
+   return devs
+
+def read_diskstats_lines():
+   """
+   Returns: memoryview of each line of /proc/diskstats, valid until the
+            next read. Lines are neither decoded nor copied; only those
+            of monitored devices are split at each interval.
+   """
+   lines = list(procreader.get_reader(DISKSTATS_FNAME).lines())
+   if not lines:
+      collectd.error('diskstats: procfs path: %s could not be read'
+                     % (DISKSTATS_FNAME))
+   return lines
+
+def update_device_filter():
+   """
+   Recompile the device filter, and forget the memoized decisions, when
+   DiskFilter or Topology changed since the last call.
+   """
+   global device_filter, device_filter_key
+   key = (tuple(device_filter_regexes or []), topology_enabled)
+   if key == device_filter_key:
+      return
+   device_filter = devfilter.DeviceFilter(device_filter_regexes,
+                                          is_default_dev)
+   device_filter_key = key
+
+def is_default_dev(devname):
+   """
+   Default device selection: non-storage devices (loop, ram, sr) are
+   skipped, and so are partitions, md and dm devices unless Topology is
+   enabled.
+   """
+   if re_default_skip.match(devname):
+      return False
+   return topology_enabled or not re_default_stacked.match(devname)
+
+def is_monitored_dev(devname):
+   """
+   Returns: True if devname is to be monitored; decisions are memoized
+            per name
+   """
+   return device_filter.match(devname)
+
+def get_fingerprint(lines):
+   """
+   Returns: major, minor and name of every /proc/diskstats line
+   """
+   return [m.group() if m else None
+           for m in map(re_dev_fingerprint.match, lines)]
 
-   There are a number of non-storage devices in /proc/diskstat output
-   that need to be skipped. These inclue loop, ram, and possibly
-   other devices and partitions.
+def init_dev_fingerprint():
+   global dev_fingerprint
+   dev_fingerprint = get_fingerprint(read_diskstats_lines())
+
+def check_dev_list(lines):
+   """
+   Select the device list again if devices were added to or removed from
+   /proc/diskstats since the last check.
 
    Args:
-        None
+        lines: lines of /proc/diskstats
 
-   Returns:
-        Updated global dev_list
-   """
-   with open(DISKSTATS_FNAME) as f:
-      for line in f:
-         fields = line.split()
-         fields = [fl.strip() for fl in fields]
-         is_loop = re.match('^loop', fields[2])
-         is_ram = re.match('^ram', fields[2])
-         is_sr = re.match('^sr', fields[2])
-         is_disk_part = re.findall('(^[hs]d[a-z]+)([\d]+)', fields[2])
-         is_raid_md = re.findall('^md[0-9]+', fields[2])
-         is_raid_dm = re.findall('^dm-[0-9]+', fields[2])
-         if (is_loop) or (is_ram) or (is_sr) or is_disk_part or is_raid_md or is_raid_dm:
-             continue
+   Returns: True if dev_list changed
+   """
+   global dev_fingerprint
+   if dev_fingerprint is None or not hotplug_enabled:
+      return False
+   fingerprint = get_fingerprint(lines)
+   if fingerprint == dev_fingerprint:
+      return False
+   dev_fingerprint = fingerprint
+   devs = select_dev_list(procreader.decode_lines(lines))
+   if devs == dev_list:
+      return False
+   old_devs = set(dev_list)
+   new_devs = set(devs)
+   collectd.info('diskstats: devices added: %s removed: %s' %
+                 ([d for d in devs if d not in old_devs],
+                  [d for d in dev_list if d not in new_devs]))
+   set_dev_list(devs)
+   return True
+
+def set_dev_list(devs):
+   """
+   Replace dev_list, keeping the cached stats of remaining devices. In
+   batch mode the snapshots are reallocated for the new list, with NaN
+   cached rows for new devices, which have no derived metrics until their
+   first read becomes the cached one.
+   """
+   global dev_list, dev_snap_blank, dev_snap_cache, dev_snap_current
+   old_rows = dict(dev_rows)
+   dev_list = devs
+   dev_rows.clear()
+   dev_rows.update((dev, row) for row, dev in enumerate(dev_list))
+   if not batch_mode or dev_snap_cache is None:
+      return
+   old_cache = dev_snap_cache
+   dev_snap_blank = alloc_dev_snap()
+   dev_snap_cache = alloc_dev_snap()
+   dev_snap_current = alloc_dev_snap()
+   n = NR_RAW_FIELDS
+   if numpy is not None:
+      dev_snap_cache.fill(NAN)
+   for dev, row in dev_rows.items():
+      old_row = old_rows.get(dev)
+      if old_row is None:
+         continue
+      if numpy is not None:
+         dev_snap_cache[row] = old_cache[old_row]
+      else:
+         dev_snap_cache[row * n:(row + 1) * n] = \
+            old_cache[old_row * n:(old_row + 1) * n]
+
+def list_sys_dir(path):
+   try:
+      return os.listdir(path)
+   except OSError:
+      return []
+
+def build_topology():
+   """
+   Build the map of top level device-mapper and md devices to the leaf
+   devices under them from SYS_BLOCK_DIR.
+
+   Stacked devices (e.g. an LVM volume on an md RAID) are resolved to
+   the devices of their lowest layer, disks or partitions; partitions
+   are kept as members, as the counters of their disk also hold the IO
+   of the disk's other partitions.
+
+   Args: None
+
+   Returns: Updated global volume_members
+   """
+   slaves = {}
+   holders = {}
+   for dev in list_sys_dir(SYS_BLOCK_DIR):
+      dev_dir = os.path.join(SYS_BLOCK_DIR, dev)
+      slaves[dev] = list_sys_dir(os.path.join(dev_dir, 'slaves'))
+      holders[dev] = list_sys_dir(os.path.join(dev_dir, 'holders'))
+
+   def members(dev, seen):
+      leaves = set()
+      for slave in slaves.get(dev, []):
+         if slave in seen:
+            continue
+         seen.add(slave)
+         if slaves.get(slave):
+            leaves.update(members(slave, seen))
          else:
-             dev_list.append(fields[2])
+            leaves.add(slave)
+      return leaves
 
-      f.close()
+   volume_members.clear()
+   for dev in sorted(slaves.keys()):
+      if slaves[dev] and not holders[dev]:
+         volume_members[dev] = sorted(members(dev, set([dev])))
+   collectd.info('diskstats: volume members: %s' % (volume_members))
+
+def get_member_deltas(dev):
+   """
+   Returns: counter deltas of dev in raw_field_names order since the
+            previous read, or None if dev was not in both reads
+   """
+   if batch_mode:
+      row = dev_rows.get(dev)
+      if row is None:
+         return None
+      cur = get_snap_row(dev_snap_current, row)
+      pre = get_snap_row(dev_snap_cache, row)
+      if None in cur or None in pre:
+         return None
+   else:
+      if (dev, 'ts') not in dev_stats_current or \
+            (dev, 'ts') not in dev_stats_cache:
+         return None
+      cur = [dev_stats_current[(dev, k)] for k in raw_field_names]
+      pre = [dev_stats_cache[(dev, k)] for k in raw_field_names]
+   return [counter_delta(c, p, col) for col, (c, p) in
+           enumerate(zip(cur, pre))]
+
+def calc_rollup_metrics(members, time_delta=None):
+   """
+   Derive diskstat_metrics of a volume from the summed counter deltas of
+   its member devices, with io_time averaged over the members. time_delta
+   is taken from the members' timestamps when None.
 
-   collectd.info('diskstats get_default_dev_list: dev_list: --- %s\n'
-                 % (dev_list))
+   Returns: metric values in diskstat_metrics order, or None if no member
+            was collected in both reads
+   """
+   total = None
+   count = 0
+   for dev in members:
+      deltas = get_member_deltas(dev)
+      if deltas is None:
+         continue
+      if total is None:
+         total = deltas
+         if time_delta is None:
+            time_delta = calc_del_t(dev)
+      else:
+         total = [t + d for t, d in zip(total, deltas)]
+      count += 1
+   if total is None:
+      return None
+   total[F_IO_TIME] = total[F_IO_TIME] / float(count)
+   return calc_metrics_deltas(total, time_delta)
+
+def dispatch_rollups(time_delta=None):
+   for volume, members in sorted(volume_members.items()):
+      vals = calc_rollup_metrics(members, time_delta)
+      if vals is not None:
+         metric_dispatcher.add(volume, METRICS_TYPE, diskstat_metrics, vals,
+                               ROLLUP_INSTANCE, ROLLUP_INSTANCE + '.')
 
 def init_dev_stats_cache():
    global dev_stats_cache
    dev_stats_cache = collect_diskstats()
 
+def index_diskstats(lines):
+   """
+   Build the line index of monitored devices in /proc/diskstats.
+
+   The kernel prints devices in a stable order, so the line number of
+   each device in dev_list is recorded once and reused at every interval
+   until the number of lines (or the device list) changes.
+
+   Args:
+        lines: lines of /proc/diskstats, decoded
+
+   Returns:
+        Updated globals dev_index, (line number, device name, device
+        name as bytes) of each device, and dev_rows
+   """
+   global dev_index, dev_index_key
+   devs = set(dev_list)
+   index = []
+   for n, line in enumerate(lines):
+      fields = line.split(None, 3)
+      if len(fields) > 2 and fields[2] in devs:
+         index.append((n, fields[2], fields[2].encode('ascii')))
+   dev_index = index
+   dev_index_key = (DISKSTATS_FNAME, len(lines), dev_list, len(dev_list))
+   dev_rows.clear()
+   dev_rows.update((dev, row) for row, dev in enumerate(dev_list))
+   if topology_enabled:
+      # devices were added, removed or reordered: re-read the stacking
+      build_topology()
+   collectd.info('diskstats: indexed %d of %d devices in %d lines'
+                 % (len(dev_index), len(devs), len(lines)))
+   if len(dev_index) < len(devs):
+      # reported once per change of /proc/diskstats, the devices are
+      # skipped at each read until they come back
+      found = set(dev for n, dev, key in dev_index)
+      collectd.error('diskstats: devices not in %s: %s' %
+                     (DISKSTATS_FNAME,
+                      [dev for dev in dev_list if dev not in found]))
+
+def is_dev_index_valid(lines):
+   fname, nr_lines, devs, nr_devs = dev_index_key
+   return (nr_lines == len(lines) and devs is dev_list and
+           nr_devs == len(dev_list) and fname == DISKSTATS_FNAME)
+
 def collect_diskstats():
    """
    Collectd statistics for devices in global dev_list from /proc/diskstats
 
+   Only lines of monitored devices are split, up to the last raw field
+   of the detected layout, and only those columns are converted to ints.
+
    Args: None
 
    Returns: A dictionary collection of device specific raw statistics that
             includes timestamps
    """
    device_stats = {}
-   with open(DISKSTATS_FNAME) as f:
-      for line in f:
-         fields = line.split()
-         fields = [fl.strip() for fl in fields]
-         dev_name = fields[2]
-         if any(dev_name in s for s in dev_list):
-            for i in range(3, 14):
-                device_stats[(dev_name, diskstat_fields[i])] = fields[i]
-            device_stats[(dev_name, 'ts')] = time.time()
-      f.close()
-      return device_stats
+   lines = read_diskstats_lines()
+   check_dev_list(lines)
+   if not is_dev_index_valid(lines):
+      index_diskstats(procreader.decode_lines(lines))
+
+   ts = time.time()
+   nr_split = NR_RAW_FIELDS + 3
+   for n, dev_name, dev_key in dev_index:
+      fields = lines[n].tobytes().split(None, nr_split)
+      if fields[2] != dev_key:
+         # devices were replaced without changing the line count
+         index_diskstats(procreader.decode_lines(lines))
+         return collect_diskstats()
+      for k, v in zip(raw_field_names, fields[3:nr_split]):
+         device_stats[(dev_name, k)] = int(v)
+      device_stats[(dev_name, 'ts')] = ts
+   return device_stats
+
+def set_raw_fields(nr_fields):
+   """
+   Select the raw fields of the /proc/diskstats layout with nr_fields
+   fields after the device name.
+   """
+   global raw_field_names, NR_RAW_FIELDS
+   raw_field_names = all_raw_field_names[:nr_fields]
+   NR_RAW_FIELDS = nr_fields
+   init_counter_widths()
+
+def detect_raw_fields(lines):
+   """
+   Detect the /proc/diskstats layout from its number of columns and set
+   raw_field_names accordingly.
+
+   Args:
+        lines: lines of /proc/diskstats
+
+   Returns: number of raw fields of the layout
+   """
+   nr_fields = raw_field_layouts[0]
+   if lines:
+      nr_cols = len(lines[0].tobytes().split()) - 3
+      for n in raw_field_layouts:
+         if n <= nr_cols:
+            nr_fields = n
+   if nr_fields != NR_RAW_FIELDS:
+      set_raw_fields(nr_fields)
+   collectd.info('diskstats: %d raw fields: %s' % (NR_RAW_FIELDS,
+                                                   raw_field_names))
+   return nr_fields
 
 def swap_current_cache():
    global dev_stats_cache
@@ -221,57 +646,113 @@ def calc_del_t(dev):
    del_t = cur_t - pre_t
    return del_t
 
+def get_kernel_word_size():
+   machine = platform.machine()
+   return 64 if ('64' in machine or machine == 's390x') else 32
+
+def init_counter_widths():
+   """
+   Determine the wrap modulus of every column in raw_field_names.
+
+   The kernel prints the time fields of /proc/diskstats as unsigned int,
+   so they wrap at 2^32 on every architecture, while the other counters
+   are unsigned long and wrap at the kernel word size. Widths set through
+   the CounterWidth config option take precedence.
+
+   Args: None
+
+   Returns: Updated globals counter_bits and counter_wrap
+   """
+   global counter_bits, counter_wrap, counter_wrap_numpy
+   word_size = get_kernel_word_size()
+   counter_bits = []
+   for k in raw_field_names:
+      if k in counter_widths:
+         counter_bits.append(counter_widths[k])
+      elif k in time_fields:
+         counter_bits.append(32)
+      else:
+         counter_bits.append(word_size)
+   counter_wrap = [2 ** w for w in counter_bits]
+   if numpy is not None:
+      counter_wrap_numpy = numpy.array(counter_wrap, dtype=float)
+
+def counter_delta(cur, pre, col):
+   """
+   Delta of a raw_field_names counter that may have wrapped between two
+   reads. A negative delta is taken as a wrap only if the wrapped delta is
+   below half the counter range; otherwise the counter was reset (e.g. the
+   device was re-added) and the negative delta is kept so that metrics
+   derived from it are None.
+   """
+   delta = cur - pre
+   if delta < 0:
+      wrapped = delta + counter_wrap[col]
+      if wrapped <= counter_wrap[col] // 2:
+         return wrapped
+   return delta
+
+def counter_delta_numpy(deltas):
+   """
+   counter_delta() over a (devices x fields) matrix of deltas.
+   """
+   wrapped = deltas + counter_wrap_numpy
+   return numpy.where((deltas < 0) & (wrapped <= counter_wrap_numpy / 2),
+                      wrapped, deltas)
+
+init_counter_widths()
+
 def calc_metrics(dev):
    # time_delta is in seconds
    time_delta = calc_del_t(dev)
 
-   # read and write operation that actually complete
-   cur_r = int(dev_stats_current[(dev, 'reads_completed')])
-   pre_r = int(dev_stats_cache[(dev, 'reads_completed')])
-   cur_w = int(dev_stats_current[(dev, 'writes_completed')])
-   pre_w = int(dev_stats_cache[(dev, 'writes_completed')])
+   # per field counter deltas, in raw_field_names order
+   deltas = [counter_delta(int(dev_stats_current[(dev, k)]),
+                           int(dev_stats_cache[(dev, k)]), col)
+             for col, k in enumerate(raw_field_names)]
 
-   # read and write blocks
-   cur_sec_r = int(dev_stats_current[(dev, 'sectors_read')])
-   pre_sec_r = int(dev_stats_cache[(dev, 'sectors_read')])
-   cur_sec_w = int(dev_stats_current[(dev, 'sectors_written')])
-   pre_sec_w = int(dev_stats_cache[(dev, 'sectors_written')])
-
-   # read and write times in msec. These are 32-bit counters and
-   # monotonically increase except on overflow, when they restart
-   # from zero.
-   cur_t_r = float(dev_stats_current[(dev, 'time_spent_reading_ms')])
-   pre_t_r = float(dev_stats_cache[(dev, 'time_spent_reading_ms')])
-   cur_t_w = float(dev_stats_current[(dev, 'time_spent_writing_ms')])
-   pre_t_w = float(dev_stats_cache[(dev, 'time_spent_writing_ms')])
+   # return as a key-value dictionary:
+   # ['iops_read':iops_r, 'iops_write':iops_w, ... ]; discard and flush
+   # metrics are None on kernels without those fields
+   diskst = dict(zip(diskstat_metrics, calc_metrics_deltas(deltas, time_delta)))
+   return diskst
 
-   # note that io_time_ms is NOT equal to time_spent_reading +
-   # time_spent_writing.
-   # io_time_ms measures the time device is in use
-   cur_t_io = float(dev_stats_current[(dev, 'io_time_ms')])
-   pre_t_io = float(dev_stats_cache[(dev, 'io_time_ms')])
+def calc_metrics_deltas(deltas, time_delta):
+   """
+   Derive diskstat_metrics for one device from its counter deltas.
 
-   # weighted io times for calculating backlog.
-   # Will go to zero on 32-bit counter overflow.
-   cur_t_rq = float(dev_stats_current[(dev, 'weighted_time_spent_io')])
-   pre_t_rq = float(dev_stats_cache[(dev, 'weighted_time_spent_io')])
+   Args:
+        deltas: counter deltas in raw_field_names order
+        time_delta: observation interval in seconds
 
-   # number of reads and writes
-   nr_r = cur_r - pre_r
-   nr_w = cur_w - pre_w
+   Returns: list of metric values in diskstat_metrics order; a value is
+            None when it cannot be derived for this interval
+   """
+   # number of reads and writes that actually complete
+   nr_r = deltas[F_READS]
+   nr_w = deltas[F_WRITES]
    nr_rw = nr_r + nr_w
 
    # number of sectors read and written
-   nr_sec_r = cur_sec_r - pre_sec_r
-   nr_sec_w = cur_sec_w - pre_sec_w
+   nr_sec_r = deltas[F_SECTORS_READ]
+   nr_sec_w = deltas[F_SECTORS_WRITTEN]
    nr_sec_rw = nr_sec_r + nr_sec_w
 
-   # read and write times in seconds
-   t_r = (cur_t_r - pre_t_r)/1000.0
-   t_w = (cur_t_w - pre_t_w)/1000.0
+   # read and write times in seconds. These are 32-bit counters and
+   # monotonically increase except on overflow, when they restart
+   # from zero; counter_delta() accounts for the wrap.
+   t_r = deltas[F_TIME_READING]/1000.0
+   t_w = deltas[F_TIME_WRITING]/1000.0
    t_rw = t_r + t_w
-   t_io = (cur_t_io - pre_t_io)/1000.0
-   t_rq = (cur_t_rq - pre_t_rq)/1000.0
+
+   # note that io_time_ms is NOT equal to time_spent_reading +
+   # time_spent_writing.
+   # io_time_ms measures the time device is in use
+   t_io = deltas[F_IO_TIME]/1000.0
+
+   # weighted io times for calculating backlog.
+   # Will go to zero on 32-bit counter overflow (see counter_delta()).
+   t_rq = deltas[F_WEIGHTED_IO_TIME]/1000.0
 
    # iops
    iops_r = nr_r/time_delta if (nr_r >= 0 and time_delta > 0.0) else None
@@ -325,31 +806,192 @@ def calc_metrics(dev):
    except:
       svc_tm = None
 
-   # return as a key-value dictionary:
-   # ['iops_read':iops_r, 'iops_write':iops_w, ... ]
-   m = [iops_r, iops_w, iops, bps_r, bps_w, bps, sz_r, sz_w, sz,
-        await_r, await_w, await_rw, util_pct, avgqu_sz, svc_tm]
-   diskst = dict(zip(diskstat_metrics, m))
-   return diskst
+   # discards (4.18+) and flushes (5.5+): rates and average latency
+   iops_d = bps_d = await_d = iops_f = await_f = None
+   if len(deltas) > F_TIME_DISCARDING:
+      nr_d = deltas[F_DISCARDS]
+      nr_sec_d = deltas[F_SECTORS_DISCARDED]
+      t_d = deltas[F_TIME_DISCARDING]/1000.0
+      iops_d = nr_d/time_delta if (nr_d >= 0 and time_delta > 0.0) else None
+      bps_d = (nr_sec_d/time_delta)*dev_blk_sz if (nr_sec_d >= 0 and
+                                                   time_delta > 0.0) else None
+      await_d = t_d/nr_d if (t_d >= 0 and nr_d > 0) else None
+   if len(deltas) > F_TIME_FLUSHING:
+      nr_f = deltas[F_FLUSHES]
+      t_f = deltas[F_TIME_FLUSHING]/1000.0
+      iops_f = nr_f/time_delta if (nr_f >= 0 and time_delta > 0.0) else None
+      await_f = t_f/nr_f if (t_f >= 0 and nr_f > 0) else None
+
+   return [iops_r, iops_w, iops, bps_r, bps_w, bps, sz_r, sz_w, sz,
+           await_r, await_w, await_rw, util_pct, avgqu_sz, svc_tm,
+           iops_d, bps_d, await_d, iops_f, await_f]
+
+#=== Batched collection for all devices ===#
+def alloc_dev_snap():
+   """
+   Allocate a snapshot holding raw_field_names counters of every device
+   in dev_list, one row per device. Rows of devices missing from a read
+   hold NaN, which turns every metric derived from them into None.
+   """
+   if numpy is not None:
+      return numpy.empty((len(dev_list), NR_RAW_FIELDS))
+   return array.array('d', [NAN]) * (len(dev_list) * NR_RAW_FIELDS)
+
+def collect_diskstats_snap(snap):
+   """
+   Read /proc/diskstats into a snapshot allocated by alloc_dev_snap().
+
+   Args:
+        snap: snapshot to overwrite; replaced by the reallocated
+              dev_snap_current if the device list changed
 
-def dispatch_metrics(dev_name, keys, vals):
-   metric = collectd.Values()
-   metric.host = HOST_NAME
-   metric.plugin = METRIC_PLUGIN
-   metric.type = METRIC_TYPE
-   metric.plugin_instance = dev_name
-
-   for i in range(len(keys)):
-      if vals[i] is not None:
-         if ((filtered_metrics is None) or
-             (filtered_metrics is not None and keys[i] in filtered_metrics)):
-             metric.type_instance = keys[i]
-             metric.values = [vals[i]]
-             metric.dispatch()
+   Returns: timestamp of the read
+   """
+   lines = read_diskstats_lines()
+   if check_dev_list(lines):
+      snap = dev_snap_current
+   if not is_dev_index_valid(lines):
+      index_diskstats(procreader.decode_lines(lines))
+
+   ts = time.time()
+   if numpy is not None:
+      snap.fill(NAN)
+   else:
+      snap[:] = dev_snap_blank
+   nr_split = NR_RAW_FIELDS + 3
+   for n, dev_name, dev_key in dev_index:
+      fields = lines[n].tobytes().split(None, nr_split)
+      if fields[2] != dev_key:
+         index_diskstats(procreader.decode_lines(lines))
+         return collect_diskstats_snap(snap)
+      row = dev_rows[dev_name]
+      if numpy is not None:
+         snap[row] = [int(v) for v in fields[3:nr_split]]
+      else:
+         o = row * NR_RAW_FIELDS
+         snap[o:o + NR_RAW_FIELDS] = array.array('d', map(int,
+                                                          fields[3:nr_split]))
+   return ts
+
+def init_dev_snaps():
+   global dev_snap_blank, dev_snap_cache, dev_snap_current, dev_snap_cache_ts
+   dev_snap_blank = alloc_dev_snap()
+   dev_snap_cache = alloc_dev_snap()
+   dev_snap_current = alloc_dev_snap()
+   dev_snap_cache_ts = collect_diskstats_snap(dev_snap_cache)
+
+def swap_current_snap():
+   global dev_snap_cache, dev_snap_current, dev_snap_cache_ts
+   dev_snap_cache, dev_snap_current = dev_snap_current, dev_snap_cache
+   dev_snap_cache_ts = dev_snap_current_ts
+
+def calc_metrics_batch():
+   """
+   Derive diskstat_metrics for every device in dev_list from the current
+   and cached snapshots in one pass.
+
+   Args: None
+
+   Returns: list with one list of metric values per device in dev_list,
+            with the same None semantics as calc_metrics()
+   """
+   time_delta = dev_snap_current_ts - dev_snap_cache_ts
+   if numpy is not None:
+      deltas = dev_snap_current - dev_snap_cache
+      # a drop of the inflight_ios gauge is not a wrap
+      deltas[:, F_INFLIGHT] = 0
+      wrapped = deltas < 0
+      if wrapped.any():
+         deltas = numpy.where(wrapped, counter_delta_numpy(deltas), deltas)
+      return calc_metrics_numpy(deltas, time_delta)
+
+   n = NR_RAW_FIELDS
+   cur, pre = dev_snap_current, dev_snap_cache
+   metrics = []
+   for o in range(0, len(cur), n):
+      deltas = [c - p for c, p in zip(cur[o:o + n], pre[o:o + n])]
+      deltas[F_INFLIGHT] = 0
+      if min(deltas) < 0:
+         deltas = [counter_delta(d, 0, col) for col, d in enumerate(deltas)]
+      metrics.append(calc_metrics_deltas(deltas, time_delta))
+   return metrics
+
+def calc_metrics_numpy(deltas, time_delta):
+   """
+   numpy version of calc_metrics_deltas() over a (devices x fields)
+   matrix of counter deltas.
+   """
+   with numpy.errstate(divide='ignore', invalid='ignore'):
+      nr_r = deltas[:, F_READS]
+      nr_w = deltas[:, F_WRITES]
+      nr_rw = nr_r + nr_w
+      nr_sec_r = deltas[:, F_SECTORS_READ]
+      nr_sec_w = deltas[:, F_SECTORS_WRITTEN]
+      nr_sec_rw = nr_sec_r + nr_sec_w
+      t_r = deltas[:, F_TIME_READING]/1000.0
+      t_w = deltas[:, F_TIME_WRITING]/1000.0
+      t_rw = t_r + t_w
+      t_io = deltas[:, F_IO_TIME]/1000.0
+      t_rq = deltas[:, F_WEIGHTED_IO_TIME]/1000.0
+
+      def rate(count):
+         if time_delta <= 0.0:
+            return numpy.full(count.shape, NAN)
+         return numpy.where(count >= 0, count/time_delta, NAN)
+
+      def per_op(num, ops):
+         return numpy.where((num >= 0) & (ops > 0), num/ops, NAN)
+
+      iops_r = rate(nr_r)
+      iops_w = rate(nr_w)
+      iops = iops_r + iops_w
+      bps_r = rate(nr_sec_r)*dev_blk_sz
+      bps_w = rate(nr_sec_w)*dev_blk_sz
+      bps = bps_r + bps_w
+      sz_r = per_op(nr_sec_r * dev_blk_sz, nr_r)
+      sz_w = per_op(nr_sec_w * dev_blk_sz, nr_w)
+      sz = per_op(nr_sec_rw * dev_blk_sz, nr_rw)
+      await_r = per_op(t_r, nr_r)
+      await_w = per_op(t_w, nr_w)
+      await_rw = per_op(t_rw, nr_rw)
+      util = rate(t_io)
+      util_pct = util * 100.0
+      avgqu_sz = rate(t_rq)
+      svc_tm = numpy.where(iops != 0, util/iops, NAN)
+
+      missing = numpy.full(nr_r.shape, NAN)
+      iops_d = bps_d = await_d = iops_f = await_f = missing
+      if deltas.shape[1] > F_TIME_DISCARDING:
+         nr_d = deltas[:, F_DISCARDS]
+         iops_d = rate(nr_d)
+         bps_d = rate(deltas[:, F_SECTORS_DISCARDED])*dev_blk_sz
+         await_d = per_op(deltas[:, F_TIME_DISCARDING]/1000.0, nr_d)
+      if deltas.shape[1] > F_TIME_FLUSHING:
+         nr_f = deltas[:, F_FLUSHES]
+         iops_f = rate(nr_f)
+         await_f = per_op(deltas[:, F_TIME_FLUSHING]/1000.0, nr_f)
+
+      m = numpy.column_stack([iops_r, iops_w, iops, bps_r, bps_w, bps,
+                              sz_r, sz_w, sz, await_r, await_w, await_rw,
+                              util_pct, avgqu_sz, svc_tm,
+                              iops_d, bps_d, await_d, iops_f, await_f])
+   return [[None if v != v else v for v in row] for row in m.tolist()]
+
+def get_snap_row(snap, row):
+   if numpy is not None:
+      vals = snap[row].tolist()
+   else:
+      o = row * NR_RAW_FIELDS
+      vals = snap[o:o + NR_RAW_FIELDS].tolist()
+   return [None if v != v else int(v) for v in vals]
+
+def dispatch_metrics(dev_name, type_name, keys, vals):
+   metric_dispatcher.add(dev_name, type_name, keys, vals)
 
 #=== Callback functions registered with collectd ===#
 def configer(c):
-   global config, device_filter_regexes, filtered_metrics
+   global config, device_filter_regexes, filtered_metrics, batch_mode
+   global topology_enabled, hotplug_enabled
    collectd.info('diskstat plugin: configuring host: %s' % (HOST_NAME))
 
    # Load all configs 
@@ -376,24 +1018,78 @@ def configer(c):
           collectd.info("Metric filter is empty string, all metrics will be published")
    collectd.info('Filtered metrics are: %s' % (filtered_metrics))
 
+   metric_dispatcher.set_metric_filter(filtered_metrics)
+
+   if BATCH_MODE in config:
+      batch_mode = dispatcher.is_true(config[BATCH_MODE][0])
+   collectd.info('Batch mode: %s numpy: %s' % (batch_mode, numpy is not None))
+
+   if TOPOLOGY in config:
+      topology_enabled = dispatcher.is_true(config[TOPOLOGY][0])
+   collectd.info('Topology: %s' % (topology_enabled))
+
+   if HOTPLUG in config:
+      hotplug_enabled = dispatcher.is_true(config[HOTPLUG][0])
+   collectd.info('Hotplug: %s' % (hotplug_enabled))
+
+   # CounterWidth "io_time_ms" 64 "weighted_time_spent_io" 64
+   if COUNTER_WIDTH in config:
+      widths = list(config[COUNTER_WIDTH])
+      for k, w in zip(widths[0::2], widths[1::2]):
+         if k in all_raw_field_names and int(w) in (32, 64):
+            counter_widths[k] = int(w)
+         else:
+            collectd.error('diskstats: invalid CounterWidth %s %s' % (k, w))
+   init_counter_widths()
+   collectd.info('Counter widths: %s' % (dict(zip(raw_field_names,
+                                                   counter_bits))))
+
 def initer():
+   if BATCH_DISPATCH in config:
+      metric_dispatcher.set_batch(dispatcher.is_true(config[BATCH_DISPATCH][0]))
+   detect_raw_fields(read_diskstats_lines())
    get_dev_list()
    collectd.info('diskstat initer: dev list: %s ' % (dev_list))
-   init_dev_stats_cache()
-   collectd.info('diskstat init: dev_stats_cache: %s ' % (dev_stats_cache))
+   if batch_mode:
+      init_dev_snaps()
+   else:
+      init_dev_stats_cache()
+      collectd.info('diskstat init: dev_stats_cache: %s ' % (dev_stats_cache))
+   init_dev_fingerprint()
 
 def reader(input_data=None):
-   global dev_stats_current
-   dev_stats_current = collect_diskstats()
-   raw_dev_stats_names = diskstat_fields[3:14]
+   global dev_stats_current, dev_snap_current_ts
+   if batch_mode:
+      dev_snap_current_ts = collect_diskstats_snap(dev_snap_current)
+      metrics = calc_metrics_batch()
+      for row, i in enumerate(dev_list):
+         dispatch_metrics(i, RAW_TYPE, raw_field_names,
+                          get_snap_row(dev_snap_current, row))
+         dispatch_metrics(i, METRICS_TYPE, diskstat_metrics, metrics[row])
+      if topology_enabled:
+         dispatch_rollups(dev_snap_current_ts - dev_snap_cache_ts)
+      metric_dispatcher.flush()
+      swap_current_snap()
+      return
 
+   dev_stats_current = collect_diskstats()
    for i in dev_list:
+      if (i, 'ts') not in dev_stats_current:
+         # removed and still listed, e.g. with Hotplug false
+         continue
       raw_dev_stats_vals = [dev_stats_current[(i, k)] for k in
-                            raw_dev_stats_names]
-      dispatch_metrics(i, raw_dev_stats_names, raw_dev_stats_vals)
+                            raw_field_names]
+      dispatch_metrics(i, RAW_TYPE, raw_field_names, raw_dev_stats_vals)
+      if (i, 'ts') not in dev_stats_cache:
+         # new device, baseline taken by this read
+         continue
       metrics_key_vals = calc_metrics(i)
-      dispatch_metrics(i, metrics_key_vals.keys(), metrics_key_vals.values())
+      dispatch_metrics(i, METRICS_TYPE, diskstat_metrics,
+                       [metrics_key_vals[k] for k in diskstat_metrics])
+   if topology_enabled:
+      dispatch_rollups()
 
+   metric_dispatcher.flush()
    swap_current_cache()
 
 def writer(metric, data=None):
@@ -402,6 +1098,7 @@ def writer(metric, data=None):
 
 def shutdown():
    collectd.info("diskstat plugin shutting down")
+   procreader.close_reader(DISKSTATS_FNAME)
 
 #== Callbacks ==#
 if (OS_NAME == 'Linux'):
@@ -0,0 +1,211 @@
+#!/usr/bin/python
+
+##########################################################################
+# Copyright (c) 2015, Salesforce.com, Inc.
+# All rights reserved.
+#
+# Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#
+# Neither the name of Salesforce.com nor the names of its
+# contributors may be used to endorse or promote products
+# derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+##########################################################################
+
+"""
+**dispatcher.py**
+
+Shared metric dispatcher used by the telemetry plugins.
+
+By default every value is dispatched as its own 'gauge' with the metric
+name as type_instance, one collectd.Values.dispatch() call per value.
+With hundreds of devices or counters per interval, those calls and the
+write plugins behind them dominate the plugin cost.
+
+In batch mode a group of related values (for instance the 15 derived
+metrics of one disk) is dispatched as a single multi-value record whose
+type is defined in telemetry_types.db, e.g.:
+
+- diskstats  iops_read:GAUGE:0:U, iops_write:GAUGE:0:U, ...
+
+Values are accumulated per (plugin_instance, record type, type_instance)
+with add() and emitted with flush() at the end of the read callback.
+Values that are None, or excluded by the metric filter, are sent as NaN
+in a record and skipped in per-value mode.
+
+A record type is only used if collectd knows it with the same data
+sources (checked through collectd.get_dataset() when batch mode is
+enabled); other records fall back to per-value dispatch, so a plugin
+keeps working when telemetry_types.db is not in collectd's TypesDB.
+
+"""
+
+import collectd
+
+NAN = float('nan')
+
+class Dispatcher(object):
+   """
+   Dispatches the values of one plugin either one value at a time or as
+   multi-value records.
+
+   Args:
+        plugin: collectd plugin name
+        host: host name of the values
+        value_type: collectd type of values in per-value mode
+   """
+   def __init__(self, plugin, host, value_type='gauge'):
+      self.plugin = plugin
+      self.host = host
+      self.value_type = value_type
+      self.batch = False
+      self.metric_filter = None
+      self.record_types = {}
+      self.record_index = {}
+      self.batch_types = set()
+      self.pending = {}
+
+   def register_type(self, type_name, ds_names):
+      """
+      Declare a multi-value record type and its data source names, in the
+      order of its telemetry_types.db entry.
+      """
+      self.record_types[type_name] = list(ds_names)
+      self.record_index[type_name] = dict((n, i) for i, n in
+                                          enumerate(ds_names))
+
+   def set_metric_filter(self, names):
+      self.metric_filter = set(names) if names is not None else None
+
+   def set_batch(self, enabled):
+      """
+      Enable or disable multi-value records. Record types unknown to
+      collectd, or defined with different data sources, stay per-value.
+      """
+      self.batch = bool(enabled)
+      self.batch_types = set()
+      if not self.batch:
+         return
+      for type_name, ds_names in self.record_types.items():
+         if is_dataset_valid(type_name, ds_names):
+            self.batch_types.add(type_name)
+         else:
+            collectd.error('%s: type %s not found in TypesDB or has '
+                           'different data sources; dispatching its values '
+                           'one at a time' % (self.plugin, type_name))
+
+   def add(self, plugin_instance, type_name, names, vals,
+           type_instance='', prefix=''):
+      """
+      Add values of a record.
+
+      Args:
+           plugin_instance: collectd plugin_instance
+           type_name: record type registered with register_type()
+           names: data source names of vals
+           vals: values, None for unknown
+           type_instance: type_instance of the record in batch mode
+           prefix: prepended to each name to form the type_instance in
+                   per-value mode
+      """
+      if type_name not in self.batch_types:
+         self.dispatch_values(plugin_instance, names, vals, prefix)
+         return
+
+      key = (plugin_instance, type_name, type_instance)
+      record = self.pending.get(key)
+      if record is None:
+         record = [NAN] * len(self.record_types[type_name])
+         self.pending[key] = record
+      index = self.record_index[type_name]
+      for name, val in zip(names, vals):
+         i = index.get(name)
+         if i is not None and val is not None:
+            record[i] = val
+
+   def dispatch_values(self, plugin_instance, names, vals, prefix=''):
+      """
+      Dispatch values one at a time as self.value_type.
+      """
+      metric = collectd.Values()
+      metric.host = self.host
+      metric.plugin = self.plugin
+      metric.plugin_instance = plugin_instance
+      metric.type = self.value_type
+      metric_filter = self.metric_filter
+      for name, val in zip(names, vals):
+         if val is None:
+            continue
+         if metric_filter is not None and name not in metric_filter:
+            continue
+         metric.type_instance = prefix + name
+         metric.values = [val]
+         metric.dispatch()
+
+   def flush(self):
+      """
+      Dispatch accumulated records, one collectd.Values per record. A
+      record collectd rejects is logged and dropped, and does not keep
+      the other records, or those of later intervals, from dispatching.
+      """
+      if not self.pending:
+         return
+      pending = self.pending
+      self.pending = {}
+      metric = collectd.Values()
+      metric.host = self.host
+      metric.plugin = self.plugin
+      metric_filter = self.metric_filter
+      for key, record in pending.items():
+         plugin_instance, type_name, type_instance = key
+         if metric_filter is not None:
+            ds_names = self.record_types[type_name]
+            record = [v if ds_names[i] in metric_filter else NAN
+                      for i, v in enumerate(record)]
+         metric.plugin_instance = plugin_instance
+         metric.type = type_name
+         metric.type_instance = type_instance
+         metric.values = record
+         try:
+            metric.dispatch()
+         except Exception as e:
+            collectd.error('%s: failed to dispatch %s/%s/%s: %s' %
+                           (self.plugin, plugin_instance, type_name,
+                            type_instance, e))
+
+def is_dataset_valid(type_name, ds_names):
+   """
+   Check that collectd's TypesDB defines type_name with ds_names.
+   """
+   get_dataset = getattr(collectd, 'get_dataset', None)
+   if get_dataset is None:
+      return False
+   try:
+      dataset = get_dataset(type_name)
+   except Exception:
+      return False
+   return [ds[0] for ds in dataset] == list(ds_names)
+
+def is_true(val):
+   """
+   Interpret a collectd config value (boolean or string) as a boolean.
+   """
+   return val not in (False, 'false', 'False', 'no', '0', 0)
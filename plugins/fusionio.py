@@ -34,48 +34,59 @@
 **fusionio.py**
 
 Collectd plugin for fusion-io device measurement. It
-currently measures:
-1. physical blocks read
-2. physical blocks written
+currently measures, per device:
+1. physical bytes read
+2. physical bytes written
 3. total blocks
 4. min block erases count
 5. max block erases count
 6. average block erases count
-
-physical bytes written are obtained as:
----------------------------------------
-
-cmd_bytes_written = '/usr/bin/fio-status -a | '
-
-cmd_bytes_written += 'grep \"Physical bytes written:\" | '
-
-cmd_bytes_written += 'awk \'{print $4}\''
-
-physical bytes read are obtained as:
-------------------------------------
-
-cmd_bytes_read = '/usr/bin/fio-status -a | '
-
-cmd_bytes_read += 'grep \"Physical bytes read   :\" | '
-
-cmd_bytes_read += 'awk \'{print $5}\''
-
-Block erase counts (total, min, max, avg) are obtained as:
-----------------------------------------------------------
-
-cmd_erased_blocks = '/usr/bin/fio-get-erase-count /dev/fct0 | '
-
-cmd_erased_blocks += 'tail -n 5 | cut -d: -f 2 | sed \'s/^ \*//\''
+7. logical bytes read/written (/sys/block/<dev>/stat)
+
+Devices are discovered under /proc/fusion/fio (fioa, fiob, ...). At
+init, the files under each device's data directory are scanned once and
+those holding known counters (e.g. data/groomer/stats) are kept; they
+are then re-read through persistent descriptors at every interval, which
+costs microseconds per card.
+
+Counters not found in any file fall back to the command-line tools.
+Physical bytes read/written come from 'fio-status -a', one section per
+card:
+
+- fct0    Attached
+- fioa    State: Online, Type: block device
+- Physical bytes written: 1,234,567,890
+- Physical bytes read   : 987,654,321
+
+Block erase counts (total, min, max, avg) come from
+'fio-get-erase-count -s /dev/fctN':
+
+- Total blocks: 4020
+- Min: 1
+- Max: 12
+- Avg: 5.46
+
+Forking these tools costs far more than the metrics are worth at every
+read interval, so a background FioSampler thread runs them on their own
+cadence (SampleInterval seconds, 60 by default), kills a tool that does
+not finish within CommandTimeout seconds, and parses all keys of the
+output in one pass. reader() dispatches the last good values at once.
+The tool paths can be set with FioStatus and FioGetEraseCount, e.g. to
+test with a fake fio-status script.
 
 """
 
 import collectd
 import platform
 import os
+import re
+import signal
 import socket
 import time
-import re
 import subprocess
+import threading
+
+import procreader
 
 try:
    long        # Python 2
@@ -87,19 +98,38 @@ host_name = socket.gethostbyaddr(socket.gethostname())[0]
 host_types = ['app', 'db', 'ffx', 'indexer', 'search', 'other']
 host_type = 'other'
 
+METRIC_PLUGIN = 'fusionio'
+METRIC_TYPE = 'gauge'
+
+# config keys
+FIO_STATUS = 'FioStatus'
+FIO_GET_ERASE_COUNT = 'FioGetEraseCount'
+SAMPLE_INTERVAL = 'SampleInterval'
+COMMAND_TIMEOUT = 'CommandTimeout'
+
+FIO_PROC_DIR = '/proc/fusion/fio'
+SYS_BLOCK_DIR = '/sys/block'
+SECTOR_SIZE = 512
+
 cmd_fio_status = '/usr/bin/fio-status'
 args_fio_status = '-a'
-key_bytes_read = 'Physical bytes read   :'
-key_bytes_written = 'Physical bytes written:'
-
 cmd_fio_get_erase_blocks = '/usr/bin/fio-get-erase-count'
-args_fio_get_erase_blocks = '-s /dev/fct0'
-key_blocks_total = 'Total blocks:'
-key_blocks_min = 'Min:'
-key_blocks_max = 'Max:'
-key_blocks_avg = 'Avg:'
+args_fio_get_erase_blocks = '-s'
+
+# key in the tools output or procfs files -> metric
+fio_keys = {'Physical bytes written': 'phy_bytes_written',
+            'Physical bytes read': 'phy_bytes_read',
+            'Total blocks': 'erased_blocks_total',
+            'Min': 'erased_blocks_min',
+            'Max': 'erased_blocks_max',
+            'Avg': 'erased_blocks_avg'}
+status_metrics = ['phy_bytes_written', 'phy_bytes_read']
+erase_metrics = ['erased_blocks_total', 'erased_blocks_min',
+                 'erased_blocks_max', 'erased_blocks_avg']
+
+sample_interval = 60
+command_timeout = 10
 
-fio_fname = '/proc/fusion/fio/fioa/data/groomer/stats'
 fio_fields = ['Blocks']
               #'Data copied:']
 fio_white_list = ['phy_bytes_written',
@@ -107,17 +137,27 @@ fio_white_list = ['phy_bytes_written',
                   'erased_blocks_total',
                   'erased_blocks_min',
                   'erased_blocks_max',
-                  'erased_blocks_avg']
+                  'erased_blocks_avg',
+                  'bytes_read',
+                  'bytes_written']
 
 fio_metrics = ['physical_bytes_read_per_sec',
                'physical_bytes_written_per_sec',
                'blocks_erased_per_sec']
 
+re_fct = re.compile(r'^fct(?P<fct>\d+)\s')
+re_fio_dev = re.compile(r'^\s+(?P<dev>fio[a-z]+)\s')
+
+config = {}
+# device -> procfs files holding known counters
+fio_devices = {}
 stats_cache = {}
 stats_current = {}
 fiostats_cache = {}
 fiostats_current = {}
 
+sampler = None
+
 def get_host_type():
    global host_type
    for i in host_types:
@@ -125,178 +165,358 @@ def get_host_type():
          host_type = i
    collectd.info('fusionio: get_host_by_type: %s' % (host_type))
 
-def is_fio_device():
-   if os.path.exists(fio_fname):
-      if os.path.exists(cmd_fio_status):
-         if os.path.exists(cmd_fio_get_erase_blocks):
-            return True
-         else:
-            collectd.error('%s not found:' % (cmd_fio_get_erase_blocks))
-      else:
-         collectd.error('%s not found:' % (cmd_fio_status))
-   else:
-      collectd.error('%s not found:' % (fio_fname))
+def get_fio_devices():
+   """
+   Returns: fio block devices under FIO_PROC_DIR
+   """
+   try:
+      return sorted(d for d in os.listdir(FIO_PROC_DIR) if d.startswith('fio'))
+   except (IOError, OSError):
+      return []
 
+def is_fio_device():
+   if get_fio_devices():
+      return True
+   collectd.error('no fio device found in %s' % (FIO_PROC_DIR))
    return False
 
-def run_cmd (cmd):
-   s = ''
-   p = subprocess.Popen(cmd,
-                        shell=True,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.STDOUT)
-   for line in p.stdout.readlines():
-      s += line
-
-   return s
-
-def grep(s, pattern):
-   return '\n'.join(re.findall(r'^.*%s.*?$'%pattern,s,flags=re.M))
-
-def remove_start(s, word_to_remove):
-   return s[len(word_to_remove):] if s.startswith(word_to_remove) else ""
-
-def extract_val(out, key):
-   val = 0
-   if (out):
-      key_line = grep(out, key).lstrip()
-      if (key_line):
-         collectd.debug('key: %s key_line: %s' % (key, key_line))
-         val_str = remove_start(key_line, key)
-         collectd.debug('val_str: %s' % (val_str))
-         if '.' in val_str:
-            val = long(float(val_str.replace(',', '')))
-         else:
-            val = long(val_str.replace(',', ''))
-         collectd.debug('value: %d' % (val))
-      else:
-         collectd.debug('no line found with key: %s' % (key))
-   else:
-      collectd.debug('nothing to process in provided output str: %s' % (out))
-
-   return val
-
-def get_physical_bytes():
-   bytes_written = 0
-   bytes_read = 0
-
-   if os.path.exists(cmd_fio_status):
-      cmd = cmd_fio_status + ' ' + args_fio_status
-      out = run_cmd(cmd)
-      if (out):
-         bytes_written = extract_val(out, key_bytes_written)
-         bytes_read = extract_val(out, key_bytes_read)
-      else:
-         collectd.error('get_physical_bytes: failed to run cmd: %s' % (cmd))
-   else:
-      collectd.warning('get_physical_bytes: %s not found' % (cmd_fio_status))
-
-   return (bytes_read, bytes_written)
-
-def get_block_erases():
-   b_total = 0
-   b_min = 0
-   b_max = 0
-   b_avg = 0
-
-   if os.path.exists(cmd_fio_get_erase_blocks):
-      cmd = cmd_fio_get_erase_blocks + ' ' + args_fio_get_erase_blocks
-      out = run_cmd(cmd)
-      if (out):
-         ebs = out.split('\n')
-         b_total = extract_val(out, key_blocks_total)
-         b_min = extract_val(out, key_blocks_min)
-         b_max = extract_val(out, key_blocks_max)
-         b_avg = extract_val(out, key_blocks_avg)
-      else:
-         collectd.error('get_block_erases: failed to run cmd: %s' %(cmd))
-   else:
-      collectd.warning('get_block_erases: %s missing?' % (cmd_get_erase_blocks))
-
-   return (b_total, b_min, b_max, b_avg)
-
-
-def get_fiostats():
-   phy_b_r, phy_b_w = get_physical_bytes()
-   eb_total, eb_min, eb_max, eb_avg = get_block_erases()
-
-   for m in fio_white_list:
-      fiostats_current[(m, 'ts')] = time.time()
-   fiostats_current[('phy_bytes_written', 'val')] = phy_b_w
-   fiostats_current[('phy_bytes_read', 'val')] = phy_b_r
-   fiostats_current[('erased_blocks_total', 'val')] = eb_total
-   fiostats_current[('erased_blocks_min', 'val')] = eb_min
-   fiostats_current[('erased_blocks_max', 'val')] = eb_max
-   fiostats_current[('erased_blocks_avg', 'val')] = eb_avg
-
-   for m in fio_white_list:
-      metric = collectd.Values()
-      metric.host = host_name
-      metric.plugin = 'fusionio'
-      metric.type = 'gauge'
-      metric.type_instance = m
-      metric.values = [fiostats_current[(m, 'val')]]
-      metric.dispatch()
-
+def parse_val(val_str):
+   val_str = val_str.split()[0].replace(',', '')
+   if '.' in val_str:
+      return long(float(val_str))
+   return long(val_str)
+
+def parse_output(out, keys=fio_keys):
+   """
+   Parse "key: value" lines of the tools output in one pass.
+
+   Returns: dict of metric -> value for the keys found
+   """
+   vals = {}
+   for line in out.splitlines():
+      key, sep, val_str = line.partition(':')
+      if not sep:
+         continue
+      metric = keys.get(key.strip())
+      if metric is None or metric in vals:
+         continue
+      try:
+         vals[metric] = parse_val(val_str)
+      except (ValueError, IndexError):
+         collectd.debug('fusionio: unexpected value: %s' % (line))
+   return vals
+
+def parse_stats_file(text):
+   """
+   Parse a procfs stats file: "key: value" lines of known counters, and
+   groomer stats fields (key in fio_fields, value in the third column).
+   """
+   vals = parse_output(text)
+   for line in text.splitlines():
+      fields = line.split()
+      if len(fields) > 2 and fields[0] in fio_fields:
+         try:
+            vals[fields[0]] = int(fields[2])
+         except ValueError:
+            pass
+   return vals
+
+def parse_status_sections(out, devs):
+   """
+   Split 'fio-status -a' output into its per-card sections.
+
+   Args:
+        out: output of fio-status -a
+        devs: known devices, the first one is used for the section of a
+              card whose block device is not listed
+
+   Returns: dict of (dev, metric) -> value, dict of dev -> fct number
+   """
+   vals = {}
+   fcts = {}
+   sections = []
+   for line in out.splitlines():
+      m = re_fct.match(line)
+      if m:
+         sections.append([m.group('fct'), None, []])
+         continue
+      if not sections:
+         continue
+      m = re_fio_dev.match(line)
+      if m and sections[-1][1] is None:
+         sections[-1][1] = m.group('dev')
+      sections[-1][2].append(line)
+
+   for fct, dev, lines in sections:
+      if dev is None:
+         if len(sections) > 1 or not devs:
+            continue
+         dev = devs[0]
+      fcts[dev] = fct
+      for metric, val in parse_output('\n'.join(lines)).items():
+         vals[(dev, metric)] = val
+   return vals, fcts
+
+def kill_cmd(p):
+   # the command runs in its own session; kill its children too, as they
+   # would keep the output pipe open
+   try:
+      os.killpg(p.pid, signal.SIGKILL)
+   except OSError:
+      pass
+
+def run_cmd(args, timeout):
+   """
+   Run a command without a shell, killing it after timeout seconds.
+
+   Returns: output of the command, or None if it failed or timed out
+   """
+   try:
+      p = subprocess.Popen(args,
+                           stdout=subprocess.PIPE,
+                           stderr=subprocess.STDOUT,
+                           close_fds=True,
+                           preexec_fn=os.setsid)
+   except (IOError, OSError) as e:
+      collectd.error('fusionio: failed to run %s: %s' % (args, e))
+      return None
+
+   timer = threading.Timer(timeout, kill_cmd, [p])
+   timer.start()
+   try:
+      out = p.communicate()[0]
+   finally:
+      timer.cancel()
+   if p.returncode == -signal.SIGKILL:
+      collectd.error('fusionio: %s timed out after %ss' % (args, timeout))
+      return None
+   if p.returncode != 0:
+      collectd.error('fusionio: %s exited with %d' % (args, p.returncode))
+      return None
+   return out.decode('ascii', 'replace')
+
+class FioSampler(threading.Thread):
+   """
+   Runs the fusion-io tools in the background for the devices whose
+   counters are not available in procfs, and keeps the values of the last
+   successful run of each.
+
+   Args:
+        devs: devices to sample
+        interval: seconds between runs
+        timeout: seconds after which a tool is killed
+   """
+   def __init__(self, devs, interval, timeout):
+      threading.Thread.__init__(self, name='fusionio-sampler')
+      self.daemon = True
+      self.devs = devs
+      self.interval = interval
+      self.timeout = timeout
+      self.stopped = threading.Event()
+      self.lock = threading.Lock()
+      self.fcts = {}
+      self.values = {}
+      self.ts = {}
+
+   def update(self, vals):
+      ts = time.time()
+      with self.lock:
+         for key, val in vals.items():
+            self.values[key] = val
+            self.ts[key] = ts
+
+   def sample(self):
+      out = run_cmd([cmd_fio_status] + args_fio_status.split(), self.timeout)
+      if out is not None:
+         vals, self.fcts = parse_status_sections(out, self.devs)
+         self.update(vals)
+
+      for dev in self.devs:
+         # /dev/fct0 for a single card whose section does not name it
+         fct = self.fcts.get(dev, '0' if len(self.devs) == 1 else None)
+         if fct is None:
+            continue
+         args = [cmd_fio_get_erase_blocks] + args_fio_get_erase_blocks.split()
+         out = run_cmd(args + ['/dev/fct' + fct], self.timeout)
+         if out is not None:
+            self.update(dict(((dev, metric), val) for metric, val in
+                             parse_output(out).items()
+                             if metric in erase_metrics))
+
+   def run(self):
+      while not self.stopped.is_set():
+         try:
+            self.sample()
+         except Exception as e:
+            collectd.error('fusionio: sampler: %s' % (e))
+         self.stopped.wait(self.interval)
+
+   def stop(self):
+      self.stopped.set()
+
+   def get_values(self):
+      """
+      Returns: (values, timestamps) of the last good samples, keyed by
+               (dev, metric)
+      """
+      with self.lock:
+         return dict(self.values), dict(self.ts)
+
+def discover_stats_files(dev):
+   """
+   Returns: files under the data directory of dev holding known counters
+   """
+   files = []
+   data_dir = os.path.join(FIO_PROC_DIR, dev, 'data')
+   for root, dirs, fnames in os.walk(data_dir):
+      dirs.sort()
+      for fname in sorted(fnames):
+         path = os.path.join(root, fname)
+         try:
+            with open(path) as f:
+               text = f.read()
+         except (IOError, OSError):
+            continue
+         if parse_stats_file(text):
+            files.append(path)
+   return files
+
+def discover_devices():
+   fio_devices.clear()
+   for dev in get_fio_devices():
+      fio_devices[dev] = discover_stats_files(dev)
+      collectd.info('fusionio: %s: stats files: %s' % (dev, fio_devices[dev]))
+
+def read_block_stat(dev):
+   """
+   Returns: logical bytes read/written of dev from sysfs, or {}
+   """
+   text = procreader.get_reader(os.path.join(SYS_BLOCK_DIR, dev,
+                                             'stat')).text()
+   if text is None:
+      return {}
+   fields = text.split()
+   if len(fields) < 7:
+      return {}
+   return {'bytes_read': int(fields[2]) * SECTOR_SIZE,
+           'bytes_written': int(fields[6]) * SECTOR_SIZE}
+
+def read_device_stats(dev):
+   """
+   Returns: counters of dev read from procfs and sysfs
+   """
+   vals = read_block_stat(dev)
+   for fname in fio_devices.get(dev, []):
+      text = procreader.get_reader(fname).text()
+      if text is not None:
+         vals.update(parse_stats_file(text))
+   return vals
+
+def get_cli_devices():
+   """
+   Returns: devices missing physical bytes or erase counts in procfs
+   """
+   devs = []
+   for dev in sorted(fio_devices.keys()):
+      vals = read_device_stats(dev)
+      if any(m not in vals for m in status_metrics + erase_metrics):
+         devs.append(dev)
+   return devs
 
+def collect_fiostats():
+   ts = time.time()
+   cli_vals, cli_ts = {}, {}
+   if sampler is not None:
+      cli_vals, cli_ts = sampler.get_values()
+
+   metric = collectd.Values()
+   metric.host = host_name
+   metric.plugin = METRIC_PLUGIN
+   metric.type = METRIC_TYPE
+   for dev in sorted(fio_devices.keys()):
+      vals = read_device_stats(dev)
+      metric.plugin_instance = dev
+      for m in fio_fields + fio_white_list:
+         if m in vals:
+            stats_current[(dev, m, 'val')] = vals[m]
+            stats_current[(dev, m, 'ts')] = ts
+            val = vals[m]
+         elif (dev, m) in cli_vals:
+            fiostats_current[(dev, m, 'val')] = cli_vals[(dev, m)]
+            fiostats_current[(dev, m, 'ts')] = cli_ts[(dev, m)]
+            val = cli_vals[(dev, m)]
+         else:
+            continue
+         metric.type_instance = m
+         metric.values = [val]
+         metric.dispatch()
 
 def init_stats_cache():
-    if os.path.exists(fio_fname):
-        with open(fio_fname) as f:
-            for line in f:
-                fields = line.split()
-                fields = [fl.strip() for fl in fields]
-                key_name = fields[0]
-                key_val = int(fields[2])
-                if any(key_name in s for s in fio_fields):
-                    stats_cache[(key_name, 'val')] = key_val
-                    stats_cache[(key_name, 'ts')] = time.time()
-            f.close()
-    else:
-        collectd.info('fusionio: init_stats_cache: path: %s does not exist'
-                      % (fio_fname))
-
-def collect_fiostats():
-    if os.path.exists(fio_fname):
-        with open(fio_fname) as f:
-            for line in f:
-                fields = line.split()
-                fields = [fl.strip() for fl in fields]
-                key_name = fields[0]
-                key_val = int(fields[2])
-                if any(key_name in s for s in fio_fields):
-                    metric = collectd.Values()
-                    metric.host = host_name
-                    metric.plugin = 'fusionio'
-                    metric.type = 'gauge'
-                    metric.type_instance = key_name
-                    metric.values = [key_val]
-                    stats_current[(key_name, 'val')] = key_val
-                    metric.dispatch()
-                    stats_current[(key_name, 'ts')] = time.time()
-            f.close()
-    else:
-        collectd.info('fusionio: procfs path: %s does not exist' % (fio_fname))
+   discover_devices()
+   ts = time.time()
+   for dev in sorted(fio_devices.keys()):
+      for m, val in read_device_stats(dev).items():
+         stats_cache[(dev, m, 'val')] = val
+         stats_cache[(dev, m, 'ts')] = ts
 
 def swap_current_cache():
-   for i in fio_fields:
-       stats_cache[(i, 'val')] = stats_current[(i, 'val')]
-       stats_cache[(i, 'ts')] = stats_current[(i, 'ts')]
-
+   global stats_cache, stats_current, fiostats_cache, fiostats_current
+   stats_cache, stats_current = stats_current, stats_cache
+   fiostats_cache, fiostats_current = fiostats_current, fiostats_cache
 
 def configer(ObjConfiguration):
+   global cmd_fio_status, cmd_fio_get_erase_blocks
+   global sample_interval, command_timeout
    collectd.info('fusionio plugin: configuring host: %s' % (host_name))
+   for child in ObjConfiguration.children:
+      config[child.key] = child.values
+
+   if FIO_STATUS in config:
+      cmd_fio_status = config[FIO_STATUS][0]
+   if FIO_GET_ERASE_COUNT in config:
+      cmd_fio_get_erase_blocks = config[FIO_GET_ERASE_COUNT][0]
+   if SAMPLE_INTERVAL in config:
+      sample_interval = float(config[SAMPLE_INTERVAL][0])
+   if COMMAND_TIMEOUT in config:
+      command_timeout = float(config[COMMAND_TIMEOUT][0])
+   collectd.info('fusionio plugin: sample interval: %s timeout: %s' %
+                 (sample_interval, command_timeout))
+
+def start_sampler():
+   """
+   Start the command-line sampler for devices whose counters are not all
+   in procfs, if the tools are installed.
+   """
+   global sampler
+   devs = get_cli_devices()
+   if not devs:
+      return
+   if not os.path.exists(cmd_fio_status) or \
+         not os.path.exists(cmd_fio_get_erase_blocks):
+      collectd.warning('fusionio: %s or %s not found; no physical bytes or '
+                       'erase counts for %s' %
+                       (cmd_fio_status, cmd_fio_get_erase_blocks, devs))
+      return
+   collectd.info('fusionio: sampling %s with %s' % (devs, cmd_fio_status))
+   sampler = FioSampler(devs, sample_interval, command_timeout)
+   sampler.start()
+
+def stop_sampler():
+   global sampler
+   if sampler is not None:
+      sampler.stop()
+      sampler.join(command_timeout)
+      sampler = None
 
 def initer():
    collectd.info('fusionio plugin: host of type: %s' % (host_type))
    collectd.info('fusionio initer: fields list: %s ' % (fio_fields))
    init_stats_cache()
    collectd.info('fusionio init: stats_cache: %s ' % (stats_cache))
+   start_sampler()
 
 def reader(input_data=None):
-   get_fiostats()
    collect_fiostats()
-   #dispatch_metrics()
    swap_current_cache()
 
 def writer(metric, data=None):
@@ -305,6 +525,11 @@ def writer(metric, data=None):
 
 def shutdown():
    collectd.info("fusionio plugin shutting down")
+   stop_sampler()
+   for dev, fnames in fio_devices.items():
+      procreader.close_reader(os.path.join(SYS_BLOCK_DIR, dev, 'stat'))
+      for fname in fnames:
+         procreader.close_reader(fname)
 
 #== Callbacks ==#
 get_host_type()
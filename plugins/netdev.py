@@ -0,0 +1,353 @@
+#!/usr/bin/python
+
+##########################################################################
+# Copyright (c) 2015, Salesforce.com, Inc.
+# All rights reserved.
+#
+# Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#
+# Neither the name of Salesforce.com nor the names of its
+# contributors may be used to endorse or promote products
+# derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+##########################################################################
+
+"""
+**netdev.py**
+
+Per network interface traffic, drop and error rates from /proc/net/dev,
+which complements the protocol counters of the netstats plugin:
+
+- Inter-|   Receive                            |  Transmit
+-  face |bytes    packets errs drop fifo frame ...|bytes    packets ...
+-   eth0: 1564312     171    0    0    0     0 ...   15268     173 ...
+
+Each interface row has 8 receive counters (bytes, packets, errs, drop,
+fifo, frame, compressed, multicast) and 8 transmit counters (bytes,
+packets, errs, drop, fifo, colls, carrier, compressed). From the
+previous interval's snapshot, the plugin derives per interface:
+
+- rx_bytes_per_sec, tx_bytes_per_sec
+- rx_packets_per_sec, tx_packets_per_sec
+- rx_errors_per_sec, tx_errors_per_sec
+- rx_drops_per_sec, tx_drops_per_sec
+- rx_multicast_per_sec
+
+With ExtendedStats, the error counters that /proc/net/dev folds into
+errs (rx_crc_errors, rx_missed_errors, tx_carrier_errors, ...) are also
+read from /sys/class/net/<interface>/statistics and reported as rates.
+These files are opened and closed at every interval rather than kept
+open, as a host with thousands of veth pairs would otherwise run out of
+file descriptors. Counters the driver does not provide (e.g.
+rx_nohandler before 4.6) are only tried once per interface and are not
+reported; a counter that fails to read at an interval has no rate at
+that interval and the next, rather than a rate from a bogus value.
+
+Interfaces are selected with InterfaceFilter regular expressions,
+matched as DiskFilter of diskstats (see devfilter), '!' patterns
+excluding interfaces; by default all interfaces but loopback are
+reported. Interfaces that appear or disappear between
+intervals (hotplug, containers' veth pairs) are added or dropped on the
+fly; a new interface is reported from its second interval on.
+
+"""
+
+import collectd
+import platform
+import os
+import socket
+import time
+from array import array
+
+import devfilter
+import dispatcher
+import procreader
+
+os_name = platform.system()
+host_name = socket.gethostbyaddr(socket.gethostname())[0]
+host_types = ['app', 'db', 'ffx', 'indexer', 'search', 'other']
+host_type = 'other'
+
+NETDEV_FNAME = '/proc/net/dev'
+SYS_NET_DIR = '/sys/class/net'
+
+METRIC_PLUGIN = 'netdev'
+METRIC_TYPE = 'gauge'
+BATCH_DISPATCH = 'BatchDispatch'
+
+# config keys
+INTERFACE_FILTER = 'InterfaceFilter'
+EXTENDED_STATS = 'ExtendedStats'
+
+netdev_fields = ['rx_bytes', 'rx_packets', 'rx_errs', 'rx_drop',
+                 'rx_fifo', 'rx_frame', 'rx_compressed', 'rx_multicast',
+                 'tx_bytes', 'tx_packets', 'tx_errs', 'tx_drop',
+                 'tx_fifo', 'tx_colls', 'tx_carrier', 'tx_compressed']
+NUM_FIELDS = len(netdev_fields)
+
+# (metric, field) of the rates derived from /proc/net/dev
+netdev_rates = [('rx_bytes_per_sec', 'rx_bytes'),
+                ('tx_bytes_per_sec', 'tx_bytes'),
+                ('rx_packets_per_sec', 'rx_packets'),
+                ('tx_packets_per_sec', 'tx_packets'),
+                ('rx_errors_per_sec', 'rx_errs'),
+                ('tx_errors_per_sec', 'tx_errs'),
+                ('rx_drops_per_sec', 'rx_drop'),
+                ('tx_drops_per_sec', 'tx_drop'),
+                ('rx_multicast_per_sec', 'rx_multicast')]
+netdev_metrics = [m for m, f in netdev_rates]
+rate_slots = [netdev_fields.index(f) for m, f in netdev_rates]
+
+# /sys/class/net/<interface>/statistics counters not in /proc/net/dev
+extended_fields = ['rx_crc_errors',
+                   'rx_length_errors',
+                   'rx_missed_errors',
+                   'rx_over_errors',
+                   'rx_nohandler',
+                   'tx_aborted_errors',
+                   'tx_carrier_errors',
+                   'tx_heartbeat_errors',
+                   'tx_window_errors']
+extended_metrics = [f + '_per_sec' for f in extended_fields]
+
+# value of a counter that could not be read; rates involving it are None
+INVALID = -1
+
+# python 2 arrays have no 'q'; 'l' is 64 bits on LP64 Linux
+try:
+   STATS_TYPECODE = array('q').typecode
+except ValueError:
+   STATS_TYPECODE = 'l'
+
+interface_filter_regexes = None
+extended_stats = False
+
+class Interface(object):
+   """
+   Counters of one interface at the current and previous interval: the
+   /proc/net/dev fields followed by the extended fields, if enabled.
+   """
+   __slots__ = ('name', 'cur', 'pre', 'ext_files')
+
+   def __init__(self, name, num_counters):
+      self.name = name
+      self.cur = array(STATS_TYPECODE, [0]) * num_counters
+      self.pre = None
+      # (slot in cur, path) of the extended counters the driver provides,
+      # None until they are first read
+      self.ext_files = None
+
+   def swap(self):
+      if self.pre is None:
+         self.pre = array(STATS_TYPECODE, self.cur)
+      else:
+         self.pre, self.cur = self.cur, self.pre
+
+# interface name -> Interface of reported interfaces
+interfaces = {}
+
+# InterfaceFilter compiled with devfilter, see update_interface_filter()
+interface_filter = None
+
+# time of the previous read of /proc/net/dev
+last_ts = None
+
+config = {}
+
+# rates of an interface are a single 'netdev' record with BatchDispatch
+metric_dispatcher = dispatcher.Dispatcher(METRIC_PLUGIN, host_name, METRIC_TYPE)
+metric_dispatcher.register_type(METRIC_PLUGIN, netdev_metrics)
+
+def get_host_type():
+   for i in host_types:
+      if i in host_name:
+         host_type = i
+
+def update_interface_filter():
+   """
+   Compile InterfaceFilter; interfaces other than loopback are selected
+   when it has no include pattern.
+   """
+   global interface_filter
+   interface_filter = devfilter.DeviceFilter(interface_filter_regexes,
+                                             lambda name: name != 'lo')
+
+def parse_netdev(text):
+   """
+   Parse /proc/net/dev.
+
+   Returns: [(interface, counters)] for the selected interfaces
+   """
+   devs = []
+   for line in text.splitlines()[2:]:
+      name, sep, rest = line.partition(':')
+      if not sep:
+         continue
+      name = name.strip()
+      if not interface_filter.match(name):
+         continue
+      devs.append((name, [int(v) for v in rest.split()[:NUM_FIELDS]]))
+   return devs
+
+def extended_fname(name, field):
+   return os.path.join(SYS_NET_DIR, name, 'statistics', field)
+
+def read_extended(iface):
+   """
+   Read the extended counters of an interface into iface.cur. Counters
+   missing at the first read are not provided by the driver: they are
+   left INVALID and not tried again. A counter that fails to read later
+   is INVALID for this interval, so no rate spans the failed read.
+   """
+   cur = iface.cur
+   first = iface.ext_files is None
+   if first:
+      iface.ext_files = [(NUM_FIELDS + i, extended_fname(iface.name, field))
+                         for i, field in enumerate(extended_fields)]
+   missing = []
+   for slot, fname in iface.ext_files:
+      text = procreader.read_text(fname, 64)
+      try:
+         cur[slot] = int(text)
+      except (TypeError, ValueError):
+         cur[slot] = INVALID
+         missing.append((slot, fname))
+   if first and missing:
+      collectd.info('netdev: %s does not provide %s'
+                    % (iface.name, [os.path.basename(f) for s, f in missing]))
+      iface.ext_files = [e for e in iface.ext_files if e not in missing]
+
+def drop_interface(name):
+   interfaces.pop(name, None)
+
+def update_interfaces(devs):
+   """
+   Store the counters of devs, adding interfaces that appeared and
+   dropping the ones that disappeared since the previous interval.
+
+   Returns: interfaces with a previous snapshot to derive rates from
+   """
+   num_counters = NUM_FIELDS
+   if extended_stats:
+      num_counters += len(extended_fields)
+   names = set()
+   ready = []
+   for name, counters in devs:
+      names.add(name)
+      iface = interfaces.get(name)
+      if iface is None:
+         collectd.info('netdev: new interface %s' % (name))
+         iface = Interface(name, num_counters)
+         interfaces[name] = iface
+      else:
+         iface.swap()
+         ready.append(iface)
+      iface.cur[:len(counters)] = array(STATS_TYPECODE, counters)
+      if extended_stats:
+         read_extended(iface)
+   for name in list(interfaces.keys()):
+      if name not in names:
+         collectd.info('netdev: interface %s removed' % (name))
+         drop_interface(name)
+   return ready
+
+def calc_rates(iface, slots, time_delta):
+   """
+   Returns: rates of the counters in slots; None for counters that went
+            backwards, e.g. after the interface was re-created, or that
+            are INVALID at either interval
+   """
+   cur = iface.cur
+   pre = iface.pre
+   return [(cur[s] - pre[s]) / time_delta if cur[s] >= pre[s] >= 0
+           else None for s in slots]
+
+def collect_netdev():
+   global last_ts
+   text = procreader.get_reader(NETDEV_FNAME).text()
+   if text is None:
+      collectd.error('netdev: procfs path: %s does not exist'
+                     % (NETDEV_FNAME))
+      return
+   ts = time.time()
+   ready = update_interfaces(parse_netdev(text))
+   time_delta = ts - last_ts if last_ts is not None else 0
+   last_ts = ts
+   if time_delta <= 0:
+      return
+   ext_slots = range(NUM_FIELDS, NUM_FIELDS + len(extended_fields))
+   for iface in ready:
+      metric_dispatcher.add(iface.name, METRIC_PLUGIN, netdev_metrics,
+                            calc_rates(iface, rate_slots, time_delta))
+      if extended_stats:
+         metric_dispatcher.dispatch_values(iface.name, extended_metrics,
+                                           calc_rates(iface, ext_slots,
+                                                      time_delta))
+   metric_dispatcher.flush()
+
+def configer(ObjConfiguration):
+   global interface_filter_regexes, extended_stats
+   collectd.info('netdev plugin: configuring host: %s' % (host_name))
+   for child in ObjConfiguration.children:
+      config[child.key] = child.values
+
+   if INTERFACE_FILTER in config:
+      interface_filter_regexes = list(config[INTERFACE_FILTER])
+      if len(interface_filter_regexes) == 1 and \
+         interface_filter_regexes[0] == '':
+         interface_filter_regexes = None
+   collectd.info('netdev plugin: interface filter: %s'
+                 % (interface_filter_regexes))
+   if EXTENDED_STATS in config:
+      extended_stats = dispatcher.is_true(config[EXTENDED_STATS][0])
+   collectd.info('netdev plugin: extended stats: %s' % (extended_stats))
+
+def initer():
+   get_host_type()
+   update_interface_filter()
+   collectd.info('netdev plugin: host of type: %s' % (host_type))
+   if BATCH_DISPATCH in config:
+      metric_dispatcher.set_batch(dispatcher.is_true(config[BATCH_DISPATCH][0]))
+   collect_netdev()
+   collectd.info('netdev init: interfaces: %s' % (sorted(interfaces.keys())))
+
+def reader(input_data=None):
+   collect_netdev()
+
+def writer(metric, data=None):
+   for i in metric.values:
+      collectd.debug('%s (%s): %f' % (metric.plugin, metric.type, i))
+
+def shutdown():
+   collectd.info('netdev plugin shutting down')
+   procreader.close_reader(NETDEV_FNAME)
+   for name in list(interfaces.keys()):
+      drop_interface(name)
+
+#== Callbacks ==#
+if (os_name == 'Linux'):
+   collectd.register_config(configer)
+   collectd.register_init(initer)
+   collectd.register_read(reader)
+   collectd.register_write(writer)
+   collectd.register_shutdown(shutdown)
+else:
+   collectd.warning('netdev plugin currently works for Linux only')
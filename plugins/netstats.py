@@ -41,6 +41,17 @@ which is part of net-tools. While this plugin reads all
 available counters, it publishes only a sub-set of them,
 which are listed in white_list.
 
+Both files are parsed as "Proto: names" / "Proto: values"
+line pairs, so sections that a kernel adds, drops or
+reorders (e.g. IcmpMsg, MPTcpExt) do not break collection.
+Each section is dispatched with its lowercase protocol
+name as plugin_instance (IcmpMsg under icmp).
+
+With NetNamespaces enabled, counters of every other
+network namespace (e.g. containers) are read from
+/proc/<pid>/net of one process per namespace and
+dispatched as plugin_instance netns<inode>_<protocol>.
+
 Protocol counter names in /proc/net/snmp and their
 meanings:
 
@@ -162,16 +173,28 @@ Ipext:
 - OutMcastOctets : multicast octets sent
 - InBcastOctets  : broadcast octets received
 
+With TcpStates true, a summary of current TCP sockets (IPv4 and IPv6)
+is dispatched with plugin_instance 'tcpstates', see sockdiag.py:
+sockets per state (established, time_wait, close_wait, listen, ...),
+sockets with a pending retransmit timer, and receive/send queue and
+listen backlog bytes. TcpStateFilter limits the states counted, which
+are filtered by the kernel when sock_diag netlink is available; without
+it /proc/net/tcp{,6} is read instead.
+
 """
 
 import collectd
 import platform
 import os
 import socket
-import re
 import sys
+import time
 import traceback
 
+import dispatcher
+import procreader
+import sockdiag
+
 os_name = platform.system()
 host_name = socket.gethostbyaddr(socket.gethostname())[0]
 host_types = ['app', 'db', 'ffx', 'indexer', 'search', 'other']
@@ -183,6 +206,18 @@ NETSTAT_FNAME = '/proc/net/netstat'
 METRIC_PLUGIN = 'netstats'
 METRIC_TYPE = 'gauge'
 
+PROC_DIR = '/proc'
+
+# config keys
+NETNS = 'NetNamespaces'
+NETNS_SCAN_INTERVAL = 'NetNamespaceScanInterval'
+TCP_STATES = 'TcpStates'
+TCP_STATE_FILTER = 'TcpStateFilter'
+
+TCP_STATES_INSTANCE = 'tcpstates'
+
+config = {}
+
 white_list = [
               # Ip
               'InReceives',
@@ -252,226 +287,333 @@ white_list = [
               'InBcastOctets'
               ]
 
-ip_list, ip_vals = [], []
-icmp_list, icmp_vals = [], []
-icmpmsg_list, icmpmsg_vals = [], []
-tcp_list, tcp_vals = [], []
-udp_list, udp_vals = [], []
-udplite_list, udplite_vals = [], []
-tcpext_list, tcpext_vals = [], []
-ipext_list, ipext_vals = [], []
-
-re_snmp=re.compile (r'^Ip:\s+(?P<ip_labels>.*)\n'
-                    r'^Ip:\s+(?P<ip_vals>.*)\n'
-                    r'^Icmp:\s+(?P<icmp_labels>.*)\n'
-                    r'^Icmp:\s+(?P<icmp_vals>.*)\n'
-                    r'^IcmpMsg:\s+(?P<icmpmsg_labels>.*)\n'
-                    r'^IcmpMsg:\s+(?P<icmpmsg_vals>.*)\n'
-                    r'^Tcp:\s+(?P<tcp_labels>.*)\n'
-                    r'^Tcp:\s+(?P<tcp_vals>.*)\n'
-                    r'^Udp:\s+(?P<udp_labels>.*)\n'
-                    r'^Udp:\s+(?P<udp_vals>.*)\n'
-                    r'^UdpLite:\s+(?P<udplite_labels>.*)\n'
-                    r'^UdpLite:\s+(?P<udplite_vals>.*)\n'
-                    , re.MULTILINE)
-
-re_netstat=re.compile (r'^TcpExt:\s+(?P<tcpext_labels>.*)\n'
-                       r'^TcpExt:\s+(?P<tcpext_vals>.*)\n'
-                       r'^IpExt:\s+(?P<ipext_labels>.*)\n'
-                       r'^IpExt:\s+(?P<ipext_vals>.*)\n'
-                       , re.MULTILINE)
+white_set = set(white_list)
+
+# protocol counters vary by kernel, so they are always dispatched one
+# value at a time; white_list is applied through dispatch_plans
+metric_dispatcher = dispatcher.Dispatcher(METRIC_PLUGIN, host_name, METRIC_TYPE)
+
+# sections reported under the plugin_instance of another protocol
+section_instances = {'icmpmsg': 'icmp'}
+
+# section -> (header line, value columns, metric names) of the white listed
+# counters, rebuilt only when the header line of the section changes
+dispatch_plans = {}
+
+# section -> counter names / values, sections in file order
+counter_lists = {}
+counter_vals = {}
+sections = []
+
+# Network namespaces other than the host's are collected through
+# /proc/<pid>/net/{snmp,netstat} of one representative pid each. The
+# pid -> netns map is kept between intervals: a scan only resolves pids
+# it has not seen before, and runs every netns_scan_interval seconds.
+# Representatives are re-checked at every interval, so a namespace that
+# goes away between scans is dropped (and its descriptors closed) at once.
+netns_enabled = False
+netns_scan_interval = 60
+netns_last_scan = 0
+host_netns = None
+netns_pid_map = {}    # pid -> netns inode
+netns_pids = {}       # netns inode -> representative pid
+netns_vals = {}       # netns inode -> {section: values}
+netns_sections = {}   # netns inode -> sections found
+
+# TCP socket summary; falls back to /proc/net/tcp{,6} for good once a
+# sock_diag netlink dump fails
+tcp_states_enabled = False
+tcp_states_mask = sockdiag.ALL_STATES
+tcp_netlink = True
 
 def get_host_type():
    for i in host_types:
       if i in host_name:
          host_type = i
 
-def get_matches(fname, rex):
-   match = None
-   if os.path.exists(fname):
-      with open(fname) as f:
-         match = re.finditer(rex, f.read())
-      f.close()
-   else:
-      collectd.error('get_matches: path %s does not exist' % (fname))
-
-   return match
+def parse_sections(text):
+   """
+   Parse the "Proto: names" / "Proto: values" line pairs of
+   /proc/net/snmp or /proc/net/netstat in a single pass.
+
+   Any number of sections is handled, in any order, so sections added by
+   newer kernels (e.g. MPTcpExt) are picked up as well.
+
+   Args:
+        text: file contents
+
+   Returns: list of (section, header, values), where section is the
+            lowercase protocol name, header the raw names line and values
+            a list of ints
+   """
+   parsed = []
+   proto, header = None, None
+   for line in text.splitlines():
+      name, sep, rest = line.partition(':')
+      if not sep:
+         continue
+      if name != proto:
+         proto, header = name, rest
+         continue
+      try:
+         vals = list(map(int, rest.split()))
+      except ValueError:
+         # two header lines in a row; keep the latest one
+         header = rest
+         continue
+      parsed.append((proto.lower(), header, vals))
+      proto, header = None, None
+   return parsed
+
+def build_dispatch_plan(section, header):
+   """
+   Precompute the columns of a section's counters that are in white_list,
+   so that dispatching is an index gather without membership tests.
+   """
+   labels = header.split()
+   cols = [i for i, label in enumerate(labels) if label in white_set]
+   dispatch_plans[section] = (header, cols, [labels[i] for i in cols])
+   counter_lists[section] = labels
+   return labels
+
+def collect_file(fname, vals_dict=counter_vals):
+   """
+   Read and parse one counters file, refreshing the dispatch plan of any
+   section whose header line changed. All namespaces run on the same
+   kernel, so they share the dispatch plans.
+
+   Args:
+        fname: counters file
+        vals_dict: section -> values dict to update
+
+   Returns: list of sections found, in file order
+   """
+   text = procreader.get_reader(fname).text()
+   if text is None:
+      collectd.error('collect_netstats: path %s does not exist' % (fname))
+      return []
+
+   found = []
+   for section, header, vals in parse_sections(text):
+      plan = dispatch_plans.get(section)
+      if plan is None or plan[0] != header:
+         labels = build_dispatch_plan(section, header)
+         if plan is not None:
+            collectd.info('netstats: %s counters changed: %s' %
+                          (section, labels))
+      vals_dict[section] = vals
+      found.append(section)
+   if not found:
+      collectd.error('collect_netstats: no counters found in %s' % (fname))
+   return found
 
-def init_snmp_counters_list():
-   global ip_list, icmp_list, icmpmsg_list, tcp_list, udp_list, udplite_list
+def collect_netstats():
+   global sections
    try:
-      match = get_matches(SNMP_FNAME, re_snmp)
-      if not match:
-         print('init_snmp_white_list: snmp metrics not found')
-         return
-      for m in match:
-         if 'ip_labels' in m.groupdict():
-            ip_list = m.group('ip_labels').strip().split()
-         else:
-            collectd.error('ip_labels not found in netstats')
-            return
-         if 'icmp_labels' in m.groupdict():
-            icmp_list = m.group('icmp_labels').strip().split()
-         else:
-             collectd.error('icmp_labels not found in netstats')
-             return
-         if 'icmpmsg_labels' in m.groupdict():
-            icmpmsg_list = m.group('icmpmsg_labels').strip().split()
-         else:
-             collectd.error('icmpmsg_labels not found in netstats')
-             return
-         if 'tcp_labels' in m.groupdict():
-            tcp_list = m.group('tcp_labels').strip().split()
-         else:
-             collectd.error('tcp_labels not found in netstats')
-             return
-         if 'udp_labels' in m.groupdict():
-            udp_list = m.group('udp_labels').strip().split()
-         else:
-             collectd.error('udp_labels not found in netstats')
-             return
-         if 'udplite_labels' in m.groupdict():
-            udplite_list = m.group('udplite_labels').strip().split()
-         else:
-             collectd.error('udplite_labels not found in netstats')
-             return
+      sections = collect_file(SNMP_FNAME) + collect_file(NETSTAT_FNAME)
    except Exception as e:
       exc_type, exc_value, exc_traceback = sys.exc_info()
-      collectd.error('Exception during netstats init: %s\n%s' %
+      collectd.error('Exception during netstats collection: %s\n%s' %
                      (str(e), traceback.format_tb(exc_traceback)))
 
-def init_netstat_counters_list():
+def get_netns(pid):
+   """
+   Returns: inode of the network namespace of pid, or None if pid is gone
+   """
+   try:
+      link = os.readlink('%s/%s/ns/net' % (PROC_DIR, pid))
+   except (IOError, OSError):
+      return None
+   # link is of the form net:[4026531992]
    try:
-      global tcpext_list, ipext_list
-      match = get_matches(NETSTAT_FNAME, re_netstat)
-      if not match:
-         print('init_netstat_white_list: netstat metrics not found')
-         return
-      for m in match:
-         if 'tcpext_labels' in m.groupdict():
-            tcpext_list = m.group('tcpext_labels').strip().split()
-         else:
-             collectd.error('tcpext_labels not found in netstats')
-             return
-         if 'ipext_labels' in m.groupdict():
-            ipext_list = m.group('ipext_labels').strip().split()
-         else:
-             collectd.error('ipext_labels not found in netstats')
-             return
+      return int(link[link.index('[') + 1:link.index(']')])
+   except ValueError:
+      return None
+
+def netns_fnames(pid):
+   return ['%s/%d/net/snmp' % (PROC_DIR, pid),
+           '%s/%d/net/netstat' % (PROC_DIR, pid)]
+
+def drop_netns(ns):
+   pid = netns_pids.pop(ns, None)
+   if pid is not None:
+      for fname in netns_fnames(pid):
+         procreader.close_reader(fname)
+   netns_vals.pop(ns, None)
+   netns_sections.pop(ns, None)
+
+def set_netns_pid(ns, pid):
+   old_pid = netns_pids.get(ns)
+   if old_pid == pid:
+      return
+   if old_pid is not None:
+      for fname in netns_fnames(old_pid):
+         procreader.close_reader(fname)
+   netns_pids[ns] = pid
+
+def scan_netns():
+   """
+   Update the pid -> netns map with the pids started since the last scan,
+   forget exited pids and pick a representative pid per namespace.
+   """
+   pids = set(int(d) for d in os.listdir(PROC_DIR) if d.isdigit())
+   for pid in list(netns_pid_map.keys()):
+      if pid not in pids:
+         del netns_pid_map[pid]
+   for pid in pids:
+      if pid not in netns_pid_map:
+         ns = get_netns(pid)
+         if ns is not None:
+            netns_pid_map[pid] = ns
+
+   found = {}
+   for pid, ns in netns_pid_map.items():
+      if ns != host_netns and (ns not in found or pid < found[ns]):
+         found[ns] = pid
+   # keep the current representative while it is still in its namespace
+   for ns, pid in netns_pids.items():
+      if netns_pid_map.get(pid) == ns:
+         found[ns] = pid
+   for ns in list(netns_pids.keys()):
+      if ns not in found:
+         drop_netns(ns)
+   for ns, pid in found.items():
+      set_netns_pid(ns, pid)
+
+def check_netns():
+   """
+   Make sure every representative pid is still in its namespace, picking
+   another known pid of the namespace, or dropping it, when not.
+   """
+   for ns, pid in list(netns_pids.items()):
+      if get_netns(pid) == ns:
+         continue
+      netns_pid_map.pop(pid, None)
+      for other, other_ns in sorted(netns_pid_map.items()):
+         if other_ns == ns and get_netns(other) == ns:
+            set_netns_pid(ns, other)
+            break
+      else:
+         drop_netns(ns)
+
+def collect_netns():
+   global netns_last_scan
+   try:
+      now = time.time()
+      if now - netns_last_scan >= netns_scan_interval:
+         scan_netns()
+         netns_last_scan = now
+      else:
+         check_netns()
+
+      for ns, pid in netns_pids.items():
+         vals_dict = netns_vals.setdefault(ns, {})
+         found = []
+         for fname in netns_fnames(pid):
+            found += collect_file(fname, vals_dict)
+         netns_sections[ns] = found
    except Exception as e:
       exc_type, exc_value, exc_traceback = sys.exc_info()
-      collectd.error('Exception during netstats init: %s\n%s' %
+      collectd.error('Exception during netns collection: %s\n%s' %
                      (str(e), traceback.format_tb(exc_traceback)))
 
 def init_counters_list():
-   init_snmp_counters_list()
-   init_netstat_counters_list()
+   collect_netstats()
 
    # print list of found metrics at startup for debugging help
-   collectd.info('netstat: ip_list: %s' % (ip_list))
-   collectd.info('netstat: icmp_list: %s' % (icmp_list))
-   collectd.info('netstat: icmpmsg_list: %s' % (icmpmsg_list))
-   collectd.info('netstat: tcp_list: %s' % (tcp_list))
-   collectd.info('netstat: udp_list: %s' % (udp_list))
-   collectd.info('netstat: udplite_list: %s' % (udplite_list))
-   collectd.info('netstat: tcpext_list: %s' % (tcpext_list))
-   collectd.info('netstat: ipext_list: %s' % (ipext_list))
+   for section in sections:
+      collectd.info('netstat: %s_list: %s' % (section, counter_lists[section]))
    collectd.info('netstat: white_list: %s' % (white_list))
 
-def collect_netstats():
-   global ip_vals, icmp_vals, icmpmsg_vals, tcp_vals, udp_vals, udplite_vals
-   global tcpext_vals, ipext_vals
+def dispatch_metrics(proto, section, vals):
+   plan = dispatch_plans.get(section)
+   if plan is None:
+      return
+   header, cols, names = plan
+   if cols and cols[-1] >= len(vals):
+      collectd.error('netstats: %s values do not match its header' % (section))
+      return
+   metric_dispatcher.dispatch_values(proto, names, [vals[i] for i in cols])
+
+def collect_tcp_states():
+   """
+   Returns: TCP socket summary in sockdiag.summary_fields order, or None
+   """
+   global tcp_netlink
+   if tcp_netlink:
+      try:
+         return sockdiag.netlink_summary(tcp_states_mask)
+      except (socket.error, OSError) as e:
+         tcp_netlink = False
+         collectd.info('netstats: sock_diag netlink not available (%s), '
+                       'reading /proc/net/tcp instead' % (str(e)))
    try:
-      match_snmp = get_matches(SNMP_FNAME, re_snmp)
-      if not match_snmp:
-         collectd.error('collect_netstat: snmp metrics not found')
-         return
-      for m in match_snmp:
-         if 'ip_vals' in m.groupdict():
-            ip_vals = m.group('ip_vals').strip().split()
-         else:
-            collectd.error('ip_vals not found in netstats')
-            return
-         if 'icmp_vals' in m.groupdict():
-            icmp_vals = m.group('icmp_vals').strip().split()
-         else:
-            collectd.error('icmp_vals not found in netstats')
-            return
-         if 'icmpmsg_vals' in m.groupdict():
-            icmpmsg_vals = m.group('icmpmsg_vals').strip().split()
-         else:
-            collectd.error('icmpmsg_vals not found in netstats')
-            return
-         if 'tcp_vals' in m.groupdict():
-            tcp_vals = m.group('tcp_vals').strip().split()
-         else:
-            collectd.error('tcp_vals not found in netstats')
-            return
-         if 'udp_vals' in m.groupdict():
-            udp_vals = m.group('udp_vals').strip().split()
-         else:
-            collectd.error('udp_vals not found in netstats')
-            return
-         if 'udplite_vals' in m.groupdict():
-            udplite_vals = m.group('udplite_vals').strip().split()
-         else:
-            collectd.error('udplite_vals not found in netstats')
-            return
-
-      match_netstat = get_matches(NETSTAT_FNAME, re_netstat)
-      if not match_netstat:
-         collectd.error('collect_netstat: netstat metrics not found')
-         return
-      for m in match_netstat:
-         if 'tcpext_vals' in m.groupdict():
-            tcpext_vals = m.group('tcpext_vals').strip().split()
-         else:
-            collectd.error('tcpext_vals not found in netstats')
-            return
-         if 'ipext_vals' in m.groupdict():
-            ipext_vals = m.group('ipext_vals').strip().split()
-         else:
-            collectd.error('ipext_vals not found in netstats')
-            return
+      return sockdiag.proc_summary(tcp_states_mask)
    except Exception as e:
       exc_type, exc_value, exc_traceback = sys.exc_info()
-      collectd.error('Exception during netstats collection: %s\n%s' %
+      collectd.error('Exception during tcp states collection: %s\n%s' %
                      (str(e), traceback.format_tb(exc_traceback)))
-
-def dispatch_metrics(proto, labels, vals):
-   metric = collectd.Values()
-   metric.host = host_name
-   metric.plugin = METRIC_PLUGIN
-   metric.plugin_instance = proto
-   metric.type = METRIC_TYPE
-   for k in range(0, len(labels)):
-      if labels[k] in white_list:
-         metric.type_instance = labels[k]
-         metric.values = [vals[k]]
-         metric.dispatch()
+   return None
 
 #=== Callback functions registered with collectd ===#
 def configer(ObjConfiguration):
+   global netns_enabled, netns_scan_interval
+   global tcp_states_enabled, tcp_states_mask
    collectd.info('netstats plugin: configuring host: %s' % (host_name))
 
+   for child in ObjConfiguration.children:
+      config[child.key] = child.values
+
+   if NETNS in config:
+      netns_enabled = dispatcher.is_true(config[NETNS][0])
+   if NETNS_SCAN_INTERVAL in config:
+      netns_scan_interval = int(config[NETNS_SCAN_INTERVAL][0])
+   collectd.info('netstats plugin: network namespaces: %s, scan interval: %d'
+                 % (netns_enabled, netns_scan_interval))
+
+   if TCP_STATES in config:
+      tcp_states_enabled = dispatcher.is_true(config[TCP_STATES][0])
+   if TCP_STATE_FILTER in config:
+      try:
+         tcp_states_mask = sockdiag.states_mask(config[TCP_STATE_FILTER])
+      except ValueError:
+         collectd.error('netstats plugin: unknown TCP state in %s: %s; '
+                        'counting all states' %
+                        (TCP_STATE_FILTER, config[TCP_STATE_FILTER]))
+   collectd.info('netstats plugin: tcp states: %s, state mask: 0x%x'
+                 % (tcp_states_enabled, tcp_states_mask))
+
 def initer():
+   global host_netns
    get_host_type()
    collectd.info('netstats plugin: host of type: %s' % (host_type))
    init_counters_list()
    collectd.info('netstats init: white list: %s ' % (white_list))
+   if netns_enabled:
+      host_netns = get_netns('self')
 
 def reader(input_data=None):
    collect_netstats()
 
    # dispatch metrics for each protocol seperately
-   dispatch_metrics("ip", ip_list, ip_vals)
-   dispatch_metrics("icmp", icmp_list, icmp_vals)
-   dispatch_metrics("icmp", icmpmsg_list, icmpmsg_vals)
-   dispatch_metrics("tcp", tcp_list, tcp_vals)
-   dispatch_metrics("udp", udp_list, udp_vals)
-   dispatch_metrics("udplite", udplite_list, udplite_vals)
-   dispatch_metrics("tcpext", tcpext_list, tcpext_vals)
-   dispatch_metrics("ipext", ipext_list, ipext_vals)
+   for section in sections:
+      dispatch_metrics(section_instances.get(section, section), section,
+                       counter_vals[section])
+
+   if netns_enabled:
+      collect_netns()
+      for ns, ns_sections in netns_sections.items():
+         vals_dict = netns_vals[ns]
+         for section in ns_sections:
+            dispatch_metrics('netns%d_%s' %
+                             (ns, section_instances.get(section, section)),
+                             section, vals_dict[section])
+
+   if tcp_states_enabled:
+      vals = collect_tcp_states()
+      if vals is not None:
+         metric_dispatcher.dispatch_values(TCP_STATES_INSTANCE,
+                                           sockdiag.summary_fields, vals)
 
 def writer(metric, data=None):
    for i in metric.values:
@@ -479,6 +621,10 @@ def writer(metric, data=None):
 
 def shutdown():
    collectd.info("netstats plugin shutting down")
+   procreader.close_reader(SNMP_FNAME)
+   procreader.close_reader(NETSTAT_FNAME)
+   for ns in list(netns_pids.keys()):
+      drop_netns(ns)
 
 #== Callbacks ==#
 if (os_name == 'Linux'):
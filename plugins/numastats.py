@@ -0,0 +1,292 @@
+#!/usr/bin/python
+
+##########################################################################
+# Copyright (c) 2015, Salesforce.com, Inc.
+# All rights reserved.
+#
+# Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#
+# Neither the name of Salesforce.com nor the names of its
+# contributors may be used to endorse or promote products
+# derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+##########################################################################
+
+"""
+**numastats.py**
+
+Per NUMA node memory statistics from sysfs, complementing the per zone
+view of zoneinfo and buddyinfo and the global numa_* counters of
+vmstats. For each node under /sys/devices/system/node, the plugin reads:
+
+- node<N>/numastat: allocation counters as reported by 'numastat'
+
+  - numa_hit: pages allocated on this node as intended
+  - numa_miss: pages allocated on this node though intended for another
+  - numa_foreign: pages intended for this node but allocated on another
+  - interleave_hit: interleaved pages allocated on this node as intended
+  - local_node: pages allocated on this node by a task running on it
+  - other_node: pages allocated on this node by a task on another node
+
+- node<N>/meminfo: per node equivalent of /proc/meminfo (values in kB,
+  HugePages_* in pages), as reported by 'numastat -m'
+- node<N>/vmstat: per node vmstat counters (4.x+ kernels), of which the
+  reclaim, workingset and page promotion/demotion counters in
+  vmstat_white_list are reported as rates
+
+From the previous interval's snapshot, the plugin derives per node:
+
+- <numastat counter>_per_sec
+- pct_numa_miss: numa_miss / (numa_hit + numa_miss) over the interval
+- pct_local_node: local_node / (local_node + other_node) over the interval
+- <vmstat counter>_per_sec
+
+Nodes are discovered once at init. The files of every node are kept
+open and re-read with a single read each interval, so the cost of a
+collection is a fixed 3 reads per node.
+
+"""
+
+import collectd
+import platform
+import os
+import re
+import socket
+import time
+
+import dispatcher
+import procreader
+
+os_name = platform.system()
+host_name = socket.gethostbyaddr(socket.gethostname())[0]
+host_types = ['app', 'db', 'ffx', 'indexer', 'search', 'other']
+host_type = 'other'
+
+NODE_DIR = '/sys/devices/system/node'
+
+METRIC_PLUGIN = 'numastats'
+METRIC_TYPE = 'gauge'
+BATCH_DISPATCH = 'BatchDispatch'
+
+numastat_fields = ['numa_hit',
+                   'numa_miss',
+                   'numa_foreign',
+                   'interleave_hit',
+                   'local_node',
+                   'other_node']
+numastat_metrics = [f + '_per_sec' for f in numastat_fields] + \
+                   ['pct_numa_miss', 'pct_local_node']
+vmstat_white_list = ['pgpromote_success',
+                     'pgdemote_kswapd',
+                     'pgdemote_direct',
+                     'pgdemote_khugepaged',
+                     'workingset_refault_anon',
+                     'workingset_refault_file',
+                     'workingset_activate_anon',
+                     'workingset_activate_file',
+                     'nr_vmscan_write',
+                     'nr_dirtied',
+                     'nr_written']
+vmstat_metrics = [k + '_per_sec' for k in vmstat_white_list]
+
+node_list = []
+has_node_vmstat = True
+
+# node -> (ts, numastat values, vmstat values) of the previous interval
+stats_cache = {}
+
+config = {}
+
+# numastat rates of a node are a single 'numastats' record with
+# BatchDispatch
+metric_dispatcher = dispatcher.Dispatcher(METRIC_PLUGIN, host_name, METRIC_TYPE)
+metric_dispatcher.register_type(METRIC_PLUGIN, numastat_metrics)
+
+re_node = re.compile(r'^node(\d+)$')
+re_meminfo_name = re.compile(r'[()]')
+
+def get_host_type():
+   for i in host_types:
+      if i in host_name:
+         host_type = i
+
+def get_node_list():
+   """
+   Returns: node directory names (node0, node1, ...) in node order
+   """
+   try:
+      names = os.listdir(NODE_DIR)
+   except (IOError, OSError):
+      return []
+   nodes = [(int(m.group(1)), m.group(0)) for m in
+            (re_node.match(n) for n in names) if m]
+   return [name for num, name in sorted(nodes)]
+
+def node_fname(node, fname):
+   return os.path.join(NODE_DIR, node, fname)
+
+def parse_counters(text, keys):
+   """
+   Parse a 'key value' per line file.
+
+   Args:
+        text: contents of numastat or vmstat
+        keys: keys to return
+
+   Returns: values of keys, None for keys not in text
+   """
+   fields = text.split()
+   counters = dict(zip(fields[::2], fields[1::2]))
+   return [int(counters[k]) if k in counters else None for k in keys]
+
+def meminfo_name(field):
+   """
+   Returns: metric name of a meminfo field, e.g. 'Active(anon):' ->
+            'meminfo_active_anon'
+   """
+   return 'meminfo_' + re_meminfo_name.sub('_', field.rstrip(':')) \
+      .strip('_').lower()
+
+def parse_meminfo(text):
+   """
+   Parse 'Node <N> <field>: <value> [kB]' lines.
+
+   Returns: (names, values)
+   """
+   names = []
+   vals = []
+   for line in text.splitlines():
+      fields = line.split()
+      if len(fields) < 4:
+         continue
+      names.append(meminfo_name(fields[2]))
+      vals.append(int(fields[3]))
+   return names, vals
+
+def calc_rates(cur, pre, time_delta):
+   return [(c - p) / time_delta
+           if c is not None and p is not None and c >= p else None
+           for c, p in zip(cur, pre)]
+
+def calc_pct(part, other):
+   if part is None or other is None:
+      return None
+   total = part + other
+   return 100.0 * part / total if total > 0 else None
+
+def calc_node_metrics(cur, pre, time_delta):
+   """
+   Derive the rates of a node.
+
+   Args:
+        cur: (numastat values, vmstat values)
+        pre: (numastat values, vmstat values) of the previous interval, or
+             None
+        time_delta: seconds between pre and cur
+
+   Returns: (numastat_metrics values, vmstat rates)
+   """
+   if pre is None or time_delta <= 0:
+      return [None] * len(numastat_metrics), [None] * len(vmstat_white_list)
+   numa_rates = calc_rates(cur[0], pre[0], time_delta)
+   rates = dict(zip(numastat_fields, numa_rates))
+   numa_rates.append(calc_pct(rates['numa_miss'], rates['numa_hit']))
+   numa_rates.append(calc_pct(rates['local_node'], rates['other_node']))
+   return numa_rates, calc_rates(cur[1], pre[1], time_delta)
+
+def collect_node(node, ts):
+   numastat = procreader.get_reader(node_fname(node, 'numastat')).text()
+   meminfo = procreader.get_reader(node_fname(node, 'meminfo')).text()
+   vmstat = None
+   if has_node_vmstat:
+      vmstat = procreader.get_reader(node_fname(node, 'vmstat')).text()
+   if numastat is None or meminfo is None:
+      collectd.error('numastats: cannot read %s' % (node_fname(node, '')))
+      stats_cache.pop(node, None)
+      return
+
+   numa_vals = parse_counters(numastat, numastat_fields)
+   if vmstat is not None:
+      vm_vals = parse_counters(vmstat, vmstat_white_list)
+   else:
+      vm_vals = [None] * len(vmstat_white_list)
+   metric_dispatcher.dispatch_values(node, numastat_fields, numa_vals)
+   names, vals = parse_meminfo(meminfo)
+   metric_dispatcher.dispatch_values(node, names, vals)
+
+   pre = stats_cache.get(node)
+   time_delta = ts - pre[0] if pre is not None else 0
+   numa_rates, vm_rates = calc_node_metrics((numa_vals, vm_vals),
+                                            pre[1:] if pre else None,
+                                            time_delta)
+   metric_dispatcher.add(node, METRIC_PLUGIN, numastat_metrics, numa_rates)
+   metric_dispatcher.dispatch_values(node, vmstat_metrics, vm_rates)
+   stats_cache[node] = (ts, numa_vals, vm_vals)
+
+def collect_numastats():
+   ts = time.time()
+   for node in node_list:
+      collect_node(node, ts)
+   metric_dispatcher.flush()
+
+def configer(ObjConfiguration):
+   collectd.info('numastats plugin: configuring host: %s' % (host_name))
+   for child in ObjConfiguration.children:
+      config[child.key] = child.values
+
+def initer():
+   global node_list, has_node_vmstat
+   get_host_type()
+   collectd.info('numastats plugin: host of type: %s' % (host_type))
+   node_list = get_node_list()
+   if not node_list:
+      collectd.error('numastats plugin: no NUMA nodes found in %s'
+                     % (NODE_DIR))
+   else:
+      # vmstat is not available per node before 4.x kernels
+      has_node_vmstat = os.path.exists(node_fname(node_list[0], 'vmstat'))
+   collectd.info('numastats init: node_list: %s, per node vmstat: %s'
+                 % (node_list, has_node_vmstat))
+   if BATCH_DISPATCH in config:
+      metric_dispatcher.set_batch(dispatcher.is_true(config[BATCH_DISPATCH][0]))
+
+def reader(input_data=None):
+   collect_numastats()
+
+def writer(metric, data=None):
+   for i in metric.values:
+      collectd.debug('%s (%s): %f' % (metric.plugin, metric.type, i))
+
+def shutdown():
+   collectd.info('numastats plugin shutting down')
+   for node in node_list:
+      for fname in ('numastat', 'meminfo', 'vmstat'):
+         procreader.close_reader(node_fname(node, fname))
+
+#== Callbacks ==#
+if (os_name == 'Linux'):
+   collectd.register_config(configer)
+   collectd.register_init(initer)
+   collectd.register_read(reader)
+   collectd.register_write(writer)
+   collectd.register_shutdown(shutdown)
+else:
+   collectd.warning('numastats plugin currently works for Linux only')
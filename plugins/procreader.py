@@ -0,0 +1,238 @@
+#!/usr/bin/python
+
+##########################################################################
+# Copyright (c) 2015, Salesforce.com, Inc.
+# All rights reserved.
+#
+# Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#
+# Neither the name of Salesforce.com nor the names of its
+# contributors may be used to endorse or promote products
+# derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+##########################################################################
+
+"""
+**procreader.py**
+
+Shared procfs/sysfs reader used by the telemetry plugins.
+
+Each plugin reads one or more procfs files at every collection
+interval. Opening the file, stat'ing it and reading it line by line
+allocates a new file object, read buffer and line strings every time,
+which adds up on hosts with hundreds of block devices and a 1 second
+interval.
+
+A ProcReader keeps a file descriptor open for the lifetime of the
+plugin and re-reads the file from offset 0 into a preallocated
+bytearray. procfs regenerates file contents on every read from offset 0,
+so there is no need to reopen it. The buffer grows (and stays grown)
+whenever the file does not fit, so after the first interval a read is a
+single syscall with no buffer allocation.
+
+Readers are shared per path through get_reader(), so plugins loaded in
+the same collectd python interpreter do not hold duplicate descriptors:
+
+- data = get_reader('/proc/diskstats').read()   # memoryview of contents
+- for line in get_reader(fname).lines(): ...    # memoryview per line
+- text = get_reader(fname).text()                # decoded str, if needed
+
+Files that come in the thousands, such as the pressure files of every
+cgroup or the statistics files of every network interface, must not each
+hold a descriptor for the life of the process: read_text() opens, reads
+and closes them instead.
+
+diskstats and vmstats parse lines() directly: only the lines of the
+devices or counters they track are copied, and decode_lines() is only
+needed when the layout changes.
+
+read(), lines() and text() return None (or nothing) when the path cannot
+be opened or read; the descriptor is dropped and re-opened on the next
+call, so a device that goes away and comes back is picked up again.
+
+"""
+
+import os
+
+DEFAULT_BUFSIZE = 16384
+
+# read into the caller supplied buffer without allocating a bytes object
+if hasattr(os, 'preadv'):
+   def _read_into(fd, view, offset):
+      return os.preadv(fd, [view], offset)
+elif hasattr(os, 'readv'):
+   def _read_into(fd, view, offset):
+      os.lseek(fd, offset, os.SEEK_SET)
+      return os.readv(fd, [view])
+else:
+   def _read_into(fd, view, offset):
+      os.lseek(fd, offset, os.SEEK_SET)
+      data = os.read(fd, len(view))
+      view[:len(data)] = data
+      return len(data)
+
+class ProcReader(object):
+   """
+   Persistent reader for a single procfs or sysfs file.
+
+   Args:
+        fname: path of the file to read
+        bufsize: initial buffer size in bytes
+
+   The contents of the most recent read are available as self.buf[:self.size]
+   until the next read.
+   """
+   def __init__(self, fname, bufsize=DEFAULT_BUFSIZE):
+      self.fname = fname
+      self.fd = None
+      self.buf = bytearray(bufsize)
+      self.view = memoryview(self.buf)
+      self.size = 0
+
+   def open(self):
+      if self.fd is None:
+         try:
+            self.fd = os.open(self.fname, os.O_RDONLY)
+         except (IOError, OSError):
+            self.fd = None
+      return self.fd is not None
+
+   def close(self):
+      if self.fd is not None:
+         try:
+            os.close(self.fd)
+         except (IOError, OSError):
+            pass
+      self.fd = None
+      self.size = 0
+
+   def grow(self):
+      # allocate a new buffer rather than resizing in place: callers may
+      # still hold memoryview slices of the old one
+      self.buf = bytearray(2 * len(self.buf))
+      self.view = memoryview(self.buf)
+
+   def fill(self):
+      """
+      Re-read the whole file into self.buf.
+
+      Args: None
+
+      Returns: number of bytes read, or -1 if the file could not be read
+      """
+      if not self.open():
+         self.size = 0
+         return -1
+
+      while True:
+         size = 0
+         try:
+            while True:
+               n = _read_into(self.fd, self.view[size:], size)
+               if n <= 0:
+                  break
+               size += n
+               if size == len(self.buf):
+                  break
+         except (IOError, OSError):
+            self.close()
+            return -1
+
+         if size < len(self.buf):
+            break
+         # contents did not fit; grow and re-read from the start so the
+         # snapshot comes from a single pass over the file
+         self.grow()
+
+      self.size = size
+      return size
+
+   def read(self):
+      """
+      Returns: memoryview of the file contents, or None on failure
+      """
+      if self.fill() < 0:
+         return None
+      return self.view[:self.size]
+
+   def lines(self):
+      """
+      Generator of memoryview slices, one per line without the newline.
+      The slices are only valid until the next read.
+      """
+      if self.fill() < 0:
+         return
+      buf, view, end = self.buf, self.view, self.size
+      start = 0
+      while start < end:
+         nl = buf.find(b'\n', start, end)
+         if nl < 0:
+            nl = end
+         yield view[start:nl]
+         start = nl + 1
+
+   def text(self):
+      """
+      Returns: file contents decoded as a str, or None on failure
+      """
+      if self.fill() < 0:
+         return None
+      return self.buf[:self.size].decode('ascii', 'replace')
+
+readers = {}
+
+def get_reader(fname, bufsize=DEFAULT_BUFSIZE):
+   """
+   Return the shared ProcReader for fname, creating it on first use.
+   """
+   reader = readers.get(fname)
+   if reader is None:
+      reader = ProcReader(fname, bufsize)
+      readers[fname] = reader
+   return reader
+
+def decode_lines(lines):
+   """
+   Returns: memoryview lines of ProcReader.lines() decoded as str, for
+            the occasional full parse (e.g. when the layout changed)
+   """
+   return [line.tobytes().decode('ascii', 'replace') for line in lines]
+
+def read_text(fname, bufsize=DEFAULT_BUFSIZE):
+   """
+   Read fname once, without keeping a descriptor open.
+
+   Returns: file contents decoded as a str, or None on failure
+   """
+   reader = ProcReader(fname, bufsize)
+   try:
+      return reader.text()
+   finally:
+      reader.close()
+
+def close_reader(fname):
+   reader = readers.pop(fname, None)
+   if reader is not None:
+      reader.close()
+
+def close_all():
+   for fname in list(readers.keys()):
+      close_reader(fname)
@@ -0,0 +1,365 @@
+#!/usr/bin/python
+
+##########################################################################
+# Copyright (c) 2015, Salesforce.com, Inc.
+# All rights reserved.
+#
+# Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#
+# Neither the name of Salesforce.com nor the names of its
+# contributors may be used to endorse or promote products
+# derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+##########################################################################
+
+"""
+**psi.py**
+
+Pressure Stall Information (PSI, Linux 4.20+) reports the share of wall
+time in which tasks were stalled waiting for CPU, memory or IO, through
+/proc/pressure/{cpu,memory,io}:
+
+- some avg10=0.31 avg60=0.12 avg300=0.04 total=2714263
+- full avg10=0.00 avg60=0.00 avg300=0.00 total=1092755
+
+'some' is the time at least one task was stalled on the resource and
+'full' the time all non-idle tasks were stalled at once (cpu has no
+'full' line before 5.13). avg10/avg60/avg300 are kernel computed
+running averages in percent over 10s, 60s and 300s windows, and total
+is the accumulated stall time in microseconds.
+
+Besides the averages and totals, the plugin derives the exact stall
+percentage of each collection interval from the delta of total:
+
+- some_stall_pct, full_stall_pct: 100 * delta(total) / interval (in us)
+
+With cgroup v2, every cgroup has the same cpu.pressure, memory.pressure
+and io.pressure files, which the plugin reads when 'Cgroups' is
+enabled. The cgroup tree is walked every CgroupScanInterval seconds, and
+only directories whose mtime or link count (2 + number of
+subdirectories) changed since the previous walk are listed again, so a
+host with thousands of cgroups does not open every directory of the tree
+at each interval. Only the /proc/pressure files are kept open across
+intervals; the pressure files of cgroups are opened, read and closed at
+every interval, as holding three descriptors per cgroup would exhaust
+RLIMIT_NOFILE of the collectd process on such hosts. Values of a cgroup
+are dispatched with its path relative to the cgroup root, '/' replaced
+with '_', as plugin_instance. collectd rejects instances of 128
+characters or more, which the deep paths of systemd or Kubernetes pods
+reach; longer paths are truncated and suffixed with a hash of the full
+path, so that cgroups sharing a prefix keep distinct instances.
+
+"""
+
+import collectd
+import hashlib
+import platform
+import os
+import socket
+import time
+
+import dispatcher
+import procreader
+
+os_name = platform.system()
+host_name = socket.gethostbyaddr(socket.gethostname())[0]
+host_types = ['app', 'db', 'ffx', 'indexer', 'search', 'other']
+host_type = 'other'
+
+PSI_DIR = '/proc/pressure'
+CGROUP_ROOTS = ['/sys/fs/cgroup', '/sys/fs/cgroup/unified']
+
+METRIC_PLUGIN = 'psi'
+METRIC_TYPE = 'gauge'
+BATCH_DISPATCH = 'BatchDispatch'
+
+# config keys
+CGROUPS = 'Cgroups'
+CGROUP_ROOT = 'CgroupRoot'
+CGROUP_SCAN_INTERVAL = 'CgroupScanInterval'
+
+# pressure files are a few lines; thousands of cgroups need small buffers
+PSI_BUFSIZE = 256
+# longest plugin_instance below collectd's DATA_MAX_NAME_LEN of 128
+MAX_INSTANCE_LEN = 127
+INSTANCE_HASH_LEN = 8
+
+resources = ['cpu', 'memory', 'io']
+psi_kinds = ['some', 'full']
+psi_metrics = ['some_avg10',
+               'some_avg60',
+               'some_avg300',
+               'some_total',
+               'some_stall_pct',
+               'full_avg10',
+               'full_avg60',
+               'full_avg300',
+               'full_total',
+               'full_stall_pct']
+
+# slot of the first value of a line in psi_metrics, and of each field
+# relative to it
+kind_slots = {'some': 0, 'full': 5}
+field_slots = {'avg10': 0, 'avg60': 1, 'avg300': 2}
+TOTAL_SLOT = 3
+STALL_SLOT = 4
+
+cgroups_enabled = False
+cgroup_root = None
+cgroup_scan_interval = 60
+cgroup_last_scan = 0
+
+# cgroup directory relative to cgroup_root -> (st_mtime, st_nlink) at
+# the time it was last listed
+cgroup_dirs = {}
+
+# (plugin_instance, resource) -> (ts, some total, full total)
+stats_cache = {}
+
+config = {}
+
+# the values of a resource are a single 'psi' record with BatchDispatch
+metric_dispatcher = dispatcher.Dispatcher(METRIC_PLUGIN, host_name, METRIC_TYPE)
+metric_dispatcher.register_type(METRIC_PLUGIN, psi_metrics)
+
+def get_host_type():
+   for i in host_types:
+      if i in host_name:
+         host_type = i
+
+def parse_pressure(text):
+   """
+   Parse the contents of a pressure file.
+
+   Args:
+        text: contents of /proc/pressure/<resource> or <resource>.pressure
+
+   Returns: values in psi_metrics order, None for lines not present and
+            for the stall percentages
+   """
+   vals = [None] * len(psi_metrics)
+   for line in text.splitlines():
+      fields = line.split()
+      if not fields or fields[0] not in kind_slots:
+         continue
+      slot = kind_slots[fields[0]]
+      for field in fields[1:]:
+         name, _, val = field.partition('=')
+         if name == 'total':
+            vals[slot + TOTAL_SLOT] = int(val)
+         elif name in field_slots:
+            vals[slot + field_slots[name]] = float(val)
+   return vals
+
+def calc_stall_pct(vals, pre, ts):
+   """
+   Set the stall percentages of vals from the totals of the previous
+   interval.
+
+   Args:
+        vals: values in psi_metrics order
+        pre: (ts, some total, full total) of the previous interval, or None
+        ts: time of vals
+   """
+   if pre is None:
+      return
+   time_delta = ts - pre[0]
+   if time_delta <= 0:
+      return
+   for i, kind in enumerate(psi_kinds):
+      slot = kind_slots[kind]
+      cur_total = vals[slot + TOTAL_SLOT]
+      pre_total = pre[i + 1]
+      if cur_total is None or pre_total is None or cur_total < pre_total:
+         continue
+      # totals are in us: 100 * delta / (time_delta * 1e6)
+      vals[slot + STALL_SLOT] = (cur_total - pre_total) / (time_delta * 1e4)
+
+def collect_pressure(plugin_instance, resource, fname, ts, keep_open=True):
+   """
+   Read a pressure file and queue its values for dispatch.
+
+   Args:
+        keep_open: read fname through a persistent procreader reader,
+                   otherwise open and close it
+
+   Returns: False if the file could not be read
+   """
+   if keep_open:
+      text = procreader.get_reader(fname, PSI_BUFSIZE).text()
+   else:
+      text = procreader.read_text(fname, PSI_BUFSIZE)
+   if text is None:
+      return False
+   vals = parse_pressure(text)
+   key = (plugin_instance, resource)
+   calc_stall_pct(vals, stats_cache.get(key), ts)
+   stats_cache[key] = (ts, vals[kind_slots['some'] + TOTAL_SLOT],
+                       vals[kind_slots['full'] + TOTAL_SLOT])
+   metric_dispatcher.add(plugin_instance, METRIC_PLUGIN, psi_metrics, vals,
+                         resource, resource + '_')
+   return True
+
+def get_cgroup_root():
+   """
+   Returns: mount point of the cgroup v2 hierarchy, or None
+   """
+   for root in CGROUP_ROOTS:
+      if os.path.exists(os.path.join(root, 'cgroup.controllers')):
+         return root
+   return None
+
+def list_subdirs(path):
+   # scandir gets the file type from the directory entries, without a
+   # stat of each of the ~50 interface files of a cgroup
+   if hasattr(os, 'scandir'):
+      return [e.name for e in os.scandir(path)
+              if e.is_dir(follow_symlinks=False)]
+   return [d for d in os.listdir(path)
+           if os.path.isdir(os.path.join(path, d))]
+
+def cgroup_instance(rel):
+   """
+   Map a cgroup path, relative to the cgroup root, to a plugin_instance.
+
+   Args:
+        rel: cgroup path relative to cgroup_root
+   Returns:
+        the path with '/' replaced by '_', truncated and suffixed with a
+        hash of the path when longer than MAX_INSTANCE_LEN
+   """
+   instance = rel.replace(os.sep, '_')
+   if len(instance) <= MAX_INSTANCE_LEN:
+      return instance
+   digest = hashlib.md5(rel.encode('utf-8')).hexdigest()[:INSTANCE_HASH_LEN]
+   return instance[:MAX_INSTANCE_LEN - INSTANCE_HASH_LEN - 1] + '_' + digest
+
+def drop_cgroup(rel):
+   cgroup_dirs.pop(rel, None)
+   for resource in resources:
+      stats_cache.pop((cgroup_instance(rel), resource), None)
+
+def scan_cgroups():
+   """
+   Update cgroup_dirs: stat every known cgroup, list the subdirectories
+   of those that changed since they were last listed, and forget the
+   removed ones.
+   """
+   pending = list(cgroup_dirs.keys()) or ['']
+   while pending:
+      rel = pending.pop()
+      path = os.path.join(cgroup_root, rel)
+      try:
+         st = os.stat(path)
+         sig = (st.st_mtime, st.st_nlink)
+         if cgroup_dirs.get(rel) == sig:
+            continue
+         subdirs = list_subdirs(path)
+      except (IOError, OSError):
+         drop_cgroup(rel)
+         continue
+      cgroup_dirs[rel] = sig
+      for d in subdirs:
+         child = os.path.join(rel, d) if rel else d
+         if child not in cgroup_dirs:
+            cgroup_dirs[child] = None
+            pending.append(child)
+
+def collect_cgroups(ts):
+   global cgroup_last_scan
+   if ts - cgroup_last_scan >= cgroup_scan_interval:
+      scan_cgroups()
+      cgroup_last_scan = ts
+   for rel in list(cgroup_dirs.keys()):
+      # the root cgroup has no pressure files, it is /proc/pressure
+      if not rel:
+         continue
+      for resource in resources:
+         fname = os.path.join(cgroup_root, rel, resource + '.pressure')
+         if not collect_pressure(cgroup_instance(rel), resource, fname, ts,
+                                 False):
+            if not os.path.isdir(os.path.join(cgroup_root, rel)):
+               drop_cgroup(rel)
+               break
+
+def collect_psi():
+   ts = time.time()
+   for resource in resources:
+      collect_pressure('', resource, os.path.join(PSI_DIR, resource), ts)
+   if cgroups_enabled and cgroup_root is not None:
+      collect_cgroups(ts)
+   metric_dispatcher.flush()
+
+def configer(ObjConfiguration):
+   global cgroups_enabled, cgroup_root, cgroup_scan_interval
+   collectd.info('psi plugin: configuring host: %s' % (host_name))
+   for child in ObjConfiguration.children:
+      config[child.key] = child.values
+
+   if CGROUPS in config:
+      cgroups_enabled = dispatcher.is_true(config[CGROUPS][0])
+   if CGROUP_ROOT in config:
+      cgroup_root = config[CGROUP_ROOT][0]
+   if CGROUP_SCAN_INTERVAL in config:
+      cgroup_scan_interval = int(config[CGROUP_SCAN_INTERVAL][0])
+   collectd.info('psi plugin: cgroups: %s, scan interval: %d'
+                 % (cgroups_enabled, cgroup_scan_interval))
+
+def initer():
+   global cgroup_root
+   get_host_type()
+   collectd.info('psi plugin: host of type: %s' % (host_type))
+   if not os.path.isdir(PSI_DIR):
+      collectd.error('psi plugin: %s does not exist, kernel without PSI '
+                     'or booted with psi=0' % (PSI_DIR))
+   if cgroups_enabled:
+      if cgroup_root is None:
+         cgroup_root = get_cgroup_root()
+      if cgroup_root is None:
+         collectd.error('psi plugin: cgroup v2 hierarchy not found')
+      else:
+         collectd.info('psi plugin: cgroup root: %s' % (cgroup_root))
+   if BATCH_DISPATCH in config:
+      metric_dispatcher.set_batch(dispatcher.is_true(config[BATCH_DISPATCH][0]))
+
+def reader(input_data=None):
+   collect_psi()
+
+def writer(metric, data=None):
+   for i in metric.values:
+      collectd.debug('%s (%s): %f' % (metric.plugin, metric.type, i))
+
+def shutdown():
+   collectd.info('psi plugin shutting down')
+   for resource in resources:
+      procreader.close_reader(os.path.join(PSI_DIR, resource))
+   for rel in list(cgroup_dirs.keys()):
+      drop_cgroup(rel)
+
+#== Callbacks ==#
+if (os_name == 'Linux'):
+   collectd.register_config(configer)
+   collectd.register_init(initer)
+   collectd.register_read(reader)
+   collectd.register_write(writer)
+   collectd.register_shutdown(shutdown)
+else:
+   collectd.warning('psi plugin currently works for Linux only')
@@ -0,0 +1,300 @@
+#!/usr/bin/python
+
+##########################################################################
+# Copyright (c) 2015, Salesforce.com, Inc.
+# All rights reserved.
+#
+# Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#
+# Neither the name of Salesforce.com nor the names of its
+# contributors may be used to endorse or promote products
+# derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+##########################################################################
+
+"""
+**sockdiag.py**
+
+TCP socket state summary used by the netstats plugin: the number of
+sockets in each TCP state, sockets with a retransmit timer pending, and
+queued bytes, for IPv4 and IPv6 sockets together.
+
+Walking /proc/net/tcp and /proc/net/tcp6 costs a formatted text line
+per socket, millions of lines on busy front-ends, so the summary is
+obtained through the sock_diag netlink interface (NETLINK_SOCK_DIAG,
+INET_DIAG requests, Linux 3.3+) whenever it is available:
+
+- one SOCK_DIAG_BY_FAMILY dump request per address family, with the
+  states of interest as the idiag_states filter, so the kernel only
+  walks and reports sockets in those states
+- replies are inet_diag_msg records, received into a preallocated
+  buffer; only the state, timer and queue fields are decoded, with a
+  precompiled struct, and sockets are counted per distinct value
+
+Without netlink (e.g. blocked by a seccomp policy), proc_summary()
+streams /proc/net/tcp{,6} in 1MB chunks and extracts the few columns
+it needs with one regular expression per chunk, decoding each distinct
+combination of state, queue and timer columns once.
+
+Summary fields, in summary_fields order:
+
+- established ... closing: sockets per TCP state (request sockets of
+  half-open connections are counted as syn_recv)
+- retrans_sockets: sockets with the retransmit timer pending
+- retrans_segs: unrecovered retransmissions of those sockets
+- rx_queue_bytes, tx_queue_bytes: bytes in receive and send queues of
+  non-listening sockets
+- listen_backlog: connections waiting to be accepted on listening
+  sockets
+
+"""
+
+import os
+import re
+import socket
+import struct
+
+from collections import Counter
+
+# kernel TCP states, in order from TCP_ESTABLISHED (1)
+tcp_states = ['established',
+              'syn_sent',
+              'syn_recv',
+              'fin_wait1',
+              'fin_wait2',
+              'time_wait',
+              'close',
+              'close_wait',
+              'last_ack',
+              'listen',
+              'closing']
+SYN_RECV = 3
+LISTEN = 10
+NEW_SYN_RECV = 12
+ALL_STATES = 0x1ffe
+
+summary_fields = tcp_states + ['retrans_sockets',
+                               'retrans_segs',
+                               'rx_queue_bytes',
+                               'tx_queue_bytes',
+                               'listen_backlog']
+RETRANS_SOCKETS = len(tcp_states)
+RETRANS_SEGS = RETRANS_SOCKETS + 1
+RX_QUEUE = RETRANS_SOCKETS + 2
+TX_QUEUE = RETRANS_SOCKETS + 3
+LISTEN_BACKLOG = RETRANS_SOCKETS + 4
+
+# idiag_timer / 'tr' value of a pending retransmit timer
+TIMER_RETRANSMIT = 1
+
+# netlink constants
+NETLINK_SOCK_DIAG = 4
+SOCK_DIAG_BY_FAMILY = 20
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+RECV_BUFSIZE = 65536
+
+# nlmsghdr: len, type, flags, seq, pid
+nlmsghdr = struct.Struct('=IHHII')
+nlmsg_head = struct.Struct('=IH')
+# inet_diag_req_v2: family, protocol, ext, pad, states, inet_diag_sockid
+inet_diag_req = struct.Struct('=BBBxI48x')
+# inet_diag_msg state, timer, retrans, rqueue and wqueue, from the start
+# of its nlmsghdr (family, id and expires skipped)
+inet_diag_msg = struct.Struct('=17xBBB52xII')
+
+TCP_FNAMES = ['/proc/net/tcp', '/proc/net/tcp6']
+CHUNK_SIZE = 1 << 20
+
+# 'st tx_queue:rx_queue tr' and retrnsmt columns of /proc/net/tcp{,6}
+re_tcp_line = re.compile(r'^ *\d+: \S+ \S+ (\S\S \S+ \S\S):\S+ (\S+)',
+                         re.MULTILINE)
+
+def states_mask(names):
+   """
+   Returns: idiag_states bit mask of TCP state names, all states if names
+            is empty
+   """
+   if not names:
+      return ALL_STATES
+   mask = 0
+   for name in names:
+      state = tcp_states.index(name.lower()) + 1
+      mask |= 1 << state
+      if state == SYN_RECV:
+         mask |= 1 << NEW_SYN_RECV
+   return mask
+
+def new_summary(mask):
+   """
+   Returns: summary values, 0 for the states in mask and for the other
+            fields, None for the states not in mask
+   """
+   summary = [0] * len(summary_fields)
+   for i in range(len(tcp_states)):
+      if not mask & (1 << (i + 1)):
+         summary[i] = None
+   return summary
+
+def add_socket(summary, state, timer, retrans, rqueue, wqueue, count=1):
+   """
+   Add count sockets with the same state, timer, retransmissions and queue
+   sizes to summary.
+   """
+   if state == NEW_SYN_RECV:
+      state = SYN_RECV
+   summary[state - 1] += count
+   if timer == TIMER_RETRANSMIT:
+      summary[RETRANS_SOCKETS] += count
+      summary[RETRANS_SEGS] += retrans * count
+   if state == LISTEN:
+      summary[LISTEN_BACKLOG] += rqueue * count
+   else:
+      summary[RX_QUEUE] += rqueue * count
+      summary[TX_QUEUE] += wqueue * count
+
+def summarize_sockets(sockets, mask=ALL_STATES):
+   """
+   Returns: summary values of a Counter filled by parse_diag_messages()
+   """
+   summary = new_summary(mask)
+   for (state, timer, retrans, rqueue, wqueue), count in sockets.items():
+      add_socket(summary, state, timer, retrans, rqueue, wqueue, count)
+   return summary
+
+def parse_diag_messages(buf, size, sockets):
+   """
+   Count the sockets of a netlink reply.
+
+   Args:
+        buf: reply buffer
+        size: number of bytes received
+        sockets: Counter of (state, timer, retrans, rqueue, wqueue) tuples
+
+   Returns: True when the end of the dump was reached
+   """
+   unpack_head = nlmsg_head.unpack_from
+   unpack_msg = inet_diag_msg.unpack_from
+   found = []
+   offset = 0
+   done = False
+   while offset + nlmsghdr.size <= size:
+      length, msg_type = unpack_head(buf, offset)
+      if msg_type == SOCK_DIAG_BY_FAMILY:
+         found.append(unpack_msg(buf, offset))
+      elif msg_type == NLMSG_DONE:
+         done = True
+         break
+      elif msg_type == NLMSG_ERROR:
+         errno = -struct.unpack_from('=i', buf, offset + nlmsghdr.size)[0]
+         raise OSError(errno, os.strerror(errno))
+      if length < nlmsghdr.size:
+         break
+      offset += (length + 3) & ~3
+   sockets.update(found)
+   return done
+
+def netlink_summary(mask=ALL_STATES):
+   """
+   Summarize TCP sockets through sock_diag netlink dumps.
+
+   Args:
+        mask: idiag_states bit mask of the states to report
+
+   Returns: summary values in summary_fields order
+
+   Raises: socket.error or OSError if sock_diag is not available
+   """
+   sockets = Counter()
+   buf = bytearray(RECV_BUFSIZE)
+   sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM,
+                        NETLINK_SOCK_DIAG)
+   try:
+      for seq, family in enumerate((socket.AF_INET, socket.AF_INET6)):
+         req = inet_diag_req.pack(family, socket.IPPROTO_TCP, 0, mask)
+         sock.send(nlmsghdr.pack(nlmsghdr.size + len(req),
+                                 SOCK_DIAG_BY_FAMILY,
+                                 NLM_F_REQUEST | NLM_F_DUMP, seq + 1, 0) + req)
+         while True:
+            size = sock.recv_into(buf)
+            if size <= 0 or parse_diag_messages(buf, size, sockets):
+               break
+   finally:
+      sock.close()
+   return summarize_sockets(sockets, mask)
+
+state_codes = dict(('%02X' % (i + 1), i + 1) for i in range(NEW_SYN_RECV))
+
+def parse_tcp_chunk(text, columns):
+   """
+   Count the distinct column values of complete /proc/net/tcp{,6} lines
+   in text. Most sockets share the same state, empty queues and no
+   timer, so only distinct values are decoded.
+
+   Args:
+        text: complete lines
+        columns: Counter of ('st tx_queue:rx_queue tr', retrnsmt) tuples
+   """
+   columns.update(re_tcp_line.findall(text))
+
+def add_tcp_columns(summary, columns, mask):
+   """
+   Add the sockets counted by parse_tcp_chunk() to summary, skipping
+   states not in mask.
+   """
+   for (cols, retrans), count in columns.items():
+      state = state_codes.get(cols[:2])
+      if state is None or not mask & (1 << state):
+         continue
+      add_socket(summary, state, int(cols[21:23], 16), int(retrans, 16),
+                 int(cols[12:20], 16), int(cols[3:11], 16), count)
+
+def proc_summary(mask=ALL_STATES, fnames=None):
+   """
+   Summarize TCP sockets from /proc/net/tcp{,6}, read in CHUNK_SIZE
+   chunks so memory use does not grow with the number of sockets.
+
+   Returns: summary values in summary_fields order
+   """
+   columns = Counter()
+   for fname in fnames or TCP_FNAMES:
+      try:
+         fd = os.open(fname, os.O_RDONLY)
+      except (IOError, OSError):
+         continue
+      try:
+         rest = ''
+         while True:
+            data = os.read(fd, CHUNK_SIZE)
+            if not data:
+               break
+            text = rest + data.decode('ascii', 'replace')
+            end = text.rfind('\n') + 1
+            rest = text[end:]
+            parse_tcp_chunk(text[:end], columns)
+         parse_tcp_chunk(rest, columns)
+      finally:
+         os.close(fd)
+   summary = new_summary(mask)
+   add_tcp_columns(summary, columns, mask)
+   return summary
@@ -84,6 +84,12 @@
            virtual memory is having some difficulty.  This field is displayed
            as zero if no pages have been scanned during the interval of time.
 
+ Where the kernel exposes them, the following rates are derived as well:
+ pgscan/pgsteal of anon and file pages, workingset refaults (total, anon
+ and file), activations, restores and node reclaims, page demotions
+ (pgdemote_*) and transparent huge page faults, fallbacks, collapses and
+ splits.
+
 
  This plugin is based on /proc/vmstat output (varies from system to
  to system), which consists of following fields:
@@ -179,10 +185,13 @@
 
 import collectd
 import platform
-import os
 import socket
 import time
 import re
+from array import array
+
+import dispatcher
+import procreader
 
 os_name = platform.system()
 host_name = socket.gethostbyaddr(socket.gethostname())[0]
@@ -193,6 +202,7 @@ VMS_FNAME = '/proc/vmstat'
 
 METRIC_PLUGIN = 'vmstats'
 METRIC_TYPE = 'gauge'
+BATCH_DISPATCH = 'BatchDispatch'
 
 vmstat_fields = ['nr_free_pages',
                  'nr_inactive_anon',
@@ -296,17 +306,67 @@ vmstat_fields = ['nr_free_pages',
                  'thp_collapse_alloc_failed',
                  'thp_split'
                  ]
-vmstat_metrics = ['pgpgin_per_sec',
-                  'pgpgout_per_sec',
-                  'pswpin_per_sec',
-                  'pswpout_per_sec',
-                  'faults_per_sec',
-                  'majflts_per_sec',
-                  'pgfree_per_sec',
-                  'pgscank_per_sec',
-                  'pgscand_per_sec',
-                  'pgsteal_per_sec',
-                  'pct_vmeff']
+
+"""
+Derived metrics are declared as rules over whichever raw counters the
+running kernel exposes, and compiled against the /proc/vmstat layout
+with the key plan:
+
+- (metric, RATE, alternatives): per second rate of the sum of the
+  counters of the first alternative present in /proc/vmstat. Counters
+  are given as regular expressions matching whole key names; the
+  metric is None if no alternative is present.
+- (metric, PCT, (numerator, denominators)): percentage of earlier
+  metrics, numerator / sum of denominators, capped at 100 and 0 when
+  the denominator is 0 (as %vmeff of 'sar -B').
+
+pgscan/pgsteal counters are kept per zone up to 3.x kernels
+(pgscan_kswapd_normal, ...) and per reclaim origin since 4.x kernels
+(pgscan_kswapd, ...); pgscan_direct_throttle is not a scan counter.
+"""
+RATE = 0
+PCT = 1
+ZONES = '(dma|dma32|normal|high|movable|device)'
+
+derived_rules = [
+   ('pgpgin_per_sec', RATE, [['pgpgin']]),
+   ('pgpgout_per_sec', RATE, [['pgpgout']]),
+   ('pswpin_per_sec', RATE, [['pswpin']]),
+   ('pswpout_per_sec', RATE, [['pswpout']]),
+   ('faults_per_sec', RATE, [['pgfault']]),
+   ('majflts_per_sec', RATE, [['pgmajfault']]),
+   ('pgfree_per_sec', RATE, [['pgfree']]),
+   ('pgscank_per_sec', RATE, [['pgscan_kswapd'],
+                              ['pgscan_kswapd_' + ZONES]]),
+   ('pgscand_per_sec', RATE, [['pgscan_direct'],
+                              ['pgscan_direct_' + ZONES]]),
+   ('pgsteal_per_sec', RATE, [['pgsteal_kswapd', 'pgsteal_direct'],
+                              ['pgsteal_(kswapd|direct)_' + ZONES],
+                              ['pgsteal_' + ZONES]]),
+   ('pct_vmeff', PCT, ('pgsteal_per_sec',
+                       ['pgscank_per_sec', 'pgscand_per_sec'])),
+   ('pgscan_anon_per_sec', RATE, [['pgscan_anon']]),
+   ('pgscan_file_per_sec', RATE, [['pgscan_file']]),
+   ('pgsteal_anon_per_sec', RATE, [['pgsteal_anon']]),
+   ('pgsteal_file_per_sec', RATE, [['pgsteal_file']]),
+   ('workingset_refault_per_sec', RATE, [['workingset_refault_(anon|file)'],
+                                         ['workingset_refault']]),
+   ('workingset_refault_anon_per_sec', RATE, [['workingset_refault_anon']]),
+   ('workingset_refault_file_per_sec', RATE, [['workingset_refault_file']]),
+   ('workingset_activate_per_sec', RATE, [['workingset_activate_(anon|file)'],
+                                          ['workingset_activate']]),
+   ('workingset_restore_per_sec', RATE, [['workingset_restore_(anon|file)'],
+                                         ['workingset_restore']]),
+   ('workingset_nodereclaim_per_sec', RATE, [['workingset_nodereclaim']]),
+   ('pgdemote_per_sec', RATE, [['pgdemote_[a-z]+']]),
+   ('thp_fault_alloc_per_sec', RATE, [['thp_fault_alloc']]),
+   ('thp_fault_fallback_per_sec', RATE, [['thp_fault_fallback']]),
+   ('thp_collapse_alloc_per_sec', RATE, [['thp_collapse_alloc']]),
+   ('thp_collapse_alloc_failed_per_sec', RATE, [['thp_collapse_alloc_failed']]),
+   ('thp_split_per_sec', RATE, [['thp_split_page'], ['thp_split']])
+   ]
+vmstat_metrics = [rule[0] for rule in derived_rules]
+
 white_list = ['pgpgin',
               'pgpgout',
               'pswpin',
@@ -347,7 +407,6 @@ white_list = ['pgpgin',
               'compact_success',
               'htlb_buddy_alloc_success',
               'htlb_buddy_alloc_fail',
-              'nr_free_pages',
               'nr_inactive_anon',
               'nr_active_anon',
               'nr_inactive_file',
@@ -393,158 +452,281 @@ pgsteal_white_list = []
 pgscank_white_list = []
 pgscand_white_list = []
 
-stats_cache = {}
-stats_current = {}
+# Counters tracked on this kernel, in /proc/vmstat order, and the plan
+# mapping their line positions in /proc/vmstat to slots of the snapshots.
+# The layout only changes with the kernel, so the plan is built at init
+# and rebuilt only when the first key (with its separator, as bytes) or
+# the number of lines differs.
+# Raw counters are dispatched from the first num_raw_keys slots; the
+# other slots hold counters read only for derived_rules.
+stats_keys = []
+num_raw_keys = 0
+key_plan = []
+plan_first_key = b''
+plan_num_lines = 0
+
+# python 2 arrays have no 'q'; 'l' is 64 bits on LP64 Linux
+try:
+   STATS_TYPECODE = array('q').typecode
+except ValueError:
+   STATS_TYPECODE = 'l'
+
+# Previous and current snapshots of the tracked counters, preallocated
+# with the plan and swapped after each read, with the time of each read.
+# stats_cache_ts is None when there is no previous snapshot to rate from.
+stats_cache = array(STATS_TYPECODE)
+stats_current = array(STATS_TYPECODE)
+stats_cache_ts = None
+stats_current_ts = None
+
+# derived_rules compiled for the layout of the key plan, and their values
+compiled_rules = []
+derived_vals = [None] * len(vmstat_metrics)
+
+config = {}
+
+# derived metrics are a single 'vmstats' record with BatchDispatch
+metric_dispatcher = dispatcher.Dispatcher(METRIC_PLUGIN, host_name, METRIC_TYPE)
+metric_dispatcher.register_type(METRIC_PLUGIN, vmstat_metrics)
 
 def get_host_type():
    for i in host_types:
       if i in host_name:
          host_type = i
 
+def build_key_plan(lines, rule_keys=()):
+   """
+   Build the line position -> slot plan of the tracked counters for a
+   /proc/vmstat layout. Keys match white_list exactly; pgsteal_*,
+   pgscan_kswapd* and pgscan_direct* keys known in vmstat_fields are
+   tracked as well and listed in their own white lists. Keys only in
+   rule_keys get the slots after those.
+
+   Args:
+        lines: lines of /proc/vmstat
+        rule_keys: keys used by derived_rules
+
+   Returns: (keys, number of raw keys, plan, pgsteal keys,
+             pgscan_kswapd keys, pgscan_direct keys)
+   """
+   wanted = set(white_list)
+   fields = set(vmstat_fields)
+   rule_keys = set(rule_keys)
+   keys = []
+   plan = []
+   rule_only = []
+   pgsteal_keys = []
+   pgscank_keys = []
+   pgscand_keys = []
+   for pos, line in enumerate(lines):
+      key_name = line.partition(' ')[0]
+      tracked = key_name in wanted
+      if key_name in fields:
+         if key_name.startswith('pgsteal'):
+            pgsteal_keys.append(key_name)
+            tracked = True
+         elif key_name.startswith('pgscan_kswapd'):
+            pgscank_keys.append(key_name)
+            tracked = True
+         elif key_name.startswith('pgscan_direct'):
+            pgscand_keys.append(key_name)
+            tracked = True
+      if tracked:
+         plan.append((pos, len(keys)))
+         keys.append(key_name)
+      elif key_name in rule_keys:
+         rule_only.append((pos, key_name))
+   num_raw = len(keys)
+   for pos, key_name in rule_only:
+      plan.append((pos, len(keys)))
+      keys.append(key_name)
+   return keys, num_raw, plan, pgsteal_keys, pgscank_keys, pgscand_keys
+
+def resolve_rule_keys(keys):
+   """
+   Select the counters of each RATE rule of derived_rules among keys.
+
+   Args:
+        keys: keys of /proc/vmstat
+
+   Returns: list of counter names per rule, empty for other rules or
+            when no alternative is present
+   """
+   rule_keys = []
+   for metric, kind, args in derived_rules:
+      selected = []
+      if kind == RATE:
+         for alternative in args:
+            patterns = [re.compile(p + '$') for p in alternative]
+            selected = [k for k in keys if any(p.match(k) for p in patterns)]
+            if selected:
+               break
+      rule_keys.append(selected)
+   return rule_keys
+
+def compile_rules(rule_keys, slots):
+   """
+   Compile derived_rules to (kind, operands) tuples indexed like
+   vmstat_metrics: snapshot slots of the counters for RATE rules,
+   (numerator index, denominator indexes) of earlier metrics for PCT
+   rules.
+   """
+   index = dict((m, i) for i, m in enumerate(vmstat_metrics))
+   compiled = []
+   for (metric, kind, args), keys in zip(derived_rules, rule_keys):
+      if kind == RATE:
+         compiled.append((RATE, tuple(slots[k] for k in keys)))
+      else:
+         numerator, denominators = args
+         compiled.append((PCT, (index[numerator],
+                                tuple(index[d] for d in denominators))))
+   return compiled
+
+def set_key_plan(lines):
+   """
+   Build the key plan of a /proc/vmstat layout, compile derived_rules for
+   it and allocate the snapshots. The previous snapshot is dropped, so
+   the next rates are None.
+   """
+   global stats_keys, num_raw_keys, key_plan, plan_first_key, plan_num_lines
+   global pgsteal_white_list, pgscank_white_list, pgscand_white_list
+   global stats_cache, stats_current, stats_cache_ts, compiled_rules
+   rule_keys = resolve_rule_keys([line.partition(' ')[0] for line in lines])
+   (stats_keys, num_raw_keys, key_plan, pgsteal_white_list,
+    pgscank_white_list, pgscand_white_list) = \
+      build_key_plan(lines, [k for keys in rule_keys for k in keys])
+   compiled_rules = compile_rules(rule_keys, dict((k, i) for i, k in
+                                                  enumerate(stats_keys)))
+   plan_first_key = (lines[0].partition(' ')[0] + ' ').encode('ascii') \
+                    if lines else b''
+   plan_num_lines = len(lines)
+   stats_cache = array(STATS_TYPECODE, [0]) * len(stats_keys)
+   stats_current = array(STATS_TYPECODE, [0]) * len(stats_keys)
+   stats_cache_ts = None
+
+def parse_vmstat(lines, vals):
+   """
+   Parse the tracked counters into vals along key_plan. Lines are not
+   decoded, and only those of tracked counters are copied.
+
+   Args:
+        lines: memoryview of each line of /proc/vmstat, as returned by
+               ProcReader.lines()
+        vals: snapshot of len(stats_keys) slots
+
+   Returns: False when the layout does not match the plan
+   """
+   if (len(lines) != plan_num_lines or
+       lines[0][:len(plan_first_key)] != plan_first_key):
+      return False
+   for pos, slot in key_plan:
+      vals[slot] = int(lines[pos].tobytes().partition(b' ')[2])
+   return True
+
+def read_vmstat():
+   """
+   Read /proc/vmstat into stats_current, rebuilding the plan if the layout
+   changed.
+
+   Returns: False if /proc/vmstat could not be read
+   """
+   global stats_current_ts
+   lines = list(procreader.get_reader(VMS_FNAME).lines())
+   if not lines:
+      return False
+   stats_current_ts = time.time()
+   if not parse_vmstat(lines, stats_current):
+      collectd.info('vmstats: %s layout changed, rebuilding key plan'
+                    % (VMS_FNAME))
+      set_key_plan(procreader.decode_lines(lines))
+      parse_vmstat(lines, stats_current)
+   return True
+
 def init_stats_cache():
-   global white_list
-   global pgsteal_white_list
-   global pgscank_white_list
-   global pgscand_white_list
-   tmp_white_list = []
-   tmp_pgsteal_white_list = []
-   tmp_pgscank_white_list = []
-   tmp_pgscand_white_list = []
-
-   if os.path.exists(VMS_FNAME):
-      with open(VMS_FNAME) as f:
-         for line in f:
-            fields = line.split()
-            fields = [fl.strip() for fl in fields]
-            key_name = fields[0]
-            key_val = int(fields[1])
-            if any(s in key_name for s in white_list):
-                tmp_white_list.append(key_name)
-            if (key_name.startswith('pgsteal') and key_name in vmstat_fields):
-                tmp_pgsteal_white_list.append(key_name)
-            elif (key_name.startswith('pgscan_kswapd') and key_name in vmstat_fields):
-                tmp_pgscank_white_list.append(key_name)
-            elif (key_name.startswith('pgscan_direct') and key_name in vmstat_fields):
-                tmp_pgscand_white_list.append(key_name)
-            if (key_name in tmp_white_list+tmp_pgsteal_white_list+tmp_pgscank_white_list+tmp_pgscand_white_list):
-                stats_cache[(key_name, 'val')] = key_val
-                stats_cache[(key_name, 'ts')] = time.time()
-
-      f.close()
-      white_list = list(set().union(tmp_white_list,
-                                    tmp_pgsteal_white_list,
-                                    tmp_pgscank_white_list,
-                                    tmp_pgscand_white_list))
-      pgsteal_white_list = tmp_pgsteal_white_list
-      pgscank_white_list = tmp_pgscank_white_list
-      pgscand_white_list = tmp_pgscand_white_list
+   text = procreader.get_reader(VMS_FNAME).text()
+   if text is not None:
+      set_key_plan(text.splitlines())
+      read_vmstat()
+      swap_current_cache()
    else:
       collectd.info('vmstats: init_stats_cache: path: %s does not exist'
                     % (VMS_FNAME))
 
 def collect_vmstats():
-    if os.path.exists(VMS_FNAME):
-        with open(VMS_FNAME) as f:
-            for line in f:
-                fields = line.split()
-                fields = [fl.strip() for fl in fields]
-                key_name = fields[0]
-                key_val = fields[1]
-                if any(key_name in s for s in white_list):
-                    metric = collectd.Values()
-                    metric.host = host_name
-                    metric.plugin = METRIC_PLUGIN
-                    metric.type = METRIC_TYPE
-                    metric.type_instance = key_name
-                    metric.values = [fields[1]]
-                    stats_current[(key_name, 'val')] = key_val
-                    metric.dispatch()
-                    stats_current[(key_name, 'ts')] = time.time()
-            f.close()
+    if read_vmstat():
+        # stats_keys[:num_raw_keys] limits the zip to the raw counters
+        metric_dispatcher.dispatch_values('', stats_keys[:num_raw_keys],
+                                          stats_current)
     else:
         collectd.info('vmstats: procfs path: %s does not exist' % (VMS_FNAME))
 
 def swap_current_cache():
-   for i in white_list:
-       stats_cache[(i, 'val')] = stats_current[(i, 'val')]
-       stats_cache[(i, 'ts')] = stats_current[(i, 'ts')]
-
-def calc_vmstats_rate(m):
-    cur_t = float(stats_current[(m, 'ts')])
-    pre_t = float(stats_cache[(m, 'ts')])
-    time_delta = cur_t - pre_t
-    if (time_delta <= 0.0):
-        return None
-
-    cur_val = int(stats_current[(m, 'val')])
-    pre_val = int(stats_cache[(m, 'val')])
-    return (cur_val - pre_val)/time_delta if (cur_val >= pre_val) else None
+   global stats_cache, stats_current, stats_cache_ts
+   stats_cache, stats_current = stats_current, stats_cache
+   stats_cache_ts = stats_current_ts
 
 def calc_vmstats():
-    vm_rate = {}
-    for i in white_list:
-        vm_rate[(i)] = calc_vmstats_rate(i)
-
-    # sort out and adjust final metrics values as needed
-    pgpgin_ps = vm_rate['pgpgin']
-    pgpgout_ps = vm_rate['pgpgout']
-    pswpin_ps = vm_rate['pswpin']
-    pswpout_ps = vm_rate['pswpout']
-    faults_ps = vm_rate['pgfault']
-    mjflts_ps = vm_rate['pgmajfault']
-    pgfree_ps = vm_rate['nr_free_pages']
-
-    pgscank_ps = 0.0
-    if pgscank_white_list:
-        for s in pgscank_white_list:
-            pgscank_ps += vm_rate[s] if vm_rate[s] is not None else 0.0
-
-    pgscand_ps = 0.0
-    if pgscand_white_list:
-        for s in pgscand_white_list:
-            pgscand_ps += vm_rate[s] if vm_rate[s] is not None else 0.0
-
-    pgsteal_ps = 0.0
-    if pgsteal_white_list:
-        for s in pgsteal_white_list:
-            pgsteal_ps += vm_rate[s] if vm_rate[s] is not None else 0.0
-
-    pgscan_ps = pgscank_ps + pgscand_ps
-    vmeff = pgsteal_ps/pgscan_ps if (pgscan_ps > 0.0) else 0.0
-    pct_vmeff = vmeff*100.0 if (vmeff < 1.0) else 100.0
-
-    # return as key-value pairs dict
-    m = [pgpgin_ps, pgpgout_ps, pswpin_ps, pswpout_ps,
-         faults_ps, mjflts_ps, pgfree_ps,
-         pgscank_ps, pgscand_ps, pgsteal_ps, pct_vmeff]
-    vmst = dict(zip(vmstat_metrics, m))
-    return vmst
+    """
+    Evaluate the compiled derived_rules on the previous and current
+    snapshots.
+
+    Returns: values in vmstat_metrics order, None without a previous
+             snapshot or when counters went backwards
+    """
+    vals = derived_vals
+    time_delta = 0.0
+    if stats_cache_ts is not None and stats_current_ts is not None:
+        time_delta = stats_current_ts - stats_cache_ts
+    if (time_delta <= 0.0):
+        for i in range(len(vals)):
+            vals[i] = None
+        return vals
+
+    cur = stats_current
+    pre = stats_cache
+    for i, (kind, operands) in enumerate(compiled_rules):
+        if kind == RATE:
+            if not operands:
+                vals[i] = None
+                continue
+            delta = 0
+            for slot in operands:
+                delta += cur[slot] - pre[slot]
+            vals[i] = delta/time_delta if (delta >= 0) else None
+        else:
+            numerator, denominators = operands
+            num = vals[numerator]
+            den = 0.0
+            for d in denominators:
+                if vals[d] is not None:
+                    den += vals[d]
+            if num is None:
+                vals[i] = None
+            elif den > 0.0:
+                vals[i] = min(num/den*100.0, 100.0)
+            else:
+                vals[i] = 0.0
+    return vals
 
 def dispatch_metrics():
-   metric = collectd.Values()
-   metric.host = host_name
-   metric.plugin = METRIC_PLUGIN
-   metric.type = METRIC_TYPE
-
-   key_vals = {}
-   key_vals = calc_vmstats()
-   for i in vmstat_metrics:
-      if key_vals[i] is not None:
-         metric.type_instance = i
-         metric.values = [key_vals[i]]
-         metric.dispatch()
+   metric_dispatcher.add('', METRIC_PLUGIN, vmstat_metrics, calc_vmstats())
+   metric_dispatcher.flush()
 
 
 def configer(ObjConfiguration):
    collectd.info('vmstats plugin: configuring host: %s' % (host_name))
+   for child in ObjConfiguration.children:
+      config[child.key] = child.values
 
 def initer():
+   if BATCH_DISPATCH in config:
+      metric_dispatcher.set_batch(dispatcher.is_true(config[BATCH_DISPATCH][0]))
    get_host_type()
    collectd.info('vmstats plugin: host of type: %s' % (host_type))
    collectd.info('vmstats initer: white list: %s ' % (white_list))
    init_stats_cache()
    collectd.info('vmstats init: stats_cache: %s ' % (stats_cache))
-   collectd.info('vmstats init: updated white_list: %s' % (white_list))
+   collectd.info('vmstats init: tracked keys: %s' % (stats_keys))
    collectd.info('vmstats init: updated pgsteal_white_list: %s' % (pgsteal_white_list))
    collectd.info('vmstats init: updated pgscank_white_list: %s' % (pgscank_white_list))
    collectd.info('vmstats init: updated pgscand_white_list: %s' % (pgscand_white_list))
@@ -560,6 +742,7 @@ def writer(metric, data=None):
 
 def shutdown():
    collectd.info("vmstats plugin shutting down")
+   procreader.close_reader(VMS_FNAME)
 
 #== Callbacks ==#
 if (os_name == 'Linux'):
@@ -37,17 +37,34 @@
 NUMA node and memory zone. It supplements the measurements
 provided by vmstats and buddyinfo plugins.
 
+The file is parsed in a single pass: every "Node N, zone X" header
+starts a new zone, and every "key value" line below it is stored as an
+int in that zone's stats map, so counters a kernel adds or omits (e.g.
+"scanned", gone since 4.x) do not break the parser. Since 4.8 a number
+of counters (nr_dirty, nr_writeback, ...) are kept per node and listed
+once, under "per-node stats" in the first zone of the node; they are
+kept in a per-node map and dispatched as node_<counter>.
+
+white_list counters are dispatched as zone_<zone>_<counter> (or
+node_<counter>) with the node as plugin_instance. Optionally:
+
+- Protection: zone_<zone>_protection_<i>, the lowmem reserve of the
+  zone against allocations that may use zone i
+- Pagesets: zone_<zone>_pageset_cpu<N>_{count,high,batch}, the per-CPU
+  page lists of the zone
+
 """
 
 import collectd
 import platform
-import os
 import socket
 import time
-import re
 import sys
 import traceback
 
+import dispatcher
+import procreader
+
 os_name = platform.system()
 host_name = socket.gethostbyaddr(socket.gethostname())[0]
 host_types = ['app', 'db', 'ffx', 'indexer', 'search', 'other']
@@ -58,6 +75,11 @@ ZONEINFO_FNAME = '/proc/zoneinfo'
 METRIC_PLUGIN = 'zonefino'
 METRIC_TYPE = 'gauge'
 
+# config keys
+PROTECTION = 'Protection'
+PAGESETS = 'Pagesets'
+
+PAGESET_FIELDS = ['count', 'high', 'batch']
 
 white_list = ['min',
               'low',
@@ -71,84 +93,184 @@ white_list = ['min',
 node_list = []
 zone_list = []
 
+config = {}
+protection_enabled = False
+pagesets_enabled = False
+
 stats_cache = {}
 stats_current = {}
 
-re_zoneinfo=re.compile(r'^\s*Node\s+(?P<node>\d+)'
-                       r',\s+zone\s+(?P<zone>\S+)'
-                       r'(?:\n|\r\n?)'
-                       r'^\s+pages free\s+(?P<zone_free>\d+)'
-                       r'(?:\n|\r\n?)'
-                       r'^\s+min\s+(?P<min>\d+)'
-                       r'(?:\n|\r\n?)'
-                       r'^\s+low\s+(?P<low>\d+)'
-                       r'(?:\n|\r\n?)'
-                       r'^\s+high\s+(?P<high>\d+)'
-                       r'(?:\n|\r\n?)'
-                       r'^\s+scanned\s+(?P<scanned>\d+)'
-                       r'(?:\n|\r\n?)'
-                       r'(^(.+)\n)+?'
-                       r'^\s+nr_free_pages\s+(?P<nr_free_pages>\d+)'
-                       r'(?:\n|\r\n?)'
-                       r'(^(.+)\n)+?'
-                       r'^\s+nr_dirty\s+(?P<nr_dirty>\d+)'
-                       r'(?:\n|\r\n?)'
-                       r'^\s+nr_writeback\s+(?P<nr_writeback>\d+)'
-                       r'(?:\n|\r\n?)'
-                       r'(^(.+)\n)+?'
-                       r'^\s+nr_vmscan_write\s+(?P<nr_vmscan_write>\d+)'
-                       r'(?:\n|\r\n?)'
-                       r'(^(.+)\n)+?'
-                       r'^\s+nr_anon_transparent_hugepages\s+(?P<nr_anon_transparent_hugepages>\d+)'
-                       , re.MULTILINE)
+metric_dispatcher = dispatcher.Dispatcher(METRIC_PLUGIN, host_name, METRIC_TYPE)
 
 def get_host_type():
    for i in host_types:
       if i in host_name:
          host_type = i
 
+def parse_stat_lines(lines, stats, node_stats=None):
+   """
+   Parse "key value" lines into stats, or into node_stats until the first
+   zone counter ("pages free") when the zone starts with per-node stats.
+   """
+   for line in lines:
+      fields = line.split()
+      if len(fields) == 2:
+         key, val = fields
+      elif not fields:
+         continue
+      elif fields[0] == 'protection:':
+         # protection: (0, 3024, 4304, 4304)
+         stats['protection'] = [int(v.strip('(),')) for v in fields[1:]]
+         continue
+      elif fields[0] == 'per-node':
+         continue
+      else:
+         # pages free 3840, vm stats threshold: 2
+         key, val = '_'.join(fields[:-1]), fields[-1]
+         if key == 'pages_free':
+            node_stats = None
+      try:
+         val = int(val)
+      except ValueError:
+         continue
+      if node_stats is not None:
+         node_stats[key] = val
+      else:
+         stats[key.rstrip(':')] = val
+
+def parse_pagesets(lines, stats):
+   """
+   Parse the per-CPU pagesets of a zone, and the zone counters listed
+   between and after them, e.g.:
+
+   |    cpu: 0
+   |              count: 140
+   |              high:  186
+   |              batch: 31
+   |  vm stats threshold: 10
+   |  start_pfn:         1048576
+   """
+   pagesets = []
+   stats['pagesets'] = pagesets
+   pageset = None
+   tail = []
+   for line in lines:
+      if line.startswith('    cpu:'):
+         pageset = {}
+         pagesets.append((line.split()[1], pageset))
+      elif line.startswith('      ') and pageset is not None:
+         fields = line.split()
+         try:
+            pageset[fields[0].rstrip(':')] = int(fields[-1])
+         except (ValueError, IndexError):
+            pass
+      else:
+         tail.append(line)
+   parse_stat_lines(tail, stats)
+
+def parse_zoneinfo(text, with_pagesets=True):
+   """
+   Parse /proc/zoneinfo in a single pass.
+
+   The text is split on the "Node N, zone X" headers and on the pagesets
+   line of each zone; per-CPU pagesets are most of the file on hosts with
+   many CPUs, and when they are not wanted only the few zone counters
+   after the last CPU are parsed.
+
+   Args:
+        text: contents of /proc/zoneinfo
+        with_pagesets: parse per-CPU pagesets
+
+   Returns: (zones, nodes) where zones is a list of (node, zone, stats)
+            in file order and nodes maps node to its per-node stats.
+            stats map counter names to ints, except 'protection' (list of
+            ints) and 'pagesets' (list of (cpu, {field: int})).
+   """
+   zones = []
+   nodes = {}
+   for chunk in ('\n' + text).split('\nNode ')[1:]:
+      # 0, zone      DMA
+      header, sep, body = chunk.partition('\n')
+      fields = header.split()
+      if len(fields) < 3:
+         continue
+      node, zone = fields[0].rstrip(','), fields[2]
+      stats = {}
+      zones.append((node, zone, stats))
+
+      head, sep, pagesets = body.partition('\n  pagesets\n')
+      node_stats = None
+      if head.startswith('  per-node stats'):
+         node_stats = nodes.setdefault(node, {})
+      parse_stat_lines(head.split('\n'), stats, node_stats)
+      if not sep:
+         continue
+      if with_pagesets:
+         parse_pagesets(pagesets.split('\n'), stats)
+      else:
+         # skip to the fields of the last cpu
+         last = pagesets.rfind('    cpu:')
+         lines = pagesets[last:].split('\n') if last >= 0 else []
+         parse_stat_lines([l for l in lines if not l.startswith('   ')],
+                          stats)
+   return zones, nodes
+
+def get_zone_metrics(stats):
+   """
+   Returns: (names, values) of the white listed and optional metrics of
+            a zone
+   """
+   names, vals = [], []
+   for k in white_list:
+      if k in stats:
+         names.append(k)
+         vals.append(stats[k])
+   if protection_enabled and 'protection' in stats:
+      for i, v in enumerate(stats['protection']):
+         names.append('protection_%d' % (i))
+         vals.append(v)
+   if pagesets_enabled and 'pagesets' in stats:
+      for cpu, pageset in stats['pagesets']:
+         for k in PAGESET_FIELDS:
+            if k in pageset:
+               names.append('pageset_cpu%s_%s' % (cpu, k))
+               vals.append(pageset[k])
+   return names, vals
+
+def get_node_metrics(stats):
+   names = [k for k in white_list if k in stats]
+   return names, [stats[k] for k in names]
+
+def read_zoneinfo():
+   text = procreader.get_reader(ZONEINFO_FNAME).text()
+   if text is None:
+      collectd.error('zoneinfo: procfs path: %s does not exist'
+                     % (ZONEINFO_FNAME))
+      return None
+   zones, nodes = parse_zoneinfo(text, pagesets_enabled)
+   if not zones:
+      collectd.error('zoneinfo: no zones found in %s' % (ZONEINFO_FNAME))
+      return None
+   return zones, nodes
+
 def init_stats_cache():
    try:
-      if os.path.exists(ZONEINFO_FNAME):
-         with open(ZONEINFO_FNAME) as f:
-            match = re.finditer(re_zoneinfo, f.read())
-            if not match:
-               collectd.error('zoneinfo: init: pattern not found')
-               return
-            for m in match:
-               if 'node' in m.groupdict():
-                  node = m.group('node')
-               else:
-                  collectd.error('node not found in zoneinfo')
-                  return
-               if 'zone' in m.groupdict():
-                  zone = m.group('zone')
-               else:
-                  collectd.error('zone not found in zoneinfo')
-                  return
-               if node not in node_list:
-                  node_list.append(node)
-               if zone not in zone_list:
-                  zone_list.append(zone)
-
-               zone_pages = []
-               for i in white_list:
-                  if i in m.groupdict():
-                     zone_pages.append(m.group(i))
-                  else:
-                     collectd.error(i + ' not found in zoneinfo')
-                     return
-
-               stats_cache[(node, zone, 'val')] = zone_pages
-               stats_cache[(node, zone, 'ts')] = time.time()
-
-            f.close()
-            collectd.info('node_list: %s' % (node_list))
-            collectd.info('zone_list: %s' % (zone_list))
-            collectd.info('white_list: %s' % (white_list))
-      else:
-         collectd.error('zoneinfo: init: procfs path: %s does not exist'
-                        % (ZONEINFO_FNAME))
+      parsed = read_zoneinfo()
+      if parsed is None:
+         return
+      zones, nodes = parsed
+      ts = time.time()
+      for node, zone, stats in zones:
+         if node not in node_list:
+            node_list.append(node)
+         if zone not in zone_list:
+            zone_list.append(zone)
+         stats_cache[(node, zone, 'val')] = get_zone_metrics(stats)[1]
+         stats_cache[(node, zone, 'ts')] = ts
+
+      collectd.info('node_list: %s' % (node_list))
+      collectd.info('zone_list: %s' % (zone_list))
+      collectd.info('white_list: %s' % (white_list))
    except Exception as e:
       exc_type, exc_value, exc_traceback = sys.exc_info()
       collectd.error('Exception during zoneinfo init: %s\n%s' %
@@ -156,57 +278,41 @@ def init_stats_cache():
 
 def collect_zoneinfo():
    try:
-      if os.path.exists(ZONEINFO_FNAME):
-         with open(ZONEINFO_FNAME) as f:
-            match = re.finditer(re_zoneinfo, f.read())
-            if not match:
-               collectd.error('zoneinfo: collect: pattern not found')
-               return
-            for m in match:
-               zone_pages = []
-               if 'node' in m.groupdict():
-                  node = m.group('node')
-               else:
-                  collectd.error('node not found in zoneinfo')
-                  return
-               if 'zone' in m.groupdict():
-                  zone = m.group('zone')
-               else:
-                  collectd.error('zone not found in zoneinfo')
-                  return
-               for i in white_list:
-                  if i in m.groupdict():
-                     zone_pages.append(m.group(i))
-                  else:
-                     collectd.error(i + ' not found in zoneinfo')
-                     return
-               stats_current[(node, zone, 'val')] = zone_pages
-               stats_current[(node, zone, 'ts')] = time.time()
-               metric = collectd.Values()
-               metric.host = host_name
-               metric.plugin = METRIC_PLUGIN
-               metric.plugin_instance = node
-               metric.type = METRIC_TYPE
-               for k in range(0, len(white_list)):
-                  metric.type_instance = 'zone_' + zone + '_'
-                  metric.type_instance += white_list[k]
-                  metric.values = [zone_pages[k]]
-                  metric.dispatch()
-
-         f.close()
-      else:
-         collectd.error('zoneinfo: collect: procfs path: %s does not exist'
-                        % (ZONEINFO_FNAME))
+      parsed = read_zoneinfo()
+      if parsed is None:
+         return
+      zones, nodes = parsed
+      ts = time.time()
+      for node, zone, stats in zones:
+         names, zone_pages = get_zone_metrics(stats)
+         stats_current[(node, zone, 'val')] = zone_pages
+         stats_current[(node, zone, 'ts')] = ts
+         metric_dispatcher.dispatch_values(node, names, zone_pages,
+                                           'zone_' + zone + '_')
+      for node, stats in nodes.items():
+         names, vals = get_node_metrics(stats)
+         metric_dispatcher.dispatch_values(node, names, vals, 'node_')
    except Exception as e:
       exc_type, exc_value, exc_traceback = sys.exc_info()
       collectd.error('Exception during zoneinfo collection: %s\n%s' %
                      (str(e), traceback.format_tb(exc_traceback)))
 
 def swap_current_cache():
-   stats_cache = stats_current.copy()
+   global stats_cache, stats_current
+   stats_cache, stats_current = stats_current, stats_cache
 
 def configer(ObjConfiguration):
+   global protection_enabled, pagesets_enabled
    collectd.info('zoneinfo plugin: configuring host: %s' % (host_name))
+   for child in ObjConfiguration.children:
+      config[child.key] = child.values
+
+   if PROTECTION in config:
+      protection_enabled = dispatcher.is_true(config[PROTECTION][0])
+   if PAGESETS in config:
+      pagesets_enabled = dispatcher.is_true(config[PAGESETS][0])
+   collectd.info('zoneinfo plugin: protection: %s pagesets: %s' %
+                 (protection_enabled, pagesets_enabled))
 
 def initer():
    get_host_type()
@@ -225,6 +331,7 @@ def writer(metric, data=None):
 
 def shutdown():
    collectd.info("zoneinfo plugin shutting down")
+   procreader.close_reader(ZONEINFO_FNAME)
 
 #== Callbacks ==#
 if (os_name == 'Linux'):
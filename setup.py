@@ -14,13 +14,28 @@ data_files = [
                                             'plugins/buddyinfo.py',
                                             'plugins/zoneinfo.py',
                                             'plugins/netstats.py',
-                                            'plugins/fusionio.py']),
+                                            'plugins/fusionio.py',
+                                            'plugins/psi.py',
+                                            'plugins/cpustats.py',
+                                            'plugins/numastats.py',
+                                            'plugins/netdev.py',
+                                            'plugins/blklatency.py',
+                                            'plugins/procreader.py',
+                                            'plugins/devfilter.py',
+                                            'plugins/sockdiag.py',
+                                            'plugins/dispatcher.py']),
+    ('/usr/share/collectd', ['plugins/telemetry_types.db']),
     ('/etc/collectd.d', ['plugins/diskstats.conf',
                          'plugins/vmstats.conf',
                          'plugins/buddyinfo.conf',
                          'plugins/zoneinfo.conf',
                          'plugins/netstats.conf',
-                         'plugins/fusionio.conf']),
+                         'plugins/fusionio.conf',
+                         'plugins/psi.conf',
+                         'plugins/cpustats.conf',
+                         'plugins/numastats.conf',
+                         'plugins/netdev.conf',
+                         'plugins/blklatency.conf']),
 ]
 
 setup(
@@ -0,0 +1,187 @@
+#!/usr/bin/python
+
+##########################################################################
+# Copyright (c) 2015, Salesforce.com, Inc.
+# All rights reserved.
+#
+# Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#
+# Neither the name of Salesforce.com nor the names of its
+# contributors may be used to endorse or promote products
+# derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+##########################################################################
+
+
+############################################################
+# Unit test for blklatency plugin
+############################################################
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from mock import Mock, patch
+
+import collectd
+sys.path.append(os.path.join(os.path.dirname(__file__), "../plugins"))
+import blklatency
+
+def diskstats_line(dev, reads, read_ms, writes, write_ms):
+  return ('   8       0 %s %d 0 0 %d %d 0 0 %d 0 0 0\n' %
+          (dev, reads, read_ms, writes, write_ms))
+
+class TestBlklatency(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.fname = os.path.join(self.tmpdir, 'diskstats')
+
+  def tearDown(self):
+    blklatency.device_filter_regexes = None
+    blklatency.SYS_BLOCK_DIR = '/sys/block'
+    shutil.rmtree(self.tmpdir)
+
+  def make_sys_block(self, devs):
+    sys_block = os.path.join(self.tmpdir, 'block')
+    if os.path.isdir(sys_block):
+      shutil.rmtree(sys_block)
+    for dev in devs:
+      os.makedirs(os.path.join(sys_block, dev))
+    return sys_block
+
+  def write_diskstats(self, lines):
+    with open(self.fname, 'w') as f:
+      f.write(''.join(lines))
+
+  def test_1_blklatency_buckets(self):
+    for i in range(blklatency.NUM_BUCKETS):
+      self.assertEqual(blklatency.bucket_index(blklatency.bucket_value(i)), i)
+    for v in [0, 1, 15, 16, 17, 100, 999, 12345, 10**7]:
+      upper = blklatency.bucket_value(blklatency.bucket_index(v))
+      self.assertTrue(v <= upper <= v * (1 + 1.0 / blklatency.SUB_BUCKETS),
+                      'relative error of %d' % (v))
+    self.assertEqual(blklatency.bucket_index(2**50),
+                     blklatency.NUM_BUCKETS - 1, 'values above the range')
+
+  def test_2_blklatency_percentiles(self):
+    hist = blklatency.LatencyHistogram()
+    self.assertEqual(hist.percentiles(blklatency.percentiles),
+                     [None, None, None])
+    hist.record(100, 989)
+    hist.record(10000, 10)
+    hist.record(500000, 2)
+    p50, p99, p999 = hist.percentiles(blklatency.percentiles)
+    self.assertTrue(100 <= p50 <= 106)
+    self.assertTrue(10000 <= p99 <= 10625)
+    self.assertTrue(500000 <= p999 <= 531250)
+
+    other = blklatency.LatencyHistogram()
+    other.record(500000, 1000)
+    other.merge(hist)
+    self.assertEqual(other.total, 2001)
+    self.assertEqual(other.percentiles([0.4, 0.6]),
+                     [hist.percentiles([0.5])[0], p999])
+
+  def test_3_blklatency_sampler(self):
+    self.write_diskstats([diskstats_line('sda', 100, 500, 10, 100),
+                          diskstats_line('sdb', 0, 0, 0, 0),
+                          diskstats_line('loop0', 0, 0, 0, 0)])
+    with patch('blklatency.DISKSTATS_FNAME', self.fname):
+      sampler = blklatency.LatencySampler(0.1)
+    blklatency.SYS_BLOCK_DIR = self.make_sys_block(['sda', 'sdb', 'loop0'])
+    sampler.sample()
+    self.assertEqual(sampler.devs, set(['sda', 'sdb']))
+    self.assertEqual(sampler.take(), {}, 'no window yet')
+
+    # sda: 100 reads of 2ms, 10 writes of 50ms; sdb is idle
+    self.write_diskstats([diskstats_line('sda', 200, 700, 20, 600),
+                          diskstats_line('sdb', 0, 0, 0, 0),
+                          diskstats_line('loop0', 5, 5, 0, 0)])
+    sampler.sample()
+    # sda: 100 reads of 10ms; sdb went away
+    self.write_diskstats([diskstats_line('sda', 300, 1700, 20, 600),
+                          diskstats_line('loop0', 5, 5, 0, 0)])
+    sampler.sample()
+    hists = sampler.take()
+    self.assertEqual(sorted(hists.keys()), ['sda', 'sdb'])
+    self.assertEqual(sampler.counters,
+                     {'sda': (300, 1700, 20, 600)}, 'sdb dropped')
+    read_hist, write_hist = hists['sda']
+    self.assertEqual((read_hist.total, write_hist.total), (200, 10))
+    vals = dict(zip(blklatency.blklatency_metrics,
+                    blklatency.calc_device_metrics(read_hist, write_hist)))
+    self.assertTrue(0.002 <= vals['await_read_p50'] <= 0.0022)
+    self.assertTrue(0.010 <= vals['await_read_p99'] <= 0.0107)
+    self.assertTrue(0.050 <= vals['await_write_p50'] <= 0.0532)
+    self.assertTrue(0.050 <= vals['await_rw_p999'] <= 0.0532)
+    self.assertEqual(vals['await_rw_p50'], vals['await_read_p99'])
+    self.assertEqual(blklatency.calc_device_metrics(*hists['sdb']),
+                     [None] * len(blklatency.blklatency_metrics))
+    self.assertEqual(sampler.take(), {}, 'histograms reset')
+    sampler.reader.close()
+
+  def test_4_blklatency_filter(self):
+    with patch('blklatency.collectd.info'):
+      config = Mock(children=[Mock(key='DiskFilter',
+                                   values=('^sd[a-z]+$', '^dm-[0-9]+$',
+                                           '!^sdz$'))])
+      blklatency.configer(config)
+    sampler = blklatency.LatencySampler(0.1, blklatency.device_filter_regexes)
+    self.assertTrue(sampler.filter.match('dm-3'))
+    self.assertTrue(sampler.filter.match('sdb'))
+    self.assertFalse(sampler.filter.match('sdb1'))
+    self.assertFalse(sampler.filter.match('sdz'), 'excluded')
+    sampler.reader.close()
+
+    # excludes only: default devices but the excluded ones
+    sampler = blklatency.LatencySampler(0.1, ['!^sdb$'])
+    sampler.devs = set(['sda', 'sdb'])
+    self.assertTrue(sampler.filter.match('sda'))
+    self.assertFalse(sampler.filter.match('sdb'))
+    self.assertFalse(sampler.filter.match('sdc'))
+    sampler.reader.close()
+
+  def test_5_blklatency_hotplug(self):
+    self.write_diskstats([diskstats_line('sda', 100, 500, 10, 100),
+                          diskstats_line('sdb', 100, 500, 10, 100)])
+    blklatency.SYS_BLOCK_DIR = self.make_sys_block(['sda'])
+    with patch('blklatency.DISKSTATS_FNAME', self.fname):
+      sampler = blklatency.LatencySampler(0.1)
+    with patch('time.time', return_value=100.0):
+      sampler.sample()
+    self.assertEqual(list(sampler.counters.keys()), ['sda'])
+
+    # sdb shows up in /sys/block: sampled from the next listing on
+    blklatency.SYS_BLOCK_DIR = self.make_sys_block(['sda', 'sdb'])
+    with patch('time.time', return_value=105.0):
+      sampler.sample()
+    self.assertEqual(list(sampler.counters.keys()), ['sda'])
+    with patch('time.time',
+               return_value=100.0 + blklatency.DEV_SCAN_INTERVAL):
+      sampler.sample()
+    self.assertEqual(sorted(sampler.counters.keys()), ['sda', 'sdb'])
+    sampler.reader.close()
+
+if __name__ == '__main__':
+  suite = unittest.TestLoader().loadTestsFromTestCase(TestBlklatency)
+  unittest.TextTestRunner(verbosity=2).run(suite)
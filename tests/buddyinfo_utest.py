@@ -74,6 +74,40 @@ class TestBuddyinfo(unittest.TestCase):
     collectdValues.assert_called_once()
     self.assertTrue(len(buddyinfo.stats_cache) > 0, 'at least one udp counter')
 
+  def test_4_buddyinfo_fragmentation(self):
+    # 4K pages: 4*1 + 2*2 + 1*4 + 1*8 = 20
+    cur = [4, 2, 1, 1]
+    self.assertEqual(buddyinfo.get_total_free_pages(cur), 20, 'total pages')
+    self.assertEqual(buddyinfo.get_unusable_index(cur, 0), 0.0,
+                     'all free memory usable at order 0')
+    self.assertEqual(buddyinfo.get_unusable_index(cur, 3), 12.0 / 20,
+                     'only the order 3 block usable at order 3')
+    self.assertEqual(buddyinfo.get_unusable_index([0, 0, 0, 0], 1), 1.0,
+                     'no free memory')
+
+    buddyinfo.fragment_orders = [3, 9]
+    names, vals = buddyinfo.calc_zone_metrics(cur, None, 0)
+    self.assertEqual(names[:3], ['total_free_pages', 'pct_fragment_32K',
+                                 'total_free_pages_per_sec'],
+                     'orders beyond the zone are skipped')
+    self.assertEqual(vals, [20, 100.0 * 12 / 20] + [None] * 5,
+                     'no rates without a previous snapshot')
+
+    names, vals = buddyinfo.calc_zone_metrics(cur, [0, 2, 3, 1], 2.0)
+    metrics = dict(zip(names, vals))
+    self.assertEqual(metrics['total_free_pages_per_sec'], -2.0,
+                     'total free pages rate')
+    self.assertEqual([metrics['free_pages_%dK_per_sec' % (4*2**i)]
+                      for i in range(4)], [2.0, 0.0, -1.0, 0.0],
+                     'per order rates')
+
+  def test_5_buddyinfo_swap_cache(self):
+    buddyinfo.stats_cache = {('0', 'Normal', 'val'): [1]}
+    buddyinfo.stats_current = {('0', 'Normal', 'val'): [2]}
+    buddyinfo.swap_current_cache()
+    self.assertEqual(buddyinfo.stats_cache[('0', 'Normal', 'val')], [2],
+                     'cache advanced')
+
 if __name__ == '__main__':
   suite = unittest.TestLoader().loadTestsFromTestCase(TestBuddyinfo)
   unittest.TextTestRunner(verbosity=2).run(suite)
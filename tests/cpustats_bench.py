@@ -0,0 +1,86 @@
+#!/usr/bin/python
+
+##########################################################################
+# Copyright (c) 2015, Salesforce.com, Inc.
+# All rights reserved.
+#
+# Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#
+# Neither the name of Salesforce.com nor the names of its
+# contributors may be used to endorse or promote products
+# derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+##########################################################################
+
+"""
+Micro-benchmark for the cpustats interrupt matrix on a synthetic
+/proc/interrupts of a large host, e.g.:
+
+    python cpustats_bench.py 192 300
+
+Each iteration parses an in-memory snapshot, computes the rates of all
+cells against the previous one and selects the top 10 cells.
+"""
+
+import sys
+import os
+import random
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../plugins"))
+import cpustats
+
+def make_interrupts(cpus, irqs, seed):
+    rnd = random.Random(seed)
+    lines = [' ' * 11 + ''.join('CPU%-8d' % (c) for c in range(cpus))]
+    for irq in range(irqs):
+        counts = ''.join('%11d' % (rnd.randint(0, 2**31)) for c in range(cpus))
+        lines.append('%4d:%s  PCI-MSI %d-edge      eth0-TxRx-%d' %
+                     (irq, counts, irq, irq))
+    lines.append('ERR:%11d' % (0))
+    return '\n'.join(lines) + '\n'
+
+def main():
+    cpus = int(sys.argv[1]) if len(sys.argv) > 1 else 192
+    irqs = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+    iterations = 20
+    texts = [make_interrupts(cpus, irqs, i) for i in range(2)]
+    matrix = cpustats.CounterMatrix(cpustats.COUNTER_WRAP)
+
+    parse = 0.0
+    rates = 0.0
+    for i in range(iterations):
+        start = time.time()
+        rows, cols, vals = cpustats.parse_cpu_matrix(texts[i % 2])
+        matrix.update(rows, cols, vals, float(i))
+        parse += time.time() - start
+        start = time.time()
+        cell_rates = matrix.rates()
+        if cell_rates is not None:
+            cpustats.select_cells(cell_rates, 10, 0)
+        rates += time.time() - start
+    print('%d cpus x %d irqs: %d cells' % (cpus, irqs, len(vals)))
+    print('%-16s %10.2f msec/interval' % ('parse', parse * 1e3 / iterations))
+    print('%-16s %10.2f msec/interval' % ('rates + top 10',
+                                          rates * 1e3 / (iterations - 1)))
+
+if __name__ == "__main__":
+    main()
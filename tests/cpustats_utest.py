@@ -0,0 +1,201 @@
+#!/usr/bin/python
+
+##########################################################################
+# Copyright (c) 2015, Salesforce.com, Inc.
+# All rights reserved.
+#
+# Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#
+# Neither the name of Salesforce.com nor the names of its
+# contributors may be used to endorse or promote products
+# derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+##########################################################################
+
+############################################################
+# Unit test for cpustats plugin
+############################################################
+
+import os
+import sys
+import unittest
+
+from mock import Mock, patch
+
+import collectd
+sys.path.append(os.path.join(os.path.dirname(__file__), "../plugins"))
+import cpustats
+
+MOCKS = os.path.abspath(os.path.join(os.path.dirname(__file__), 'mocks'))
+PROCFS_STAT_6X = os.path.join(MOCKS, 'proc_stat_6x')
+PROCFS_SOFTIRQS_6X = os.path.join(MOCKS, 'proc_softirqs_6x')
+PROCFS_INTERRUPTS_6X = os.path.join(MOCKS, 'proc_interrupts_6x')
+
+STAT = '''cpu  400 0 200 1200 100 0 100 0 0 0
+cpu0 300 0 100 500 50 0 50 0 0 0
+cpu1 100 0 100 700 50 0 50 0 0 0
+intr 12345 0 0
+ctxt 67890
+'''
+
+# 2.6 kernels have no steal, guest and guest_nice fields
+STAT_26 = '''cpu  400 0 200 1200 100 0 100
+cpu0 400 0 200 1200 100 0 100
+'''
+
+INTERRUPTS = '''           CPU0       CPU1       CPU2
+  0:         36          0          0   IO-APIC   2-edge      timer
+ 24:       1000          0          0  PCI-MSI 524288-edge      eth0-TxRx-0
+ 25:          0        500         10  PCI-MSI 524289-edge      eth0-TxRx-1
+NMI:          1          2          3   Non-maskable interrupts
+LOC:       5000       4000       3000   Local timer interrupts
+ERR:          0
+MIS:          0
+'''
+
+class TestCpustats(unittest.TestCase):
+  def setUp(self):
+    cpustats.STAT_FNAME = PROCFS_STAT_6X
+    cpustats.SOFTIRQS_FNAME = PROCFS_SOFTIRQS_6X
+    cpustats.INTERRUPTS_FNAME = PROCFS_INTERRUPTS_6X
+
+  def test_1_cpustats_parse_stat(self):
+    rows, cols, vals = cpustats.parse_stat(STAT)
+    self.assertEqual(rows, ['all', 'cpu0', 'cpu1'])
+    self.assertEqual(cols, cpustats.stat_fields)
+    self.assertEqual(len(vals), 3 * len(cpustats.stat_fields))
+    self.assertEqual(vals[10:14], [300, 0, 100, 500])
+
+    rows, cols, vals = cpustats.parse_stat(STAT_26)
+    self.assertEqual(len(vals), 2 * len(cpustats.stat_fields))
+    self.assertEqual(vals[7:10], [0, 0, 0], 'missing fields padded')
+
+  def test_2_cpustats_parse_interrupts(self):
+    rows, cols, vals = cpustats.parse_cpu_matrix(INTERRUPTS)
+    self.assertEqual(cols, ['cpu0', 'cpu1', 'cpu2'])
+    self.assertEqual(rows, ['0_timer', '24_eth0-TxRx-0', '25_eth0-TxRx-1',
+                            'NMI', 'LOC', 'ERR', 'MIS'])
+    self.assertEqual(len(vals), len(rows) * len(cols))
+    self.assertEqual(vals[6:9], [0, 500, 10])
+    self.assertEqual(vals[15:18], [0, 0, 0], 'ERR padded')
+
+    for fname in (PROCFS_SOFTIRQS_6X, PROCFS_INTERRUPTS_6X):
+      with open(fname) as f:
+        rows, cols, vals = cpustats.parse_cpu_matrix(f.read())
+      self.assertTrue(len(rows) > 0)
+      self.assertEqual(len(vals), len(rows) * len(cols))
+
+  def test_3_cpustats_utilization(self):
+    matrix = cpustats.CounterMatrix()
+    rows, cols, vals = cpustats.parse_stat(STAT)
+    matrix.update(rows, cols, vals, 100.0)
+    self.assertEqual(cpustats.calc_utilization(matrix), [])
+
+    # cpu0: +100 user +100 idle; cpu1: +50 system +150 idle
+    vals = list(vals)
+    vals[10] += 100
+    vals[13] += 100
+    vals[22] += 50
+    vals[23] += 150
+    vals[0] += 100
+    vals[2] += 50
+    vals[3] += 250
+    matrix.update(rows, cols, vals, 101.0)
+    util = dict((r, dict(zip(cpustats.cpu_metrics, v)))
+                for r, v in cpustats.calc_utilization(matrix))
+    self.assertEqual(util['cpu0']['pct_user'], 50.0)
+    self.assertEqual(util['cpu0']['pct_busy'], 50.0)
+    self.assertEqual(util['cpu1']['pct_system'], 25.0)
+    self.assertEqual(util['cpu1']['pct_busy'], 25.0)
+    self.assertEqual(util['all']['pct_idle'], 62.5)
+
+  def test_4_cpustats_rates(self):
+    matrix = cpustats.CounterMatrix(cpustats.COUNTER_WRAP)
+    matrix.update(['a', 'b'], ['cpu0', 'cpu1'], [10, 2**32 - 10, 0, 0], 10.0)
+    self.assertTrue(matrix.rates() is None)
+    matrix.update(['a', 'b'], ['cpu0', 'cpu1'], [30, 10, 0, 5], 12.0)
+    self.assertEqual(matrix.rates(), [10.0, 10.0, 0.0, 2.5],
+                     '32 bit counter wraps')
+
+    # a CPU went offline: no rates until the next interval
+    matrix.update(['a', 'b'], ['cpu0'], [40, 0], 14.0)
+    self.assertTrue(matrix.rates() is None)
+
+  def test_5_cpustats_select(self):
+    rates = [5.0, 0.0, 50.0, 20.0, 1.0]
+    self.assertEqual(cpustats.select_cells(rates, 2, 0), [2, 3])
+    self.assertEqual(cpustats.select_cells(rates, 0, 5.0), [2, 3, 0])
+    self.assertEqual(cpustats.select_cells(rates, 0, 0), [2, 3, 0, 4])
+
+  @patch('collectd.Values')
+  def test_6_cpustats_dispatch(self, collectdValues):
+    matrix = cpustats.CounterMatrix(cpustats.COUNTER_WRAP)
+    rows, cols, vals = cpustats.parse_cpu_matrix(INTERRUPTS)
+    matrix.update(rows, cols, vals, 10.0)
+    vals = list(vals)
+    vals[3] += 100    # 24 on cpu0
+    vals[7] += 40     # 25 on cpu1
+    vals[12] += 10    # LOC on cpu0
+    vals[13] += 20    # LOC on cpu1
+    matrix.update(rows, cols, vals, 20.0)
+
+    dispatched = []
+    def dispatch():
+      metric = collectdValues.return_value
+      dispatched.append((metric.plugin_instance, metric.type_instance,
+                         metric.values[0]))
+    collectdValues.return_value.dispatch.side_effect = dispatch
+    cpustats.dispatch_cpu_matrix(matrix, 'irq', 2, 0)
+    self.assertEqual(dispatched,
+                     [('cpu0', 'interrupts_per_sec', 11.0),
+                      ('cpu1', 'interrupts_per_sec', 6.0),
+                      ('cpu2', 'interrupts_per_sec', 0.0),
+                      ('irq', '24_eth0-TxRx-0_per_sec', 10.0),
+                      ('irq', '25_eth0-TxRx-1_per_sec', 4.0),
+                      ('cpu0', 'irq_24_eth0-TxRx-0_per_sec', 10.0),
+                      ('cpu1', 'irq_25_eth0-TxRx-1_per_sec', 4.0)])
+
+  @patch('collectd.Values')
+  def test_7_cpustats_collection(self, collectdValues):
+    cpustats.collect_cpustats()
+    cpustats.collect_cpustats()
+    self.assertEqual(cpustats.stat_matrix.rows, ['all', 'cpu0'])
+    self.assertTrue(cpustats.irq_matrix.rates() is not None)
+    cpustats.dispatch_metrics()
+    self.assertTrue(collectdValues.return_value.dispatch.call_count > 0)
+
+  def test_8_cpustats_rates_no_numpy(self):
+    with patch('cpustats.numpy', None):
+      matrix = cpustats.CounterMatrix(cpustats.COUNTER_WRAP)
+      matrix.update(['a', 'b'], ['cpu0', 'cpu1'], [10, 2**32 - 10, 0, 0],
+                    10.0)
+      matrix.update(['a', 'b'], ['cpu0', 'cpu1'], [30, 10, 0, 5], 12.0)
+      self.assertEqual(matrix.rates(), [10.0, 10.0, 0.0, 2.5])
+      self.assertEqual(matrix.deltas(), [20, 20, 0, 5])
+
+      matrix = cpustats.CounterMatrix()
+      matrix.update(['cpu'], ['user', 'idle'], [100, 50], 10.0)
+      matrix.update(['cpu'], ['user', 'idle'], [150, 40], 11.0)
+      self.assertEqual(matrix.deltas(), [50, 0], '64 bit counters clip')
+
+if __name__ == '__main__':
+  suite = unittest.TestLoader().loadTestsFromTestCase(TestCpustats)
+  unittest.TextTestRunner(verbosity=2).run(suite)
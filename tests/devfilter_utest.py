@@ -0,0 +1,75 @@
+#!/usr/bin/python
+
+##########################################################################
+# Copyright (c) 2015, Salesforce.com, Inc.
+# All rights reserved.
+#
+# Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#
+# Neither the name of Salesforce.com nor the names of its
+# contributors may be used to endorse or promote products
+# derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+##########################################################################
+
+############################################################
+# Unit test for devfilter module
+############################################################
+
+import os
+import sys
+import unittest
+
+from mock import Mock
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../plugins"))
+import devfilter
+
+class TestDevfilter(unittest.TestCase):
+  def test_1_devfilter_include_exclude(self):
+    default = Mock(return_value=True)
+    dev_filter = devfilter.DeviceFilter(['^sd[a-z]+$', '^sd', '!^sdz$'],
+                                        default)
+    self.assertTrue(dev_filter.match('sda'))
+    self.assertTrue(dev_filter.match('sda1'))
+    self.assertFalse(dev_filter.match('sdz'))
+    self.assertFalse(dev_filter.match('nvme0n1'))
+    self.assertFalse(default.called, 'no default with include patterns')
+
+  def test_2_devfilter_default(self):
+    default = Mock(side_effect=lambda dev: not dev.startswith('loop'))
+    dev_filter = devfilter.DeviceFilter(['!^sdb$'], default)
+    self.assertEqual([d for d in ['sda', 'sdb', 'loop0']
+                      if dev_filter.match(d)], ['sda'])
+    self.assertEqual(dev_filter.match('sda'), True)
+    self.assertEqual(default.call_count, 3, 'decisions memoized')
+    dev_filter.clear()
+    dev_filter.match('sda')
+    self.assertEqual(default.call_count, 4)
+
+    dev_filter = devfilter.DeviceFilter(None, default)
+    self.assertTrue(dev_filter.match('sdb'))
+    self.assertTrue(devfilter.DeviceFilter([''], default).match('loop0'),
+                    'an empty pattern matches all devices')
+
+if __name__ == '__main__':
+  suite = unittest.TestLoader().loadTestsFromTestCase(TestDevfilter)
+  unittest.TextTestRunner(verbosity=2).run(suite)
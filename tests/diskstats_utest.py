@@ -34,8 +34,11 @@
 # Unit test for diskstatss plugin
 ############################################################
 
+import array
 import os
+import shutil
 import sys
+import tempfile
 import unittest
 
 from mock import Mock, patch
@@ -153,6 +156,366 @@ class TestDiskstats(unittest.TestCase):
                        [diskstats.dev_stats_current[(i,k)] for k in st_names],
                        'prev and curr dev stats should be same')
 
+  def test_5_diskstats_line_index(self):
+    lines = ['   8       0 sda 10 2 30 4 5 6 7 8 9 10 11\n',
+             '   8       1 sda1 1 2 3 4 5 6 7 8 9 10 11\n',
+             '   8      16 sdb 20 2 3 4 5 6 7 8 9 10 11\n']
+    fd, fname = tempfile.mkstemp()
+    os.close(fd)
+    try:
+      with open(fname, 'w') as f:
+        f.writelines(lines)
+      diskstats.DISKSTATS_FNAME = fname
+      diskstats.dev_list = ['sda', 'sdb']
+      stats = diskstats.collect_diskstats()
+      self.assertEqual(diskstats.dev_index,
+                       [(0, 'sda', b'sda'), (2, 'sdb', b'sdb')],
+                       'partitions should not match their disk')
+      self.assertEqual(stats[('sda', 'reads_completed')], 10)
+      self.assertEqual(len(stats), (len(diskstats.raw_field_names) + 1) * 2)
+
+      # same line count, different order
+      with open(fname, 'w') as f:
+        f.writelines(reversed(lines))
+      stats = diskstats.collect_diskstats()
+      self.assertEqual(diskstats.dev_index,
+                       [(0, 'sdb', b'sdb'), (2, 'sda', b'sda')],
+                       'index should follow reordered devices')
+      self.assertEqual(stats[('sdb', 'reads_completed')], 20)
+    finally:
+      os.remove(fname)
+      diskstats.DISKSTATS_FNAME = PROCFS_DISKSTAT
+
+  def test_6_diskstats_batch_metrics(self):
+    prev = ['   8       0 sda 100 0 800 50 200 0 1600 100 0 120 150\n',
+            '   8      16 sdb 100 0 800 50 200 0 1600 100 0 120 150\n',
+            '   8      32 sdc 100 0 800 50 200 0 1600 100 0 120 150\n']
+    curr = ['   8       0 sda 150 0 1200 80 260 0 2000 160 1 620 900\n',
+            '   8      16 sdb 100 0 800 50 200 0 1600 100 0 120 150\n',
+            '   8      32 sdc 90 0 800 50 250 0 1700 90 0 170 100\n']
+    fd, fname = tempfile.mkstemp()
+    os.close(fd)
+    try:
+      diskstats.DISKSTATS_FNAME = fname
+      diskstats.dev_list = ['sda', 'sdb', 'sdc', 'sdd']
+      with open(fname, 'w') as f:
+        f.writelines(prev)
+      diskstats.init_dev_snaps()
+      diskstats.dev_stats_cache = diskstats.collect_diskstats()
+      with open(fname, 'w') as f:
+        f.writelines(curr)
+      diskstats.dev_snap_current_ts = diskstats.collect_diskstats_snap(
+          diskstats.dev_snap_current)
+      diskstats.dev_stats_current = diskstats.collect_diskstats()
+      for dev in diskstats.dev_list[:3]:
+        diskstats.dev_stats_cache[(dev, 'ts')] = diskstats.dev_snap_cache_ts
+        diskstats.dev_stats_current[(dev, 'ts')] = diskstats.dev_snap_current_ts
+
+      batch = diskstats.calc_metrics_batch()
+      self.assertEqual(len(batch), len(diskstats.dev_list))
+      for row, dev in enumerate(diskstats.dev_list[:3]):
+        metrics = diskstats.calc_metrics(dev)
+        for k, v in zip(diskstats.diskstat_metrics, batch[row]):
+          if metrics[k] is None:
+            self.assertEqual(v, None, '%s %s should be None' % (dev, k))
+          else:
+            self.assertAlmostEqual(metrics[k], v, 6, '%s %s' % (dev, k))
+      self.assertEqual(batch[3], [None] * len(diskstats.diskstat_metrics),
+                       'missing device should not have metrics')
+      self.assertEqual(diskstats.get_snap_row(diskstats.dev_snap_current, 3),
+                       [None] * diskstats.NR_RAW_FIELDS)
+    finally:
+      os.remove(fname)
+      diskstats.DISKSTATS_FNAME = PROCFS_DISKSTAT
+
+  def test_7_diskstats_counter_wrap(self):
+    wrap = 2 ** 32
+    prev = dict(zip(diskstats.raw_field_names,
+                    [100, 0, 800, wrap - 100, 200, 0, 1600, 100, 0,
+                     wrap - 500, wrap - 1000]))
+    curr = dict(zip(diskstats.raw_field_names,
+                    [150, 0, 1200, 50, 260, 0, 2000, 160, 0, 500, 1000]))
+    diskstats.init_counter_widths()
+    diskstats.dev_stats_cache = dict(((('sdx', k), v) for k, v in prev.items()))
+    diskstats.dev_stats_current = dict(((('sdx', k), v) for k, v in curr.items()))
+    diskstats.dev_stats_cache[('sdx', 'ts')] = 0.0
+    diskstats.dev_stats_current[('sdx', 'ts')] = 10.0
+
+    metrics = diskstats.calc_metrics('sdx')
+    self.assertAlmostEqual(metrics['await_read'], 0.150 / 50)
+    self.assertAlmostEqual(metrics['util_pct'], 100.0 * 1.0 / 10.0)
+    self.assertAlmostEqual(metrics['avgqu_sz'], 2.0 / 10.0)
+
+    # a counter reset is not a wrap
+    diskstats.dev_stats_cache[('sdx', 'io_time_ms')] = 1000000
+    metrics = diskstats.calc_metrics('sdx')
+    self.assertEqual(metrics['util_pct'], None, 'reset counter is not a wrap')
+
+    # inflight_ios is a gauge: a drop does not take the wrap path
+    self.assertEqual(diskstats.counter_bits[diskstats.F_INFLIGHT],
+                     diskstats.get_kernel_word_size())
+    pre = [100, 0, 800, 50, 200, 0, 1600, 100, 8, 120, 150]
+    cur = [150, 0, 1200, 80, 260, 0, 2000, 160, 1, 620, 900]
+    try:
+      diskstats.dev_snap_cache_ts = 0.0
+      diskstats.dev_snap_current_ts = 10.0
+      if diskstats.numpy is not None:
+        diskstats.dev_snap_cache = diskstats.numpy.array([pre], dtype=float)
+        diskstats.dev_snap_current = diskstats.numpy.array([cur], dtype=float)
+        with patch('diskstats.counter_delta_numpy') as delta:
+          metrics = diskstats.calc_metrics_batch()
+        self.assertFalse(delta.called)
+      with patch('diskstats.numpy', None):
+        diskstats.dev_snap_cache = array.array('d', pre)
+        diskstats.dev_snap_current = array.array('d', cur)
+        with patch('diskstats.counter_delta') as delta:
+          metrics = diskstats.calc_metrics_batch()
+        self.assertFalse(delta.called)
+      self.assertAlmostEqual(metrics[0][0], 5.0, msg='iops_read')
+    finally:
+      diskstats.dev_snap_cache = None
+      diskstats.dev_snap_current = None
+
+  def test_8_diskstats_discard_flush_fields(self):
+    # 5.5+ layout: 4 discard and 2 flush fields
+    prev = ['   259     0 nvme0n1 100 0 800 50 200 0 1600 100 0 120 150 '
+            '10 0 2048 20 40 80\n',
+            '   259     1 nvme0n2 100 0 800 50 200 0 1600 100 0 120 150 '
+            '10 0 2048 20 40 80\n']
+    curr = ['   259     0 nvme0n1 150 0 1200 80 260 0 2000 160 1 620 900 '
+            '30 0 6144 60 90 130\n',
+            '   259     1 nvme0n2 100 0 800 50 200 0 1600 100 0 120 150 '
+            '10 0 2048 20 40 80\n']
+    fd, fname = tempfile.mkstemp()
+    os.close(fd)
+    try:
+      diskstats.DISKSTATS_FNAME = fname
+      diskstats.dev_list = ['nvme0n1', 'nvme0n2']
+      with open(fname, 'w') as f:
+        f.writelines(prev)
+      self.assertEqual(diskstats.detect_raw_fields(
+        diskstats.read_diskstats_lines()), 17)
+      self.assertEqual(diskstats.raw_field_names[-1], 'time_spent_flushing_ms')
+      diskstats.init_dev_snaps()
+      diskstats.dev_stats_cache = diskstats.collect_diskstats()
+      with open(fname, 'w') as f:
+        f.writelines(curr)
+      diskstats.dev_snap_current_ts = diskstats.collect_diskstats_snap(
+          diskstats.dev_snap_current)
+      diskstats.dev_stats_current = diskstats.collect_diskstats()
+      self.assertEqual(diskstats.dev_stats_current[('nvme0n1',
+                                                    'sectors_discarded')],
+                       6144)
+      diskstats.dev_stats_cache[('nvme0n1', 'ts')] = 0.0
+      diskstats.dev_stats_current[('nvme0n1', 'ts')] = 10.0
+      metrics = diskstats.calc_metrics('nvme0n1')
+      self.assertAlmostEqual(metrics['iops_discard'], 2.0)
+      self.assertAlmostEqual(metrics['bytes_ps_discard'], 4096 * 512 / 10.0)
+      self.assertAlmostEqual(metrics['await_discard'], 0.040 / 20)
+      self.assertAlmostEqual(metrics['iops_flush'], 5.0)
+      self.assertAlmostEqual(metrics['await_flush'], 0.050 / 50)
+
+      diskstats.dev_snap_cache_ts = 0.0
+      diskstats.dev_snap_current_ts = 10.0
+      batch = diskstats.calc_metrics_batch()
+      for k, v in zip(diskstats.diskstat_metrics, batch[0]):
+        if metrics[k] is None:
+          self.assertEqual(v, None, '%s should be None' % (k))
+        else:
+          self.assertAlmostEqual(metrics[k], v, 6, k)
+      self.assertEqual(batch[1][-5:], [0.0, 0.0, None, 0.0, None],
+                       'idle device')
+
+      # 4.18+ layout: no flush fields
+      with open(fname, 'w') as f:
+        f.writelines([' '.join(l.split()[:-2]) + '\n' for l in curr])
+      self.assertEqual(diskstats.detect_raw_fields(
+        diskstats.read_diskstats_lines()), 15)
+      diskstats.dev_stats_current = diskstats.collect_diskstats()
+      diskstats.dev_stats_current[('nvme0n1', 'ts')] = 10.0
+      metrics = diskstats.calc_metrics('nvme0n1')
+      self.assertAlmostEqual(metrics['iops_discard'], 2.0)
+      self.assertEqual(metrics['iops_flush'], None, 'no flush fields')
+    finally:
+      diskstats.set_raw_fields(11)
+      os.remove(fname)
+      diskstats.DISKSTATS_FNAME = PROCFS_DISKSTAT
+
+  def test_9_diskstats_topology(self):
+    sys_block = tempfile.mkdtemp()
+    def add_dev(dev, parts=(), slaves=(), holders=()):
+      os.makedirs(os.path.join(sys_block, dev, 'slaves'))
+      os.makedirs(os.path.join(sys_block, dev, 'holders'))
+      for part in parts:
+        os.makedirs(os.path.join(sys_block, dev, part, 'holders'))
+        open(os.path.join(sys_block, dev, part, 'partition'), 'w').close()
+      for slave in slaves:
+        os.mkdir(os.path.join(sys_block, dev, 'slaves', slave))
+      for holder in holders:
+        os.mkdir(os.path.join(sys_block, dev, 'holders', holder))
+
+    try:
+      # LVM volume dm-0 on md0 (RAID1 of sda1, sdb1); md2 on sda2, sdb2;
+      # md1 on sdc, sdd
+      add_dev('sda', parts=['sda1', 'sda2'])
+      add_dev('sdb', parts=['sdb1', 'sdb2'])
+      add_dev('sdc', holders=['md1'])
+      add_dev('sdd', holders=['md1'])
+      add_dev('md0', slaves=['sda1', 'sdb1'], holders=['dm-0'])
+      add_dev('dm-0', slaves=['md0'])
+      add_dev('md1', slaves=['sdc', 'sdd'])
+      add_dev('md2', slaves=['sda2', 'sdb2'])
+      diskstats.SYS_BLOCK_DIR = sys_block
+      diskstats.build_topology()
+      self.assertEqual(diskstats.volume_members,
+                       {'dm-0': ['sda1', 'sdb1'], 'md1': ['sdc', 'sdd'],
+                        'md2': ['sda2', 'sdb2']},
+                       'partitions are members, not their disks')
+
+      diskstats.batch_mode = False
+      diskstats.init_counter_widths()
+      pre = [100, 0, 800, 50, 200, 0, 1600, 100, 0, 100, 150]
+      cur = {'sda1': [150, 0, 1200, 80, 300, 0, 2400, 200, 0, 600, 650],
+             'sdb1': [140, 0, 1100, 90, 300, 0, 2400, 300, 0, 400, 750],
+             'sda2': [900, 0, 9000, 900, 900, 0, 9000, 900, 0, 900, 900]}
+      diskstats.dev_stats_cache = {}
+      diskstats.dev_stats_current = {}
+      for dev in ['sda1', 'sdb1', 'sda2', 'sdc']:
+        for k, v in zip(diskstats.raw_field_names, pre):
+          diskstats.dev_stats_cache[(dev, k)] = v
+        diskstats.dev_stats_cache[(dev, 'ts')] = 0.0
+      for dev, vals in cur.items():
+        for k, v in zip(diskstats.raw_field_names, vals):
+          diskstats.dev_stats_current[(dev, k)] = v
+        diskstats.dev_stats_current[(dev, 'ts')] = 10.0
+
+      metrics = dict(zip(diskstats.diskstat_metrics,
+                         diskstats.calc_rollup_metrics(
+                           diskstats.volume_members['dm-0'])))
+      self.assertAlmostEqual(metrics['iops_read'], 9.0)
+      self.assertAlmostEqual(metrics['iops_write'], 20.0)
+      self.assertAlmostEqual(metrics['await_write'], 0.3 / 200)
+      self.assertAlmostEqual(metrics['util_pct'], 100.0 * 0.4 / 10.0,
+                             msg='mean utilization of the members')
+      self.assertEqual(diskstats.calc_rollup_metrics(['sdc', 'sdd']), None,
+                       'members not in the current read')
+    finally:
+      diskstats.SYS_BLOCK_DIR = '/sys/block'
+      diskstats.batch_mode = True
+      diskstats.volume_members.clear()
+      shutil.rmtree(sys_block)
+
+  def test_10_diskstats_hotplug(self):
+    def line(major, minor, dev, reads):
+      return '%4d %7d %s %d 0 800 50 200 0 1600 100 0 120 150\n' % (
+        major, minor, dev, reads)
+    fd, fname = tempfile.mkstemp()
+    os.close(fd)
+    try:
+      diskstats.DISKSTATS_FNAME = fname
+      diskstats.device_filter_regexes = ['^sd[a-z]+$']
+      diskstats.dev_list = []
+      with open(fname, 'w') as f:
+        f.writelines([line(8, 0, 'sda', 100), line(8, 16, 'sdb', 100)])
+      diskstats.get_dev_list()
+      diskstats.init_dev_snaps()
+      diskstats.init_dev_fingerprint()
+      self.assertEqual(diskstats.dev_list, ['sda', 'sdb'])
+
+      # sdb pulled, sdc inserted: same number of lines
+      with open(fname, 'w') as f:
+        f.writelines([line(8, 0, 'sda', 200), line(8, 32, 'sdc', 5000)])
+      diskstats.dev_snap_current_ts = diskstats.collect_diskstats_snap(
+        diskstats.dev_snap_current)
+      self.assertEqual(diskstats.dev_list, ['sda', 'sdc'])
+      self.assertEqual(diskstats.dev_rows, {'sda': 0, 'sdc': 1})
+      diskstats.dev_snap_current_ts = diskstats.dev_snap_cache_ts + 10.0
+      metrics = diskstats.calc_metrics_batch()
+      self.assertAlmostEqual(metrics[0][0], 10.0, msg='sda kept its cache')
+      self.assertEqual(metrics[1], [None] * len(diskstats.diskstat_metrics),
+                       'no rates for sdc until its baseline is cached')
+      diskstats.swap_current_snap()
+
+      with open(fname, 'w') as f:
+        f.writelines([line(8, 0, 'sda', 200), line(8, 32, 'sdc', 5100)])
+      diskstats.collect_diskstats_snap(diskstats.dev_snap_current)
+      diskstats.dev_snap_current_ts = diskstats.dev_snap_cache_ts + 10.0
+      metrics = diskstats.calc_metrics_batch()
+      self.assertAlmostEqual(metrics[1][0], 10.0, msg='sdc from its baseline')
+      diskstats.swap_current_snap()
+
+      # per-device mode: a new device is skipped until it has a cache
+      diskstats.batch_mode = False
+      diskstats.dev_stats_cache = diskstats.collect_diskstats()
+      with open(fname, 'w') as f:
+        f.writelines([line(8, 0, 'sda', 300), line(8, 32, 'sdc', 5100),
+                      line(8, 48, 'sdd', 10)])
+      with patch('diskstats.dispatch_metrics') as dispatch:
+        diskstats.reader()
+      self.assertEqual(diskstats.dev_list, ['sda', 'sdc', 'sdd'])
+      self.assertEqual([c[0][:2] for c in dispatch.call_args_list],
+                       [('sda', 'diskstats_raw'), ('sda', 'diskstats'),
+                        ('sdc', 'diskstats_raw'), ('sdc', 'diskstats'),
+                        ('sdd', 'diskstats_raw')])
+      self.assertTrue(('sdd', 'ts') in diskstats.dev_stats_cache)
+
+      # Hotplug false: a removed device is skipped and reported once
+      diskstats.hotplug_enabled = False
+      with open(fname, 'w') as f:
+        f.writelines([line(8, 0, 'sda', 400), line(8, 48, 'sdd', 20)])
+      with patch('diskstats.dispatch_metrics') as dispatch:
+        with patch('collectd.error') as error:
+          diskstats.reader()
+          diskstats.reader()
+      self.assertEqual(diskstats.dev_list, ['sda', 'sdc', 'sdd'])
+      self.assertEqual(error.call_count, 1)
+      self.assertTrue('sdc' in error.call_args[0][0])
+      self.assertFalse('sdc' in [c[0][0] for c in dispatch.call_args_list])
+    finally:
+      diskstats.batch_mode = True
+      diskstats.hotplug_enabled = True
+      diskstats.dev_fingerprint = None
+      diskstats.dev_list = []
+      os.remove(fname)
+      diskstats.DISKSTATS_FNAME = PROCFS_DISKSTAT
+
+  def test_11_diskstats_device_filter(self):
+    lines = ['   8       0 sda 1 0 8 1 1 0 8 1 0 1 2',
+             '   8       1 sda1 1 0 8 1 1 0 8 1 0 1 2',
+             '   8      16 sdb 1 0 8 1 1 0 8 1 0 1 2',
+             '   8     400 sdz 1 0 8 1 1 0 8 1 0 1 2',
+             '   7       0 loop0 1 0 8 1 1 0 8 1 0 1 2',
+             ' 253       0 dm-0 1 0 8 1 1 0 8 1 0 1 2',
+             ' 252       0 fioa 1 0 8 1 1 0 8 1 0 1 2']
+    try:
+      diskstats.topology_enabled = False
+      diskstats.device_filter_regexes = ['^sd[a-z]+$', '^sd', '!^sdz$']
+      self.assertEqual(diskstats.select_dev_list(lines), ['sda', 'sda1', 'sdb'],
+                       'a device matching several patterns is listed once')
+      self.assertEqual(diskstats.device_filter.cache['sdz'], False)
+      self.assertEqual(diskstats.device_filter.cache['fioa'], False)
+
+      diskstats.device_filter_regexes = ['!^sd']
+      self.assertEqual(diskstats.select_dev_list(lines), ['fioa'],
+                       'excludes apply to the default selection')
+      diskstats.topology_enabled = True
+      self.assertEqual(diskstats.select_dev_list(lines), ['dm-0', 'fioa'])
+
+      diskstats.device_filter_regexes = None
+      self.assertEqual(diskstats.select_dev_list(lines),
+                       ['sda', 'sda1', 'sdb', 'sdz', 'dm-0', 'fioa'])
+      diskstats.topology_enabled = False
+      self.assertEqual(diskstats.select_dev_list(lines),
+                       ['sda', 'sdb', 'sdz', 'fioa'])
+
+      # decisions are memoized per device name
+      diskstats.device_filter.default = Mock()
+      diskstats.select_dev_list(lines)
+      self.assertFalse(diskstats.device_filter.default.called)
+    finally:
+      diskstats.topology_enabled = False
+      diskstats.device_filter_regexes = []
+
 if __name__ == '__main__':
   suite = unittest.TestLoader().loadTestsFromTestCase(TestDiskstats)
   unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,139 @@
+#!/usr/bin/python
+
+##########################################################################
+# Copyright (c) 2015, Salesforce.com, Inc.
+# All rights reserved.
+#
+# Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#
+# Neither the name of Salesforce.com nor the names of its
+# contributors may be used to endorse or promote products
+# derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+##########################################################################
+
+############################################################
+# Unit test for dispatcher module
+############################################################
+
+import math
+import os
+import sys
+import unittest
+
+from mock import Mock, patch
+
+import collectd
+sys.path.append(os.path.join(os.path.dirname(__file__), "../plugins"))
+import dispatcher
+
+DS_NAMES = ['iops_read', 'iops_write', 'util_pct']
+DATASET = [(n, 1, 0.0, float('nan')) for n in DS_NAMES]
+
+class TestDispatcher(unittest.TestCase):
+  def setUp(self):
+    self.dispatcher = dispatcher.Dispatcher('diskstats_telemetry', 'localhost')
+    self.dispatcher.register_type('diskstats', DS_NAMES)
+
+  @patch('collectd.Values')
+  def test_1_dispatcher_per_value(self, collectdValues):
+    self.dispatcher.add('sda', 'diskstats', DS_NAMES, [1.0, None, 3.0])
+    self.dispatcher.flush()
+
+    metric = collectdValues.return_value
+    self.assertEqual(metric.dispatch.call_count, 2, 'None is not dispatched')
+    self.assertEqual(metric.type, 'gauge')
+    self.assertEqual(metric.type_instance, 'util_pct')
+    self.assertEqual(metric.values, [3.0])
+
+  @patch('collectd.Values')
+  def test_2_dispatcher_metric_filter(self, collectdValues):
+    self.dispatcher.set_metric_filter(['iops_read'])
+    self.dispatcher.add('sda', 'diskstats', DS_NAMES, [1.0, 2.0, 3.0])
+
+    metric = collectdValues.return_value
+    self.assertEqual(metric.dispatch.call_count, 1)
+    self.assertEqual(metric.type_instance, 'iops_read')
+
+  @patch('collectd.get_dataset', create=True)
+  @patch('collectd.Values')
+  def test_3_dispatcher_batch(self, collectdValues, get_dataset):
+    get_dataset.return_value = DATASET
+    self.dispatcher.set_batch(True)
+    self.dispatcher.add('sda', 'diskstats', DS_NAMES[:2], [1.0, None])
+    self.dispatcher.add('sda', 'diskstats', DS_NAMES[2:], [3.0])
+    self.dispatcher.add('sdb', 'diskstats', DS_NAMES, [4.0, 5.0, 6.0])
+    metric = collectdValues.return_value
+    self.assertEqual(metric.dispatch.call_count, 0, 'dispatched before flush')
+
+    records = {}
+    def record():
+      records[metric.plugin_instance] = (metric.type, list(metric.values))
+    metric.dispatch.side_effect = record
+    self.dispatcher.flush()
+
+    self.assertEqual(metric.dispatch.call_count, 2, 'one record per device')
+    self.assertEqual(records['sdb'], ('diskstats', [4.0, 5.0, 6.0]))
+    self.assertEqual(records['sda'][1][0], 1.0)
+    self.assertTrue(math.isnan(records['sda'][1][1]), 'None is sent as NaN')
+    self.assertEqual(records['sda'][1][2], 3.0)
+
+  @patch('collectd.get_dataset', create=True)
+  @patch('collectd.Values')
+  def test_4_dispatcher_unknown_type(self, collectdValues, get_dataset):
+    get_dataset.side_effect = TypeError('unknown type')
+    self.dispatcher.set_batch(True)
+    self.dispatcher.add('sda', 'diskstats', DS_NAMES, [1.0, 2.0, 3.0])
+
+    metric = collectdValues.return_value
+    self.assertEqual(metric.dispatch.call_count, 3,
+                     'unknown types fall back to per-value dispatch')
+
+  @patch('collectd.error')
+  @patch('collectd.get_dataset', create=True)
+  @patch('collectd.Values')
+  def test_5_dispatcher_flush_error(self, collectdValues, get_dataset, error):
+    get_dataset.return_value = DATASET
+    self.dispatcher.set_batch(True)
+    self.dispatcher.add('x' * 200, 'diskstats', DS_NAMES, [1.0, 2.0, 3.0])
+    self.dispatcher.add('sda', 'diskstats', DS_NAMES, [4.0, 5.0, 6.0])
+
+    dispatched = []
+    def record():
+      if len(metric.plugin_instance) >= 128:
+        raise ValueError('plugin_instance too long')
+      dispatched.append(metric.plugin_instance)
+    metric = collectdValues.return_value
+    metric.dispatch.side_effect = record
+    self.dispatcher.flush()
+
+    self.assertEqual(dispatched, ['sda'], 'other records are dispatched')
+    self.assertEqual(error.call_count, 1)
+    self.assertEqual(self.dispatcher.pending, {})
+
+    self.dispatcher.add('sdb', 'diskstats', DS_NAMES, [7.0, 8.0, 9.0])
+    self.dispatcher.flush()
+    self.assertEqual(dispatched, ['sda', 'sdb'],
+                     'a failed record is not dispatched again')
+
+if __name__ == '__main__':
+  suite = unittest.TestLoader().loadTestsFromTestCase(TestDispatcher)
+  unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,183 @@
+#!/usr/bin/python
+
+##########################################################################
+# Copyright (c) 2015, Salesforce.com, Inc.
+# All rights reserved.
+#
+# Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#
+# Neither the name of Salesforce.com nor the names of its
+# contributors may be used to endorse or promote products
+# derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+##########################################################################
+
+############################################################
+# Unit test for fusionio plugin
+############################################################
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+from mock import Mock, patch
+
+import collectd
+sys.path.append(os.path.join(os.path.dirname(__file__), "../plugins"))
+import fusionio
+
+FAKE_FIO_STATUS = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                               'mocks/fake_fio_status'))
+
+# Expected values for verifications
+FIO_STATS = {('fioa', 'phy_bytes_written'): 142512361233408,
+             ('fioa', 'phy_bytes_read'): 96208154116096,
+             ('fioa', 'erased_blocks_total'): 4020,
+             ('fioa', 'erased_blocks_min'): 1,
+             ('fioa', 'erased_blocks_max'): 12,
+             ('fioa', 'erased_blocks_avg'): 5}
+
+class TestFusionio(unittest.TestCase):
+  def setUp(self):
+    for k in ('FAKE_FIO_SLEEP', 'FAKE_FIO_FAIL', 'FAKE_FIO_CARDS'):
+      os.environ.pop(k, None)
+    fusionio.cmd_fio_status = FAKE_FIO_STATUS
+    fusionio.cmd_fio_get_erase_blocks = FAKE_FIO_STATUS
+    self.sampler = fusionio.FioSampler(['fioa'], 60, 5)
+
+    # fioa: groomer stats only; fiob: all counters in procfs
+    self.tmpdir = tempfile.mkdtemp()
+    fusionio.FIO_PROC_DIR = os.path.join(self.tmpdir, 'fio')
+    fusionio.SYS_BLOCK_DIR = os.path.join(self.tmpdir, 'block')
+    self.write('fio/fioa/data/groomer/stats', 'Blocks erased: 17\n')
+    self.write('fio/fioa/data/other', 'Nothing: here\n')
+    self.write('fio/fiob/data/groomer/stats', 'Blocks erased: 3\n')
+    self.write('fio/fiob/data/media/stats',
+               'Physical bytes written: 2,000\n'
+               'Physical bytes read   : 1,000\n'
+               'Total blocks: 4020\nMin: 2\nMax: 7\nAvg: 3.10\n')
+    self.write('block/fioa/stat',
+               '  100 0 2048 10 200 0 4096 20 0 30 30\n')
+
+  def tearDown(self):
+    for k in ('FAKE_FIO_SLEEP', 'FAKE_FIO_FAIL', 'FAKE_FIO_CARDS'):
+      os.environ.pop(k, None)
+    fusionio.stop_sampler()
+    fusionio.procreader.close_all()
+    fusionio.fio_devices.clear()
+    shutil.rmtree(self.tmpdir)
+
+  def write(self, path, text):
+    path = os.path.join(self.tmpdir, path)
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+      f.write(text)
+
+  def test_1_fusionio_parse_output(self):
+    out = fusionio.run_cmd([FAKE_FIO_STATUS, '-a'], 5)
+    self.assertEqual(fusionio.parse_output(out),
+                     {'phy_bytes_written': 142512361233408,
+                      'phy_bytes_read': 96208154116096},
+                     'physical bytes parsing error')
+
+  def test_2_fusionio_sample(self):
+    self.sampler.sample()
+    vals, ts = self.sampler.get_values()
+    self.assertEqual(vals, FIO_STATS, 'sampled values')
+    self.assertEqual(sorted(ts.keys()), sorted(FIO_STATS.keys()),
+                     'sample timestamps')
+
+  def test_3_fusionio_last_good_values(self):
+    self.sampler.sample()
+    os.environ['FAKE_FIO_FAIL'] = '1'
+    self.sampler.sample()
+    self.assertEqual(self.sampler.get_values()[0], FIO_STATS,
+                     'failed runs keep the last good values')
+
+  def test_4_fusionio_timeout(self):
+    os.environ['FAKE_FIO_SLEEP'] = '10'
+    self.sampler.timeout = 0.2
+    start = time.time()
+    self.sampler.sample()
+    self.assertTrue(time.time() - start < 5, 'hung tool killed')
+    self.assertEqual(self.sampler.get_values()[0], {}, 'no values')
+
+  def test_5_fusionio_multiple_cards(self):
+    os.environ['FAKE_FIO_CARDS'] = '2'
+    sampler = fusionio.FioSampler(['fioa', 'fiob'], 60, 5)
+    sampler.sample()
+    vals = sampler.get_values()[0]
+    # fct0 does not name its block device with several cards
+    self.assertEqual(sampler.fcts, {'fiob': '1'}, 'card of each device')
+    self.assertEqual(vals, {('fiob', 'phy_bytes_written'): 2000,
+                            ('fiob', 'phy_bytes_read'): 1000,
+                            ('fiob', 'erased_blocks_total'): 4020,
+                            ('fiob', 'erased_blocks_min'): 2,
+                            ('fiob', 'erased_blocks_max'): 7,
+                            ('fiob', 'erased_blocks_avg'): 3},
+                     'values per card')
+
+  def test_6_fusionio_discovery(self):
+    fusionio.discover_devices()
+    self.assertEqual(sorted(fusionio.fio_devices.keys()), ['fioa', 'fiob'],
+                     'devices found')
+    self.assertEqual([os.path.relpath(f, self.tmpdir)
+                      for f in fusionio.fio_devices['fiob']],
+                     ['fio/fiob/data/groomer/stats',
+                      'fio/fiob/data/media/stats'], 'stats files found')
+    self.assertEqual(fusionio.read_device_stats('fioa'),
+                     {'Blocks': 17, 'bytes_read': 2048 * 512,
+                      'bytes_written': 4096 * 512}, 'fioa counters')
+    self.assertEqual(fusionio.read_device_stats('fiob')['phy_bytes_read'],
+                     1000, 'fiob counters')
+    self.assertEqual(fusionio.get_cli_devices(), ['fioa'],
+                     'only fioa needs the tools')
+
+  @patch('collectd.Values')
+  def test_7_fusionio_reader_uses_cache(self, collectdValues):
+    fusionio.init_stats_cache()
+    fusionio.start_sampler()
+    sampler = fusionio.sampler
+    self.assertEqual(sampler.devs, ['fioa'], 'sampler for fioa only')
+    for i in range(50):
+      if len(sampler.get_values()[0]) == len(FIO_STATS):
+        break
+      time.sleep(0.1)
+    fusionio.collect_fiostats()
+    # fioa: Blocks, 6 from the tools, 2 from sysfs; fiob: Blocks, 6
+    self.assertEqual(collectdValues.return_value.dispatch.call_count, 16,
+                     'cached and procfs values dispatched')
+    self.assertEqual(
+      fusionio.fiostats_current[('fioa', 'phy_bytes_read', 'val')],
+      FIO_STATS[('fioa', 'phy_bytes_read')], 'cached value')
+    self.assertEqual(
+      fusionio.stats_current[('fiob', 'phy_bytes_read', 'val')], 1000,
+      'procfs value')
+    fusionio.stop_sampler()
+    self.assertFalse(sampler.is_alive(), 'sampler stopped')
+
+if __name__ == '__main__':
+  suite = unittest.TestLoader().loadTestsFromTestCase(TestFusionio)
+  unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,189 @@
+#!/usr/bin/python
+
+##########################################################################
+# Copyright (c) 2015, Salesforce.com, Inc.
+# All rights reserved.
+#
+# Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#
+# Neither the name of Salesforce.com nor the names of its
+# contributors may be used to endorse or promote products
+# derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+##########################################################################
+
+############################################################
+# Unit test for netdev plugin
+############################################################
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from mock import Mock, patch
+
+import collectd
+sys.path.append(os.path.join(os.path.dirname(__file__), "../plugins"))
+import netdev
+
+PROCFS_NETDEV_6X = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                'mocks/proc_net_dev_6x'))
+
+HEADER = '''Inter-|   Receive                                                |  Transmit
+ face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier compressed
+'''
+
+def netdev_line(name, rx_bytes, rx_packets, rx_drop=0, tx_bytes=0):
+  return ('%6s: %d %d 0 %d 0 0 0 0 %d 0 0 0 0 0 0 0\n' %
+          (name, rx_bytes, rx_packets, rx_drop, tx_bytes))
+
+class TestNetdev(unittest.TestCase):
+  def setUp(self):
+    netdev.interface_filter_regexes = None
+    netdev.extended_stats = False
+    netdev.interfaces.clear()
+    netdev.update_interface_filter()
+    netdev.last_ts = None
+
+  def test_1_netdev_parse(self):
+    with open(PROCFS_NETDEV_6X) as f:
+      devs = netdev.parse_netdev(f.read())
+    names = [name for name, counters in devs]
+    self.assertFalse('lo' in names, 'loopback skipped by default')
+    self.assertTrue('eth0' in names)
+    for name, counters in devs:
+      self.assertEqual(len(counters), netdev.NUM_FIELDS)
+
+  def test_2_netdev_filter(self):
+    netdev.interface_filter_regexes = ['^eth[0-9]+$', '^bond']
+    netdev.update_interface_filter()
+    text = HEADER + netdev_line('lo', 1, 1) + netdev_line('eth0', 1, 1) + \
+           netdev_line('veth12ab', 1, 1) + netdev_line('bond0', 1, 1)
+    self.assertEqual([n for n, c in netdev.parse_netdev(text)],
+                     ['eth0', 'bond0'])
+    self.assertEqual(netdev.interface_filter.cache,
+                     {'lo': False, 'eth0': True, 'veth12ab': False,
+                      'bond0': True}, 'decisions memoized')
+
+    # excludes apply to the default selection
+    netdev.interface_filter_regexes = ['!^veth']
+    netdev.update_interface_filter()
+    self.assertEqual([n for n, c in netdev.parse_netdev(text)],
+                     ['eth0', 'bond0'])
+
+  def test_3_netdev_hotplug(self):
+    text = HEADER + netdev_line('eth0', 1000, 10) + netdev_line('eth1', 0, 0)
+    self.assertEqual(netdev.update_interfaces(netdev.parse_netdev(text)), [])
+    self.assertEqual(sorted(netdev.interfaces.keys()), ['eth0', 'eth1'])
+
+    # eth1 removed, eth2 added: eth0 keeps its snapshot, eth2 has none yet
+    text = HEADER + netdev_line('eth0', 3000, 30, 4) + \
+           netdev_line('eth2', 500, 5)
+    ready = netdev.update_interfaces(netdev.parse_netdev(text))
+    self.assertEqual([i.name for i in ready], ['eth0'])
+    self.assertEqual(sorted(netdev.interfaces.keys()), ['eth0', 'eth2'])
+    rates = dict(zip(netdev.netdev_metrics,
+                     netdev.calc_rates(ready[0], netdev.rate_slots, 2.0)))
+    self.assertEqual(rates['rx_bytes_per_sec'], 1000.0)
+    self.assertEqual(rates['rx_packets_per_sec'], 10.0)
+    self.assertEqual(rates['rx_drops_per_sec'], 2.0)
+
+    # eth0 re-created: counters start over
+    text = HEADER + netdev_line('eth0', 10, 1) + netdev_line('eth2', 900, 9)
+    ready = netdev.update_interfaces(netdev.parse_netdev(text))
+    self.assertEqual(sorted(i.name for i in ready), ['eth0', 'eth2'])
+    rates = netdev.calc_rates(netdev.interfaces['eth0'], netdev.rate_slots,
+                              1.0)
+    self.assertTrue(rates[0] is None)
+
+  @patch('collectd.Values')
+  def test_4_netdev_extended(self, collectdValues):
+    root = tempfile.mkdtemp()
+    try:
+      stats = os.path.join(root, 'eth0', 'statistics')
+      os.makedirs(stats)
+      for field in netdev.extended_fields:
+        with open(os.path.join(stats, field), 'w') as f:
+          f.write('0\n')
+      netdev.SYS_NET_DIR = root
+      netdev.extended_stats = True
+      netdev.NETDEV_FNAME = os.path.join(root, 'dev')
+      with open(netdev.NETDEV_FNAME, 'w') as f:
+        f.write(HEADER + netdev_line('eth0', 1000, 10))
+      with patch('time.time', return_value=100.0):
+        netdev.collect_netdev()
+
+      with open(netdev.NETDEV_FNAME, 'w') as f:
+        f.write(HEADER + netdev_line('eth0', 2000, 20))
+      with open(os.path.join(stats, 'rx_crc_errors'), 'w') as f:
+        f.write('50\n')
+      dispatched = {}
+      def dispatch():
+        metric = collectdValues.return_value
+        dispatched[metric.type_instance] = metric.values[0]
+      collectdValues.return_value.dispatch.side_effect = dispatch
+      with patch('time.time', return_value=110.0):
+        netdev.collect_netdev()
+      self.assertEqual(dispatched['rx_bytes_per_sec'], 100.0)
+      self.assertEqual(dispatched['rx_crc_errors_per_sec'], 5.0)
+      self.assertEqual(dispatched['tx_carrier_errors_per_sec'], 0.0)
+      self.assertFalse(any(f.startswith(stats)
+                           for f in netdev.procreader.readers),
+                       'statistics files are not kept open')
+
+      # a counter the driver does not provide is not retried, and not
+      # reported
+      netdev.interfaces.clear()
+      os.remove(os.path.join(stats, 'rx_nohandler'))
+      with patch('time.time', return_value=120.0):
+        netdev.collect_netdev()
+      dispatched.clear()
+      with patch('procreader.read_text',
+                 side_effect=netdev.procreader.read_text) as read_text:
+        with patch('time.time', return_value=130.0):
+          netdev.collect_netdev()
+      self.assertEqual(read_text.call_count, len(netdev.extended_fields) - 1)
+      self.assertFalse('rx_nohandler_per_sec' in dispatched)
+      self.assertEqual(dispatched['rx_crc_errors_per_sec'], 0.0)
+
+      # a failed read has no rate at its interval and the next
+      crc_errors = os.path.join(stats, 'rx_crc_errors')
+      os.remove(crc_errors)
+      for ts, crc in [(140.0, None), (150.0, '150\n'), (160.0, '250\n')]:
+        if crc is not None:
+          with open(crc_errors, 'w') as f:
+            f.write(crc)
+        dispatched.clear()
+        with patch('time.time', return_value=ts):
+          netdev.collect_netdev()
+        if ts < 160.0:
+          self.assertFalse('rx_crc_errors_per_sec' in dispatched)
+          self.assertEqual(dispatched['rx_length_errors_per_sec'], 0.0)
+      self.assertEqual(dispatched['rx_crc_errors_per_sec'], 10.0)
+    finally:
+      netdev.shutdown()
+      shutil.rmtree(root)
+
+if __name__ == '__main__':
+  suite = unittest.TestLoader().loadTestsFromTestCase(TestNetdev)
+  unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,116 @@
+#!/usr/bin/python
+
+##########################################################################
+# Copyright (c) 2015, Salesforce.com, Inc.
+# All rights reserved.
+#
+# Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#
+# Neither the name of Salesforce.com nor the names of its
+# contributors may be used to endorse or promote products
+# derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+##########################################################################
+
+"""
+Micro-benchmark for the netstats line parser against the multiline regex
+path it replaced, on captured /proc/net/snmp and /proc/net/netstat
+snapshots, e.g.:
+
+    python netstats_bench.py mocks/proc_net_snmp_6x mocks/proc_net_netstat_6x
+
+Each iteration parses an in-memory snapshot into counter names and values,
+so only parsing is measured, not the read.
+"""
+
+import sys
+import os
+import re
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../plugins"))
+import netstats
+
+MOCKS = os.path.join(os.path.dirname(__file__), 'mocks')
+
+re_snmp=re.compile (r'^Ip:\s+(?P<ip_labels>.*)\n'
+                    r'^Ip:\s+(?P<ip_vals>.*)\n'
+                    r'^Icmp:\s+(?P<icmp_labels>.*)\n'
+                    r'^Icmp:\s+(?P<icmp_vals>.*)\n'
+                    r'^IcmpMsg:\s+(?P<icmpmsg_labels>.*)\n'
+                    r'^IcmpMsg:\s+(?P<icmpmsg_vals>.*)\n'
+                    r'^Tcp:\s+(?P<tcp_labels>.*)\n'
+                    r'^Tcp:\s+(?P<tcp_vals>.*)\n'
+                    r'^Udp:\s+(?P<udp_labels>.*)\n'
+                    r'^Udp:\s+(?P<udp_vals>.*)\n'
+                    r'^UdpLite:\s+(?P<udplite_labels>.*)\n'
+                    r'^UdpLite:\s+(?P<udplite_vals>.*)\n'
+                    , re.MULTILINE)
+
+re_netstat=re.compile (r'^TcpExt:\s+(?P<tcpext_labels>.*)\n'
+                       r'^TcpExt:\s+(?P<tcpext_vals>.*)\n'
+                       r'^IpExt:\s+(?P<ipext_labels>.*)\n'
+                       r'^IpExt:\s+(?P<ipext_vals>.*)\n'
+                       , re.MULTILINE)
+
+def parse_regex(text):
+    nr_vals = 0
+    rex = re_snmp if text.startswith('Ip:') else re_netstat
+    for m in re.finditer(rex, text):
+        for name, group in m.groupdict().items():
+            if name.endswith('_labels'):
+                group.strip().split()
+            else:
+                nr_vals += len([int(v) for v in group.strip().split()])
+    return nr_vals
+
+def parse_lines(text):
+    nr_vals = 0
+    for section, header, vals in netstats.parse_sections(text):
+        header.split()
+        nr_vals += len(vals)
+    return nr_vals
+
+def bench(name, func, text, iterations):
+    nr_vals = func(text)
+    start = time.time()
+    for i in range(iterations):
+        func(text)
+    elapsed = time.time() - start
+    print('%-16s %10.2f usec/parse %6d values' %
+          (name, elapsed * 1e6 / iterations, nr_vals))
+
+def main():
+    fnames = sys.argv[1:] or [os.path.join(MOCKS, 'proc_net_snmp_6x'),
+                              os.path.join(MOCKS, 'proc_net_netstat_6x')]
+    iterations = 10000
+    for fname in fnames:
+        if not os.path.exists(fname):
+            print('%s does not exist' % (fname))
+            continue
+        with open(fname) as f:
+            text = f.read()
+        print('%s: %d iterations' % (fname, iterations))
+        bench('regex', parse_regex, text, iterations)
+        bench('line parser', parse_lines, text, iterations)
+
+if __name__ == "__main__":
+    main()
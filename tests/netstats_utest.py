@@ -35,22 +35,46 @@
 ############################################################
 
 import os
+import shutil
 import sys
+import tempfile
 import unittest
 
+from mock import patch
+
 import collectd
 sys.path.append(os.path.join(os.path.dirname(__file__), "../plugins"))
 import netstats
+import sockdiag
 
 PROCFS_SNMP = os.path.abspath(os.path.join(os.path.dirname(__file__),
                                            'mocks/proc_net_snmp'))
 PROCFS_NETSTAT = os.path.abspath(os.path.join(os.path.dirname(__file__),
                                            'mocks/proc_net_netstat'))
+# 6.x kernel: no IcmpMsg section, MPTcpExt section in netstat
+PROCFS_SNMP_6X = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                              'mocks/proc_net_snmp_6x'))
+PROCFS_NETSTAT_6X = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                 'mocks/proc_net_netstat_6x'))
 
 # Expected values for verifications
 WHITE_LIST = ['InReceives', 'InHdrErrors', 'ForwDatagrams', 'InDiscards', 'InDelivers', 'OutRequests', 'OutNoRoutes', 'ReasmReqds', 'ReasmOKs', 'ReasmFails', 'InMsgs', 'InErrors', 'InDestUnreachs', 'InEchos', 'InTimestamps', 'InAddrMasks', 'OutMsgs', 'OutDestUnreachs', 'OutEchoReps', 'OutTimestampReps', 'ActiveOpens', 'PassiveOpens', 'AttemptFails', 'EstabResets', 'CurrEstab', 'InSegs', 'OutSegs', 'RetransSegs', 'InErrs', 'OutRsts', 'InDatagrams', 'NoPorts', 'InErrors', 'OutDatagrams', 'RcvbufErrors', 'SndbufErrors', 'SyncookiesFailed', 'EmbryonicRsts', 'TW', 'DelayedACKs', 'DelayedACKLocked', 'DelayedACKLost', 'TCPPrequeued', 'TCPHPHits', 'TCPPureAcks', 'TCPHPAcks', 'TCPLossFailures', 'TCPTimeouts', 'TCPDSACKOldSent', 'TCPAbortOnData', 'TCPAbortOnClose', 'TCPAbortOnTimeout', 'InMcastPkts', 'OutMcastPkts', 'InBcastPkts', 'InOctets', 'OutOctets', 'InMcastOctets', 'OutMcastOctets', 'InBcastOctets']
 
-IP_VALS = ['2', '64', '193667093', '0', '622', '0', '0', '0', '178978597', '8430305', '0', '0', '15', '6026610', '3013266', '15', '0', '0', '0']
+SNMP = '''Ip: Forwarding DefaultTTL InReceives InHdrErrors InAddrErrors
+Ip: 2 64 2822 1 0
+Icmp: InMsgs InErrors InCsumErrors
+Icmp: 5 0 0
+IcmpMsg: InType3 OutType3
+IcmpMsg: 7 7
+Tcp: RtoAlgorithm RtoMin ActiveOpens PassiveOpens
+Tcp: 1 200 25 18
+Udp: InDatagrams NoPorts InErrors
+Udp: 18 0 0
+UdpLite: InDatagrams NoPorts InErrors
+UdpLite: 0 0 0
+'''
+
+IP_VALS = [2, 64, 193667093, 0, 622, 0, 0, 0, 178978597, 8430305, 0, 0, 15, 6026610, 3013266, 15, 0, 0, 0]
 
 class TestNetstats(unittest.TestCase):
   def setUp(self):
@@ -62,30 +86,176 @@ class TestNetstats(unittest.TestCase):
     self.assertTrue(netstats.host_type is 'other', 'unknown host type')
 
   def test_2_netstats_white_list(self):
-    netstats.init_snmp_counters_list()
-    netstats.init_netstat_counters_list()
-    self.assertTrue(len(netstats.ip_list) > 0, 'at least one ip counter')
-    self.assertTrue(len(netstats.icmp_list) > 0, 'at least one icmp counter')
-    self.assertTrue(len(netstats.tcp_list) > 0, 'at least one tcp counter')
-    self.assertTrue(len(netstats.udp_list) > 0, 'at least one udp counter')
-    self.assertTrue(len(netstats.tcpext_list) > 0,
+    netstats.init_counters_list()
+    counter_lists = netstats.counter_lists
+    self.assertTrue(len(counter_lists['ip']) > 0, 'at least one ip counter')
+    self.assertTrue(len(counter_lists['icmp']) > 0, 'at least one icmp counter')
+    self.assertTrue(len(counter_lists['tcp']) > 0, 'at least one tcp counter')
+    self.assertTrue(len(counter_lists['udp']) > 0, 'at least one udp counter')
+    self.assertTrue(len(counter_lists['tcpext']) > 0,
                     'at least one tcpext counter')
-    self.assertTrue(len(netstats.ipext_list) > 0,
+    self.assertTrue(len(counter_lists['ipext']) > 0,
                     'at least one ipext counter')
     self.assertEqual(netstats.white_list, WHITE_LIST,
                      'white lists parsing error')
 
   def test_3_netstats_collection(self):
     netstats.collect_netstats()
-    self.assertTrue(len(netstats.ip_vals) > 0, 'at least one ip counter')
-    self.assertTrue(len(netstats.icmp_vals) > 0, 'at least one icmp counter')
-    self.assertTrue(len(netstats.tcp_vals) > 0, 'at least one tcp counter')
-    self.assertTrue(len(netstats.udp_vals) > 0, 'at least one udp counter')
-    self.assertTrue(len(netstats.tcpext_vals) > 0,
+    counter_vals = netstats.counter_vals
+    self.assertTrue(len(counter_vals['ip']) > 0, 'at least one ip counter')
+    self.assertTrue(len(counter_vals['icmp']) > 0, 'at least one icmp counter')
+    self.assertTrue(len(counter_vals['tcp']) > 0, 'at least one tcp counter')
+    self.assertTrue(len(counter_vals['udp']) > 0, 'at least one udp counter')
+    self.assertTrue(len(counter_vals['tcpext']) > 0,
                     'at least one tcpext counter')
-    self.assertTrue(len(netstats.ipext_vals) > 0,
+    self.assertTrue(len(counter_vals['ipext']) > 0,
                     'at least one ipext counter')
-    self.assertEqual(netstats.ip_vals, IP_VALS, 'ip counts mis-match')
+    self.assertEqual(counter_vals['ip'], IP_VALS, 'ip counts mis-match')
+
+  def test_4_netstats_dispatch_plan(self):
+    fd, fname = tempfile.mkstemp()
+    os.close(fd)
+    try:
+      with open(fname, 'w') as f:
+        f.write(SNMP)
+      netstats.SNMP_FNAME = fname
+      netstats.NETSTAT_FNAME = PROCFS_NETSTAT_6X
+      netstats.dispatch_plans.clear()
+      netstats.init_counters_list()
+      header, cols, names = netstats.dispatch_plans['ip']
+      self.assertEqual(cols, [2, 3], 'ip plan columns')
+      self.assertEqual(names, ['InReceives', 'InHdrErrors'], 'ip plan names')
+      self.assertEqual(netstats.dispatch_plans['tcp'][2],
+                       ['ActiveOpens', 'PassiveOpens'], 'tcp plan names')
+      self.assertEqual(netstats.dispatch_plans['icmpmsg'][1], [],
+                       'no white listed icmpmsg counters')
+
+      # unchanged headers keep the plan, a new counter rebuilds it
+      plan = netstats.dispatch_plans['ip']
+      netstats.collect_netstats()
+      self.assertTrue(netstats.dispatch_plans['ip'] is plan, 'plan reused')
+      with open(fname, 'w') as f:
+        f.write(SNMP.replace('Ip: Forwarding DefaultTTL',
+                             'Ip: Forwarding DefaultTTL InTruncated')
+                    .replace('Ip: 2 64', 'Ip: 2 64 0'))
+      netstats.collect_netstats()
+      self.assertEqual(netstats.dispatch_plans['ip'][1], [3, 4],
+                       'ip plan rebuilt')
+      self.assertEqual(netstats.counter_vals['ip'][3:5], [2822, 1],
+                       'ip values')
+    finally:
+      netstats.procreader.close_reader(fname)
+      os.unlink(fname)
+
+  def test_5_netstats_parse_sections(self):
+    netstats.SNMP_FNAME = PROCFS_SNMP_6X
+    netstats.NETSTAT_FNAME = PROCFS_NETSTAT_6X
+    netstats.collect_netstats()
+    self.assertEqual(netstats.sections,
+                     ['ip', 'icmp', 'tcp', 'udp', 'udplite',
+                      'tcpext', 'ipext', 'mptcpext'], 'sections found')
+    for section in netstats.sections:
+      self.assertEqual(len(netstats.counter_lists[section]),
+                       len(netstats.counter_vals[section]),
+                       '%s names and values' % (section))
+    self.assertEqual(netstats.counter_vals['tcp'][:4], [1, 200, 120000, -1],
+                     'tcp values parsed as ints')
+
+    # reordered sections and a repeated header line
+    parsed = netstats.parse_sections('Udp: InDatagrams NoPorts\n'
+                                     'Ip: Forwarding\n'
+                                     'Ip: Forwarding DefaultTTL\n'
+                                     'Ip: 2 64\n'
+                                     'Udp: InDatagrams NoPorts\n'
+                                     'Udp: 18 0\n')
+    self.assertEqual(parsed, [('ip', ' Forwarding DefaultTTL', [2, 64]),
+                              ('udp', ' InDatagrams NoPorts', [18, 0])],
+                     'sections parsed')
+
+  def test_6_netstats_netns(self):
+    proc = tempfile.mkdtemp()
+    def add_pid(pid, ns):
+      os.makedirs(os.path.join(proc, str(pid), 'ns'))
+      os.makedirs(os.path.join(proc, str(pid), 'net'))
+      os.symlink('net:[%d]' % (ns), os.path.join(proc, str(pid), 'ns/net'))
+      with open(os.path.join(proc, str(pid), 'net/snmp'), 'w') as f:
+        f.write(SNMP.replace('Ip: 2 64 2822', 'Ip: 2 64 %d' % (pid)))
+      with open(os.path.join(proc, str(pid), 'net/netstat'), 'w') as f:
+        f.write('TcpExt: TW\nTcpExt: %d\n' % (ns))
+    def del_pid(pid):
+      shutil.rmtree(os.path.join(proc, str(pid)))
+
+    try:
+      netstats.PROC_DIR = proc
+      netstats.host_netns = 100
+      add_pid(1, 100)
+      add_pid(20, 200)
+      add_pid(30, 200)
+      add_pid(40, 300)
+      netstats.netns_last_scan = 0
+      netstats.collect_netns()
+      self.assertEqual(netstats.netns_pids, {200: 20, 300: 40},
+                       'one representative per namespace')
+      self.assertEqual(netstats.netns_sections[200],
+                       ['ip', 'icmp', 'icmpmsg', 'tcp', 'udp', 'udplite',
+                        'tcpext'], 'namespace sections')
+      self.assertEqual(netstats.netns_vals[200]['ip'][2], 20,
+                       'counters of the representative')
+      self.assertEqual(netstats.netns_vals[300]['tcpext'], [300],
+                       'counters per namespace')
+
+      # representative exits, another pid of the namespace takes over;
+      # last pid of a namespace exits, the namespace is dropped
+      del_pid(20)
+      del_pid(40)
+      netstats.collect_netns()
+      self.assertEqual(netstats.netns_pids, {200: 30}, 'representatives')
+      self.assertEqual(netstats.netns_vals[200]['ip'][2], 30,
+                       'counters of the new representative')
+      self.assertFalse(300 in netstats.netns_vals, 'namespace dropped')
+
+      # new pids are only resolved by the periodic scan
+      add_pid(50, 500)
+      netstats.collect_netns()
+      self.assertFalse(500 in netstats.netns_pids, 'scan not due')
+      netstats.netns_last_scan = 0
+      netstats.collect_netns()
+      self.assertEqual(netstats.netns_pids, {200: 30, 500: 50},
+                       'new namespace found')
+    finally:
+      for ns in list(netstats.netns_pids.keys()):
+        netstats.drop_netns(ns)
+      netstats.netns_pid_map.clear()
+      netstats.PROC_DIR = '/proc'
+      shutil.rmtree(proc)
+
+  def test_7_netstats_tcp_states(self):
+    tmpdir = tempfile.mkdtemp()
+    fname = os.path.join(tmpdir, 'tcp')
+    with open(fname, 'w') as f:
+      f.write('  sl  local_address rem_address   st tx_queue rx_queue tr '
+              'tm->when retrnsmt   uid  timeout inode\n'
+              '   0: 0100007F:0016 00000000:0000 0A 00000000:00000000 '
+              '00:00000000 00000000     0        0 1001 1 0 100 0 0 10 0\n')
+    tcp_fnames = sockdiag.TCP_FNAMES
+    try:
+      sockdiag.TCP_FNAMES = [fname]
+      netstats.tcp_netlink = True
+      netstats.tcp_states_mask = sockdiag.states_mask(['listen'])
+      with patch('sockdiag.netlink_summary',
+                 side_effect=OSError(93, 'Protocol not supported')) as nl:
+        vals = netstats.collect_tcp_states()
+        self.assertFalse(netstats.tcp_netlink, 'netlink disabled')
+        netstats.collect_tcp_states()
+        self.assertEqual(nl.call_count, 1, 'netlink tried once')
+      self.assertEqual(vals[sockdiag.summary_fields.index('listen')], 1,
+                       'listening socket from /proc/net/tcp')
+      self.assertEqual(vals[0], None, 'established not counted')
+    finally:
+      sockdiag.TCP_FNAMES = tcp_fnames
+      netstats.tcp_netlink = True
+      netstats.tcp_states_mask = sockdiag.ALL_STATES
+      shutil.rmtree(tmpdir)
 
 if __name__ == '__main__':
   suite = unittest.TestLoader().loadTestsFromTestCase(TestNetstats)
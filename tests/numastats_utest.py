@@ -0,0 +1,156 @@
+#!/usr/bin/python
+
+##########################################################################
+# Copyright (c) 2015, Salesforce.com, Inc.
+# All rights reserved.
+#
+# Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#
+# Neither the name of Salesforce.com nor the names of its
+# contributors may be used to endorse or promote products
+# derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+##########################################################################
+
+############################################################
+# Unit test for numastats plugin
+############################################################
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from mock import Mock, patch
+
+import collectd
+sys.path.append(os.path.join(os.path.dirname(__file__), "../plugins"))
+import numastats
+
+SYSFS_NODE = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                          'mocks/sys_devices_system_node'))
+
+NUMASTAT = '''numa_hit %d
+numa_miss %d
+numa_foreign 0
+interleave_hit 0
+local_node %d
+other_node %d
+'''
+
+MEMINFO = '''Node 1 MemTotal:       65536000 kB
+Node 1 MemFree:        1024000 kB
+Node 1 Active(anon):     20480 kB
+Node 1 HugePages_Total:     16
+'''
+
+class TestNumastats(unittest.TestCase):
+  def setUp(self):
+    numastats.stats_cache.clear()
+
+  def test_1_numastats_nodes(self):
+    root = tempfile.mkdtemp()
+    try:
+      for d in ('node10', 'node2', 'node0', 'power', 'has_cpu'):
+        os.makedirs(os.path.join(root, d))
+      numastats.NODE_DIR = root
+      self.assertEqual(numastats.get_node_list(), ['node0', 'node2', 'node10'])
+    finally:
+      shutil.rmtree(root)
+
+  def test_2_numastats_parse(self):
+    names, vals = numastats.parse_meminfo(MEMINFO)
+    self.assertEqual(names, ['meminfo_memtotal', 'meminfo_memfree',
+                             'meminfo_active_anon', 'meminfo_hugepages_total'])
+    self.assertEqual(vals, [65536000, 1024000, 20480, 16])
+
+    with open(os.path.join(SYSFS_NODE, 'node0/vmstat')) as f:
+      vals = numastats.parse_counters(f.read(), ['nr_dirtied', 'no_such_key'])
+    self.assertTrue(vals[0] > 0)
+    self.assertTrue(vals[1] is None)
+
+  def test_3_numastats_rates(self):
+    pre = (numastats.parse_counters(NUMASTAT % (1000, 100, 900, 200),
+                                    numastats.numastat_fields), [10])
+    cur = (numastats.parse_counters(NUMASTAT % (1900, 200, 1400, 700),
+                                    numastats.numastat_fields), [5])
+    numa_rates, vm_rates = numastats.calc_node_metrics(cur, pre, 10.0)
+    rates = dict(zip(numastats.numastat_metrics, numa_rates))
+    self.assertEqual(rates['numa_hit_per_sec'], 90.0)
+    self.assertEqual(rates['numa_miss_per_sec'], 10.0)
+    self.assertEqual(rates['pct_numa_miss'], 10.0)
+    self.assertEqual(rates['pct_local_node'], 50.0)
+    self.assertEqual(vm_rates, [None], 'counter went backwards')
+
+    numa_rates, vm_rates = numastats.calc_node_metrics(cur, None, 0)
+    self.assertEqual(numa_rates, [None] * len(numastats.numastat_metrics))
+
+  @patch('collectd.Values')
+  def test_4_numastats_collection(self, collectdValues):
+    root = tempfile.mkdtemp()
+    try:
+      shutil.copytree(os.path.join(SYSFS_NODE, 'node0'),
+                      os.path.join(root, 'node0'))
+      os.makedirs(os.path.join(root, 'node1'))
+      with open(os.path.join(root, 'node1/numastat'), 'w') as f:
+        f.write(NUMASTAT % (1000, 100, 900, 200))
+      with open(os.path.join(root, 'node1/meminfo'), 'w') as f:
+        f.write(MEMINFO)
+      shutil.copy(os.path.join(root, 'node0/vmstat'),
+                  os.path.join(root, 'node1/vmstat'))
+      numastats.NODE_DIR = root
+      numastats.initer()
+      self.assertEqual(numastats.node_list, ['node0', 'node1'])
+      self.assertTrue(numastats.has_node_vmstat)
+
+      with patch('time.time', return_value=100.0):
+        numastats.collect_numastats()
+      with open(os.path.join(root, 'node1/numastat'), 'w') as f:
+        f.write(NUMASTAT % (1500, 100, 1400, 200))
+
+      # files are kept open: the next collection does not open any file
+      with patch('os.open', side_effect=os.open) as os_open:
+        with patch('time.time', return_value=110.0):
+          numastats.collect_numastats()
+        self.assertEqual(os_open.call_count, 0)
+      self.assertEqual(numastats.stats_cache['node1'][1][0], 1500)
+
+      dispatched = {}
+      def dispatch():
+        metric = collectdValues.return_value
+        dispatched[(metric.plugin_instance, metric.type_instance)] = \
+          metric.values[0]
+      collectdValues.return_value.dispatch.side_effect = dispatch
+      numastats.stats_cache['node1'] = (100.0,) + \
+        numastats.stats_cache['node1'][1:]
+      with patch('time.time', return_value=110.0):
+        numastats.collect_numastats()
+      self.assertEqual(dispatched[('node1', 'numa_hit_per_sec')], 0.0)
+      self.assertEqual(dispatched[('node1', 'meminfo_hugepages_total')], 16)
+      self.assertEqual(dispatched[('node1', 'numa_hit')], 1500)
+    finally:
+      numastats.shutdown()
+      shutil.rmtree(root)
+
+if __name__ == '__main__':
+  suite = unittest.TestLoader().loadTestsFromTestCase(TestNumastats)
+  unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,97 @@
+#!/usr/bin/python
+
+##########################################################################
+# Copyright (c) 2015, Salesforce.com, Inc.
+# All rights reserved.
+#
+# Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#
+# Neither the name of Salesforce.com nor the names of its
+# contributors may be used to endorse or promote products
+# derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+##########################################################################
+
+"""
+Micro-benchmark for the shared procreader module against the
+open/readline path the plugins used before, e.g.:
+
+    python procreader_bench.py /proc/diskstats 10000
+
+Each iteration reads the whole file and splits every line into fields,
+which is the work every plugin does at each collection interval.
+"""
+
+import sys
+import os
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../plugins"))
+import procreader
+
+def read_open_readline(fname):
+    nr_fields = 0
+    if os.path.exists(fname):
+        with open(fname) as f:
+            for line in f:
+                nr_fields += len(line.split())
+    return nr_fields
+
+def read_procreader_text(fname):
+    nr_fields = 0
+    text = procreader.get_reader(fname).text()
+    for line in text.splitlines():
+        nr_fields += len(line.split())
+    return nr_fields
+
+def read_procreader_lines(fname):
+    nr_fields = 0
+    for line in procreader.get_reader(fname).lines():
+        nr_fields += len(line.tobytes().split())
+    return nr_fields
+
+def read_procreader_raw(fname):
+    return len(procreader.get_reader(fname).read())
+
+def bench(name, func, fname, iterations):
+    func(fname)
+    start = time.time()
+    for i in range(iterations):
+        func(fname)
+    elapsed = time.time() - start
+    print('%-24s %10.2f usec/read' % (name, elapsed * 1e6 / iterations))
+
+def main():
+    fname = sys.argv[1] if len(sys.argv) > 1 else '/proc/diskstats'
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    if not os.path.exists(fname):
+        print('%s does not exist' % (fname))
+        return
+
+    print('%s: %d iterations' % (fname, iterations))
+    bench('open/readline', read_open_readline, fname, iterations)
+    bench('procreader text', read_procreader_text, fname, iterations)
+    bench('procreader lines', read_procreader_lines, fname, iterations)
+    bench('procreader read only', read_procreader_raw, fname, iterations)
+    procreader.close_all()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/python
+
+##########################################################################
+# Copyright (c) 2015, Salesforce.com, Inc.
+# All rights reserved.
+#
+# Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#
+# Neither the name of Salesforce.com nor the names of its
+# contributors may be used to endorse or promote products
+# derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+##########################################################################
+
+############################################################
+# Unit test for procreader module
+############################################################
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../plugins"))
+import procreader
+
+CONTENTS = ('   8       0 sda 1 2 3 4 5 6 7 8 9 10 11\n'
+            '   8       1 sda1 1 2 3 4 5 6 7 8 9 10 11\n'
+            '   8      16 sdb 1 2 3 4 5 6 7 8 9 10 11\n')
+
+class TestProcreader(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.fname = os.path.join(self.tmpdir, 'diskstats')
+    with open(self.fname, 'w') as f:
+      f.write(CONTENTS)
+
+  def tearDown(self):
+    procreader.close_all()
+    shutil.rmtree(self.tmpdir)
+
+  def test_1_procreader_read(self):
+    reader = procreader.get_reader(self.fname)
+    self.assertEqual(reader.read().tobytes(), CONTENTS.encode('ascii'))
+    self.assertEqual(reader.text(), CONTENTS)
+    self.assertTrue(procreader.get_reader(self.fname) is reader,
+                    'readers should be shared per path')
+
+  def test_2_procreader_lines(self):
+    reader = procreader.get_reader(self.fname)
+    lines = [l.tobytes().decode('ascii') for l in reader.lines()]
+    self.assertEqual(lines, CONTENTS.splitlines())
+
+  def test_3_procreader_grow(self):
+    reader = procreader.get_reader(self.fname, 16)
+    self.assertEqual(reader.text(), CONTENTS)
+    self.assertTrue(len(reader.buf) > len(CONTENTS), 'buffer should grow')
+    buf = reader.buf
+    reader.text()
+    self.assertTrue(reader.buf is buf, 'buffer should be reused')
+
+  def test_4_procreader_reread(self):
+    reader = procreader.get_reader(self.fname)
+    reader.read()
+    fd = reader.fd
+    with open(self.fname, 'w') as f:
+      f.write(CONTENTS[:20])
+    self.assertEqual(reader.text(), CONTENTS[:20])
+    self.assertEqual(reader.fd, fd, 'file descriptor should be kept open')
+
+  def test_5_procreader_missing(self):
+    reader = procreader.get_reader(os.path.join(self.tmpdir, 'missing'))
+    self.assertEqual(reader.read(), None)
+    self.assertEqual(reader.text(), None)
+    self.assertEqual(list(reader.lines()), [])
+
+  def test_6_procreader_read_text(self):
+    self.assertEqual(procreader.read_text(self.fname, 16), CONTENTS)
+    self.assertFalse(self.fname in procreader.readers, 'not kept open')
+    self.assertEqual(procreader.read_text(os.path.join(self.tmpdir, 'x')),
+                     None)
+
+if __name__ == '__main__':
+  suite = unittest.TestLoader().loadTestsFromTestCase(TestProcreader)
+  unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,206 @@
+#!/usr/bin/python
+
+##########################################################################
+# Copyright (c) 2015, Salesforce.com, Inc.
+# All rights reserved.
+#
+# Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#
+# Neither the name of Salesforce.com nor the names of its
+# contributors may be used to endorse or promote products
+# derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+##########################################################################
+
+############################################################
+# Unit test for psi plugin
+############################################################
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from mock import Mock, patch
+
+import collectd
+sys.path.append(os.path.join(os.path.dirname(__file__), "../plugins"))
+import psi
+
+PROCFS_PRESSURE = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                               'mocks/proc_pressure'))
+
+MEMORY_PRESSURE = '''some avg10=1.50 avg60=0.75 avg300=0.25 total=1000000
+full avg10=0.50 avg60=0.25 avg300=0.05 total=400000
+'''
+
+# cpu has no 'full' line before 5.13
+CPU_PRESSURE_4X = '''some avg10=12.00 avg60=8.00 avg300=4.00 total=90000000
+'''
+
+def write_pressure(path, some_total, full_total):
+  with open(path, 'w') as f:
+    f.write('some avg10=0.00 avg60=0.00 avg300=0.00 total=%d\n' % (some_total))
+    f.write('full avg10=0.00 avg60=0.00 avg300=0.00 total=%d\n' % (full_total))
+
+class TestPsi(unittest.TestCase):
+  def setUp(self):
+    psi.PSI_DIR = PROCFS_PRESSURE
+    psi.stats_cache.clear()
+    psi.cgroup_dirs.clear()
+
+  def test_1_psi_parse(self):
+    vals = dict(zip(psi.psi_metrics, psi.parse_pressure(MEMORY_PRESSURE)))
+    self.assertEqual(vals['some_avg10'], 1.5)
+    self.assertEqual(vals['some_avg300'], 0.25)
+    self.assertEqual(vals['some_total'], 1000000)
+    self.assertEqual(vals['full_avg60'], 0.25)
+    self.assertEqual(vals['full_total'], 400000)
+    self.assertTrue(vals['some_stall_pct'] is None)
+
+    vals = dict(zip(psi.psi_metrics, psi.parse_pressure(CPU_PRESSURE_4X)))
+    self.assertEqual(vals['some_total'], 90000000)
+    self.assertTrue(vals['full_total'] is None, 'no full line')
+
+  def test_2_psi_stall_pct(self):
+    vals = psi.parse_pressure(MEMORY_PRESSURE)
+    # 500ms of some and 100ms of full stall over a 10s interval
+    psi.calc_stall_pct(vals, (100.0, 500000, 300000), 110.0)
+    vals = dict(zip(psi.psi_metrics, vals))
+    self.assertAlmostEqual(vals['some_stall_pct'], 5.0)
+    self.assertAlmostEqual(vals['full_stall_pct'], 1.0)
+
+    vals = psi.parse_pressure(CPU_PRESSURE_4X)
+    psi.calc_stall_pct(vals, (100.0, 89000000, None), 102.0)
+    vals = dict(zip(psi.psi_metrics, vals))
+    self.assertAlmostEqual(vals['some_stall_pct'], 50.0)
+    self.assertTrue(vals['full_stall_pct'] is None)
+
+  @patch('collectd.Values')
+  def test_3_psi_collection(self, collectdValues):
+    psi.collect_psi()
+    # captured files have both lines; stall pct needs a second interval
+    dispatch = collectdValues.return_value.dispatch
+    self.assertEqual(dispatch.call_count, 3 * 8)
+    self.assertEqual(len(psi.stats_cache), 3)
+    self.assertTrue(('', 'memory') in psi.stats_cache)
+
+  @patch('collectd.Values')
+  def test_4_psi_cgroups(self, collectdValues):
+    root = tempfile.mkdtemp()
+    def add_cgroup(rel):
+      os.makedirs(os.path.join(root, rel))
+      for resource in psi.resources:
+        write_pressure(os.path.join(root, rel, resource + '.pressure'), 0, 0)
+      with open(os.path.join(root, rel, 'cgroup.procs'), 'w') as f:
+        f.write('')
+
+    try:
+      psi.cgroup_root = root
+      psi.cgroup_last_scan = 0
+      add_cgroup('system.slice')
+      add_cgroup('system.slice/sshd.service')
+      add_cgroup('user.slice')
+      with patch('os.listdir', side_effect=os.listdir) as listdir:
+        with patch('os.scandir', side_effect=os.scandir) as scandir:
+          psi.scan_cgroups()
+          listed = listdir.call_count + scandir.call_count
+          self.assertEqual(listed, 4, 'root and each cgroup listed once')
+          self.assertEqual(sorted(psi.cgroup_dirs.keys()),
+                           ['', 'system.slice', 'system.slice/sshd.service',
+                            'user.slice'])
+
+          # nothing changed: cgroups are stat'ed, not listed again
+          psi.scan_cgroups()
+          self.assertEqual(listdir.call_count + scandir.call_count, listed)
+
+      psi.collect_cgroups(1000.0)
+      self.assertEqual(len(psi.stats_cache), 3 * 3)
+      self.assertFalse(('', 'io') in psi.stats_cache, 'root cgroup')
+      write_pressure(os.path.join(root, 'user.slice/io.pressure'),
+                     2000000, 1000000)
+      psi.collect_cgroups(1010.0)
+      self.assertEqual(psi.stats_cache[('user.slice', 'io')],
+                       (1010.0, 2000000, 1000000))
+
+      # removed cgroup is dropped when its files cannot be read, new one
+      # is found by the next scan
+      shutil.rmtree(os.path.join(root, 'system.slice/sshd.service'))
+      add_cgroup('system.slice/cron.service')
+      psi.cgroup_last_scan = 0
+      psi.collect_cgroups(1020.0)
+      self.assertEqual(sorted(psi.cgroup_dirs.keys()),
+                       ['', 'system.slice', 'system.slice/cron.service',
+                        'user.slice'])
+      self.assertFalse(('system.slice_sshd.service', 'io') in psi.stats_cache)
+      self.assertTrue(('system.slice_cron.service', 'io') in psi.stats_cache)
+    finally:
+      psi.shutdown()
+      shutil.rmtree(root)
+
+  @patch('collectd.Values')
+  def test_5_psi_many_cgroups(self, collectdValues):
+    # more cgroups than the 1024 descriptors of the usual RLIMIT_NOFILE
+    # would allow if their pressure files were kept open
+    root = tempfile.mkdtemp()
+    ncgroups = 500
+    try:
+      for i in range(ncgroups):
+        path = os.path.join(root, 'pod%d' % (i))
+        os.mkdir(path)
+        for resource in psi.resources:
+          write_pressure(os.path.join(path, resource + '.pressure'), i, i)
+      psi.cgroup_root = root
+      psi.cgroup_last_scan = 0
+      # /proc/pressure files stay open
+      psi.collect_psi()
+      collectdValues.reset_mock()
+      fds = len(os.listdir('/proc/self/fd'))
+      psi.cgroups_enabled = True
+      psi.collect_psi()
+      self.assertEqual(len(os.listdir('/proc/self/fd')), fds,
+                       'no descriptor left open per cgroup')
+      self.assertTrue(all(f.startswith(psi.PSI_DIR)
+                          for f in psi.procreader.readers))
+      dispatch = collectdValues.return_value.dispatch
+      # /proc/pressure has its stall percentages at its second interval
+      self.assertEqual(dispatch.call_count, ncgroups * 3 * 8 + 3 * 10)
+    finally:
+      psi.cgroups_enabled = False
+      psi.shutdown()
+      shutil.rmtree(root)
+
+  def test_6_psi_cgroup_instance(self):
+    self.assertEqual(psi.cgroup_instance('system.slice/sshd.service'),
+                     'system.slice_sshd.service')
+    pod = ('kubepods.slice/kubepods-burstable.slice/'
+           'kubepods-burstable-pod0f1e2d3c_4b5a_6978_8796_a5b4c3d2e1f0.slice/')
+    first = psi.cgroup_instance(pod + 'cri-containerd-' + 'a' * 64 + '.scope')
+    second = psi.cgroup_instance(pod + 'cri-containerd-' + 'b' * 64 + '.scope')
+    self.assertTrue(len(first) < 128, 'below DATA_MAX_NAME_LEN')
+    self.assertEqual(len(first), psi.MAX_INSTANCE_LEN)
+    self.assertTrue(first.startswith('kubepods.slice_kubepods-burstable'))
+    self.assertNotEqual(first, second, 'paths sharing a prefix stay distinct')
+
+if __name__ == '__main__':
+  suite = unittest.TestLoader().loadTestsFromTestCase(TestPsi)
+  unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,154 @@
+#!/usr/bin/python
+
+##########################################################################
+# Copyright (c) 2015, Salesforce.com, Inc.
+# All rights reserved.
+#
+# Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#
+# Neither the name of Salesforce.com nor the names of its
+# contributors may be used to endorse or promote products
+# derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+##########################################################################
+
+
+"""
+Benchmark of the sockdiag TCP summary paths on synthetic sockets, e.g.:
+
+    python sockdiag_bench.py 1000000
+
+- readlines: whole /proc/net/tcp read and split into fields per line,
+  as netstat/ss-like scripts do
+- chunked regex: sockdiag.proc_summary() on the same file
+- netlink parse: sockdiag.parse_diag_messages() on inet_diag_msg
+  replies of the same sockets, in 64KB receive buffers, i.e. the
+  userspace cost of a sock_diag dump
+
+The /proc file is generated in a temporary directory; the kernel side of
+both reads (formatting lines vs. filling netlink messages) is not part
+of the measurement.
+"""
+
+import os
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../plugins"))
+import sockdiag
+
+HEADER = ('  sl  local_address rem_address   st tx_queue rx_queue tr tm->when '
+          'retrnsmt   uid  timeout inode\n')
+
+# state mix of a busy front-end: mostly established and time_wait
+STATE_MIX = [1] * 6 + [6] * 3 + [8, 10]
+
+def tcp_line(i):
+    state = STATE_MIX[i % len(STATE_MIX)]
+    timer = 1 if i % 50 == 0 else 0
+    return ('%4d: 0100007F:%04X 0A000001:01BB %02X %08X:%08X %02X:00000000 '
+            '%08X  1000        0 %d 1 0000000000000000 20 4 30 10 -1\n' %
+            (i, 1024 + i % 60000, state, i % 7 * 100, i % 3, timer,
+             timer * 2, 100000 + i))
+
+def write_proc_tcp(fname, num_sockets):
+    with open(fname, 'w') as f:
+        f.write(HEADER)
+        lines = []
+        for i in range(num_sockets):
+            lines.append(tcp_line(i))
+            if len(lines) == 10000:
+                f.write(''.join(lines))
+                lines = []
+        f.write(''.join(lines))
+
+def diag_buffers(num_sockets, bufsize=sockdiag.RECV_BUFSIZE):
+    msg = struct.Struct('=IHHIIBBBB48xIIIII')
+    # room for the attributes a 6.x kernel adds without extensions
+    msg_len = msg.size + 36
+    per_buf = bufsize // msg_len
+    bufs = []
+    for start in range(0, num_sockets, per_buf):
+        buf = bytearray(bufsize)
+        count = min(per_buf, num_sockets - start)
+        for j in range(count):
+            i = start + j
+            state = STATE_MIX[i % len(STATE_MIX)]
+            timer = 1 if i % 50 == 0 else 0
+            msg.pack_into(buf, j * msg_len, msg_len,
+                          sockdiag.SOCK_DIAG_BY_FAMILY, 2, 1, 0,
+                          socket.AF_INET, state, timer, timer * 2, 0,
+                          i % 3, i % 7 * 100, 1000, 100000 + i)
+        bufs.append((buf, count * msg_len))
+    done = bytearray(sockdiag.nlmsghdr.pack(20, sockdiag.NLMSG_DONE, 2, 1, 0)
+                     + b'\0\0\0\0')
+    bufs.append((done, len(done)))
+    return bufs
+
+def summary_readlines(fname):
+    counts = {}
+    with open(fname) as f:
+        lines = f.readlines()
+    for line in lines[1:]:
+        fields = line.split()
+        counts[fields[3]] = counts.get(fields[3], 0) + 1
+        tx, rx = fields[4].split(':')
+        int(tx, 16)
+        int(rx, 16)
+    return counts
+
+def summary_netlink(bufs):
+    sockets = sockdiag.Counter()
+    for buf, size in bufs:
+        if sockdiag.parse_diag_messages(buf, size, sockets):
+            break
+    return sockdiag.summarize_sockets(sockets)
+
+def bench(name, func, arg):
+    start = time.time()
+    func(arg)
+    elapsed = time.time() - start
+    print('%-16s %8.3f sec' % (name, elapsed))
+
+def main():
+    num_sockets = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(tmpdir, 'tcp')
+        write_proc_tcp(fname, num_sockets)
+        bufs = diag_buffers(num_sockets)
+        print('%d sockets, /proc/net/tcp %d MB, %d netlink buffers' %
+              (num_sockets, os.path.getsize(fname) >> 20, len(bufs)))
+        bench('readlines', summary_readlines, fname)
+        bench('chunked regex', lambda f: sockdiag.proc_summary(fnames=[f]),
+              fname)
+        bench('netlink parse', summary_netlink, bufs)
+        assert (sockdiag.proc_summary(fnames=[fname]) ==
+                summary_netlink(bufs)), 'summaries differ'
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/python
+
+##########################################################################
+# Copyright (c) 2015, Salesforce.com, Inc.
+# All rights reserved.
+#
+# Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#
+# Neither the name of Salesforce.com nor the names of its
+# contributors may be used to endorse or promote products
+# derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+##########################################################################
+
+
+############################################################
+# Unit test for sockdiag module
+############################################################
+
+import os
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import unittest
+
+from collections import Counter
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../plugins"))
+import sockdiag
+
+PROC_NET_TCP = '''  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode
+   0: 0100007F:0277 00000000:0000 0A 00000000:00000003 00:00000000 00000000     0        0 1001 1 0000000000000000 100 0 0 10 0
+   1: 0100007F:0016 0100007F:A000 01 00000010:00000000 01:00000020 00000002  1000        0 1002 2 0000000000000000 20 4 30 10 -1
+   2: 0100007F:0016 0100007F:A001 01 00000000:00000020 00:00000000 00000000  1000        0 1003 1 0000000000000000 20 4 30 10 -1
+   3: 0100007F:0016 0100007F:A002 06 00000000:00000000 03:00000100 00000000     0        0 0 3 0000000000000000
+   4: 0100007F:0016 0100007F:A003 0C 00000000:00000000 02:00000100 00000001     0        0 0 1 0000000000000000
+'''
+
+# established, listen, time_wait and syn_recv counts, retrans_sockets,
+# retrans_segs, rx/tx queue bytes and listen backlog of PROC_NET_TCP
+EXPECTED = [2, 0, 1, 0, 0, 1, 0, 0, 0, 1, 0, 1, 2, 0x20, 0x10, 3]
+
+# nlmsghdr followed by an inet_diag_msg and 36 bytes of attributes
+diag_msg = struct.Struct('=IHHIIBBBB48xIIIII36x')
+
+def diag_buffer(sockets, done=True):
+  buf = b''
+  for state, timer, retrans, rqueue, wqueue in sockets:
+    buf += diag_msg.pack(diag_msg.size, sockdiag.SOCK_DIAG_BY_FAMILY, 2, 1, 0,
+                         socket.AF_INET, state, timer, retrans, 0,
+                         rqueue, wqueue, 0, 0)
+  if done:
+    buf += sockdiag.nlmsghdr.pack(20, sockdiag.NLMSG_DONE, 2, 1, 0) + b'\0' * 4
+  return bytearray(buf)
+
+class TestSockdiag(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.fname = os.path.join(self.tmpdir, 'tcp')
+    with open(self.fname, 'w') as f:
+      f.write(PROC_NET_TCP)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def test_1_sockdiag_states_mask(self):
+    self.assertEqual(sockdiag.states_mask([]), sockdiag.ALL_STATES)
+    mask = sockdiag.states_mask(['established', 'SYN_RECV'])
+    self.assertEqual(mask, (1 << 1) | (1 << 3) | (1 << 12))
+    summary = sockdiag.new_summary(mask)
+    self.assertEqual(summary[:4], [0, None, 0, None])
+    self.assertEqual(summary[len(sockdiag.tcp_states):], [0] * 5)
+    self.assertRaises(ValueError, sockdiag.states_mask, ['closed'])
+
+  def test_2_sockdiag_proc_summary(self):
+    self.assertEqual(sockdiag.proc_summary(fnames=[self.fname]), EXPECTED)
+    # lines split across chunks
+    chunk_size = sockdiag.CHUNK_SIZE
+    try:
+      sockdiag.CHUNK_SIZE = 37
+      self.assertEqual(sockdiag.proc_summary(fnames=[self.fname]), EXPECTED)
+    finally:
+      sockdiag.CHUNK_SIZE = chunk_size
+    # states outside the mask are not counted
+    summary = sockdiag.proc_summary(sockdiag.states_mask(['listen']),
+                                    [self.fname])
+    self.assertEqual(summary[9], 1)
+    self.assertEqual(summary[0], None)
+    self.assertEqual(summary[len(sockdiag.tcp_states):], [0, 0, 0, 0, 3])
+    # missing files are skipped
+    self.assertEqual(sockdiag.proc_summary(
+      fnames=[os.path.join(self.tmpdir, 'tcp6'), self.fname]), EXPECTED)
+
+  def test_3_sockdiag_parse_diag_messages(self):
+    # same sockets as PROC_NET_TCP
+    sockets = [(10, 0, 0, 3, 0), (1, 1, 2, 0, 0x10), (1, 0, 0, 0x20, 0),
+               (6, 3, 0, 0, 0), (3, 2, 1, 0, 0)]
+    counts = Counter()
+    buf = diag_buffer(sockets[:2], False)
+    self.assertFalse(sockdiag.parse_diag_messages(buf, len(buf), counts))
+    buf = diag_buffer(sockets[2:])
+    self.assertTrue(sockdiag.parse_diag_messages(buf, len(buf), counts))
+    self.assertEqual(sum(counts.values()), 5)
+    self.assertEqual(sockdiag.summarize_sockets(counts), EXPECTED)
+
+    error = sockdiag.nlmsghdr.pack(36, sockdiag.NLMSG_ERROR, 0, 1, 0) + \
+            struct.pack('=i', -1) + b'\0' * 16
+    self.assertRaises(OSError, sockdiag.parse_diag_messages,
+                      bytearray(error), len(error), counts)
+
+if __name__ == '__main__':
+  suite = unittest.TestLoader().loadTestsFromTestCase(TestSockdiag)
+  unittest.TextTestRunner(verbosity=2).run(suite)
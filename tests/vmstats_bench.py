@@ -0,0 +1,94 @@
+#!/usr/bin/python
+
+##########################################################################
+# Copyright (c) 2015, Salesforce.com, Inc.
+# All rights reserved.
+#
+# Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#
+# Neither the name of Salesforce.com nor the names of its
+# contributors may be used to endorse or promote products
+# derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+##########################################################################
+
+"""
+Micro-benchmark for the vmstats key plan against the white list substring
+scan it replaced, on a captured /proc/vmstat snapshot, e.g.:
+
+    python vmstats_bench.py mocks/proc_vmstat_6x
+
+Each iteration parses an in-memory snapshot into the tracked counters,
+so only parsing is measured, not the read.
+"""
+
+import sys
+import os
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../plugins"))
+import vmstats
+
+MOCKS = os.path.join(os.path.dirname(__file__), 'mocks')
+
+def parse_scan(text):
+    names = []
+    vals = []
+    for line in text.splitlines():
+        fields = line.split()
+        fields = [fl.strip() for fl in fields]
+        key_name = fields[0]
+        key_val = fields[1]
+        if any(key_name in s for s in vmstats.white_list):
+            names.append(key_name)
+            vals.append(int(key_val))
+    return len(vals)
+
+def parse_plan(text):
+    lines = [memoryview(l) for l in text.encode('ascii').splitlines()]
+    vmstats.parse_vmstat(lines, vmstats.stats_current)
+    return len(vmstats.stats_current)
+
+def bench(name, func, text, iterations):
+    nr_vals = func(text)
+    start = time.time()
+    for i in range(iterations):
+        func(text)
+    elapsed = time.time() - start
+    print('%-16s %10.2f usec/parse %6d values' %
+          (name, elapsed * 1e6 / iterations, nr_vals))
+
+def main():
+    fnames = sys.argv[1:] or [os.path.join(MOCKS, 'proc_vmstat_6x')]
+    iterations = 10000
+    for fname in fnames:
+        if not os.path.exists(fname):
+            print('%s does not exist' % (fname))
+            continue
+        with open(fname) as f:
+            text = f.read()
+        vmstats.set_key_plan(text.splitlines())
+        print('%s: %d iterations' % (fname, iterations))
+        bench('substring scan', parse_scan, text, iterations)
+        bench('key plan', parse_plan, text, iterations)
+
+if __name__ == "__main__":
+    main()
@@ -46,10 +46,16 @@ import vmstats
 
 PROCFS_VMSTAT = os.path.abspath(os.path.join(os.path.dirname(__file__),
                                                 'mocks/proc_vmstat'))
+PROCFS_VMSTAT_6X = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                'mocks/proc_vmstat_6x'))
 
 # Expected values for verifications
 WHITE_LIST = ['nr_free_pages', 'nr_inactive_anon', 'nr_active_anon', 'nr_inactive_file', 'nr_active_file', 'nr_unevictable', 'nr_mlock', 'nr_anon_pages', 'nr_mapped', 'nr_file_pages', 'nr_dirty', 'nr_writeback', 'nr_writeback_temp', 'nr_shmem', 'numa_hit', 'numa_miss', 'numa_foreign', 'numa_interleave', 'numa_local', 'numa_other', 'pgpgin', 'pgpgout', 'pswpin', 'pswpout', 'pgalloc_dma', 'pgalloc_dma32', 'pgalloc_normal', 'pgfault', 'pgmajfault', 'pgsteal_dma', 'pgsteal_dma32', 'pgsteal_normal', 'pgscan_kswapd_dma', 'pgscan_kswapd_dma32', 'pgscan_kswapd_normal', 'pgscan_direct_dma', 'pgscan_direct_dma32', 'pgscan_direct_normal', 'zone_reclaim_failed', 'slabs_scanned', 'kswapd_steal', 'kswapd_inodesteal', 'kswapd_low_wmark_hit_quickly', 'kswapd_high_wmark_hit_quickly', 'kswapd_skip_congestion_wait', 'pageoutrun', 'allocstall', 'pgrotated', 'compact_blocks_moved', 'compact_pages_moved', 'compact_pagemigrate_failed', 'compact_stall', 'compact_fail', 'compact_success', 'htlb_buddy_alloc_success', 'htlb_buddy_alloc_fail']
 
+def to_views(lines):
+    # lines as returned by ProcReader.lines()
+    return [memoryview(l.encode('ascii')) for l in lines]
+
 class TestVmstats(unittest.TestCase):
     def setUp(self):
         vmstats.VMS_FNAME = PROCFS_VMSTAT
@@ -66,19 +72,19 @@ class TestVmstats(unittest.TestCase):
                                       vmstats.pgscank_white_list,
                                       vmstats.pgscand_white_list))
         try:
-            self.assertTrue(len(vmstats.white_list) > 0, 'at least one metric')
-            self.assertEqual(vmstats.white_list, WHITE_LIST, 
+            self.assertTrue(len(vmstats.stats_keys) > 0, 'at least one metric')
+            self.assertEqual(vmstats.stats_keys, WHITE_LIST, 
                              'white lists parsing error')
         except:
-            print('vmstats.white_list: %s' % (vmstats.white_list))
+            print('vmstats.stats_keys: %s' % (vmstats.stats_keys))
             print('vmstats.pgsteal_white_list: %s' % (vmstats.pgsteal_white_list))
             print('vmstats.pgscank_white_list: %s' % (vmstats.pgscank_white_list))
             print('vmstats.pgscand_white_list: %s' % (vmstats.pgscand_white_list))
             print('expected: %s' % (WHITE_LIST))
             print('size: %d expected: %d'
-                  % (len(vmstats.white_list), len(WHITE_LIST)))
+                  % (len(vmstats.stats_keys), len(WHITE_LIST)))
             for i in range(len(WHITE_LIST)):
-                print('i: %d  %s   -->>     %s' % (i, vmstats.white_list[i], WHITE_LIST[i]))
+                print('i: %d  %s   -->>     %s' % (i, vmstats.stats_keys[i], WHITE_LIST[i]))
             print('Exception: %s' % (sys.exc_info()[0]))
             raise
 
@@ -87,9 +93,147 @@ class TestVmstats(unittest.TestCase):
         collectdValues.val = Mock()
         vmstats.collect_vmstats()
 
-        assert collectdValues.call_count == len(WHITE_LIST)
+        assert collectdValues.return_value.dispatch.call_count == len(WHITE_LIST)
         self.assertTrue(len(vmstats.stats_cache) > 0, 'at least one metric')
 
+    def test_4_vmstats_key_plan(self):
+        with open(PROCFS_VMSTAT_6X) as f:
+            lines = f.read().splitlines()
+        file_vals = dict((l.split()[0], int(l.split()[1])) for l in lines)
+        vmstats.set_key_plan(lines)
+
+        # keys match exactly, not as prefixes of longer keys
+        self.assertTrue('nr_free_pages' in vmstats.stats_keys)
+        self.assertFalse('nr_free_pages_blocks' in vmstats.stats_keys)
+        self.assertFalse('nr_dirty_threshold' in vmstats.stats_keys)
+        self.assertEqual(len(vmstats.stats_keys), len(set(vmstats.stats_keys)))
+        self.assertEqual(vmstats.pgsteal_white_list,
+                         ['pgsteal_kswapd', 'pgsteal_direct'])
+        self.assertEqual(vmstats.pgscank_white_list, ['pgscan_kswapd'])
+
+        self.assertTrue(vmstats.parse_vmstat(to_views(lines),
+                                             vmstats.stats_current))
+        self.assertEqual(list(vmstats.stats_current),
+                         [file_vals[k] for k in vmstats.stats_keys])
+
+        # a different layout is detected by line count or first key
+        self.assertFalse(vmstats.parse_vmstat(to_views(lines[1:]),
+                                              vmstats.stats_current))
+        moved = [lines[1], lines[0]] + lines[2:]
+        self.assertFalse(vmstats.parse_vmstat(to_views(moved),
+                                              vmstats.stats_current))
+
+    @patch('collectd.Values')
+    def test_5_vmstats_layout_change(self, collectdValues):
+        with open(PROCFS_VMSTAT_6X) as f:
+            text = f.read()
+        lines = text.splitlines()
+        vmstats.set_key_plan(lines[:-1])
+        reader = Mock()
+        reader.lines.return_value = to_views(lines)
+        with patch('procreader.get_reader', return_value=reader):
+            vmstats.collect_vmstats()
+
+        self.assertEqual(vmstats.plan_num_lines, len(lines))
+        dispatch = collectdValues.return_value.dispatch
+        self.assertEqual(dispatch.call_count, vmstats.num_raw_keys)
+
+    def test_6_vmstats_snapshots(self):
+        with open(PROCFS_VMSTAT_6X) as f:
+            text = f.read()
+        lines = text.splitlines()
+        vmstats.set_key_plan(lines)
+        reader = Mock()
+        reader.text.return_value = text
+        reader.lines.return_value = to_views(lines)
+        with patch('procreader.get_reader', return_value=reader):
+            with patch('time.time', return_value=100.0):
+                vmstats.init_stats_cache()
+            self.assertEqual(vmstats.stats_cache_ts, 100.0)
+            self.assertTrue(vmstats.calc_vmstats()[0] is None)
+
+            # 2000 pages in and 10 faults more, 10 seconds later
+            bumped = []
+            for l in lines:
+                key, val = l.split()
+                if key == 'pgpgin':
+                    val = str(int(val) + 2000)
+                elif key == 'pgfault':
+                    val = str(int(val) + 10)
+                bumped.append(key + ' ' + val)
+            reader.lines.return_value = to_views(bumped)
+            cache, current = vmstats.stats_cache, vmstats.stats_current
+            with patch('time.time', return_value=110.0):
+                with patch('collectd.Values'):
+                    vmstats.collect_vmstats()
+        metrics = dict(zip(vmstats.vmstat_metrics, vmstats.calc_vmstats()))
+        self.assertEqual(metrics['pgpgin_per_sec'], 200.0)
+        self.assertEqual(metrics['faults_per_sec'], 1.0)
+        self.assertEqual(metrics['pswpin_per_sec'], 0.0)
+
+        # snapshots are swapped, not copied or reallocated
+        vmstats.swap_current_cache()
+        self.assertTrue(vmstats.stats_cache is current)
+        self.assertTrue(vmstats.stats_current is cache)
+        self.assertEqual(vmstats.stats_cache_ts, 110.0)
+
+    def test_7_vmstats_rules(self):
+        with open(PROCFS_VMSTAT_6X) as f:
+            keys = [l.split()[0] for l in f]
+        rule_keys = dict(zip(vmstats.vmstat_metrics,
+                             vmstats.resolve_rule_keys(keys)))
+        self.assertEqual(rule_keys['pgfree_per_sec'], ['pgfree'])
+        self.assertEqual(rule_keys['pgscank_per_sec'], ['pgscan_kswapd'])
+        self.assertEqual(rule_keys['pgscand_per_sec'], ['pgscan_direct'])
+        self.assertEqual(rule_keys['pgsteal_per_sec'],
+                         ['pgsteal_kswapd', 'pgsteal_direct'])
+        self.assertEqual(rule_keys['workingset_refault_per_sec'],
+                         ['workingset_refault_anon', 'workingset_refault_file'])
+        self.assertEqual(rule_keys['thp_split_per_sec'], ['thp_split_page'])
+        self.assertEqual(len(rule_keys['pgdemote_per_sec']), 4)
+
+        # 3.x kernels count scans and steals per zone
+        keys_3x = ['pgsteal_kswapd_dma', 'pgsteal_kswapd_normal',
+                   'pgsteal_direct_dma', 'pgsteal_direct_normal',
+                   'pgscan_kswapd_dma', 'pgscan_kswapd_normal',
+                   'pgscan_direct_dma', 'pgscan_direct_normal',
+                   'pgscan_direct_throttle', 'workingset_refault']
+        rule_keys = dict(zip(vmstats.vmstat_metrics,
+                             vmstats.resolve_rule_keys(keys_3x)))
+        self.assertEqual(rule_keys['pgsteal_per_sec'], keys_3x[0:4])
+        self.assertEqual(rule_keys['pgscand_per_sec'], keys_3x[6:8])
+        self.assertEqual(rule_keys['workingset_refault_per_sec'],
+                         ['workingset_refault'])
+        self.assertEqual(rule_keys['pgscan_anon_per_sec'], [])
+
+    def test_8_vmstats_derived(self):
+        lines = ['nr_free_pages 100', 'pgfree 1000',
+                 'pgscan_kswapd_normal 500', 'pgscan_direct_normal 300',
+                 'pgscan_direct_throttle 7', 'pgsteal_kswapd_normal 400',
+                 'pgsteal_direct_normal 200']
+        vmstats.set_key_plan(lines)
+        # pgfree is read for its rule but not dispatched as a raw counter
+        self.assertFalse('pgfree' in
+                         vmstats.stats_keys[:vmstats.num_raw_keys])
+        vmstats.stats_current_ts = 10.0
+        vmstats.parse_vmstat(to_views(lines), vmstats.stats_current)
+        vmstats.swap_current_cache()
+
+        lines = ['nr_free_pages 50', 'pgfree 1200',
+                 'pgscan_kswapd_normal 540', 'pgscan_direct_normal 340',
+                 'pgscan_direct_throttle 9', 'pgsteal_kswapd_normal 420',
+                 'pgsteal_direct_normal 220']
+        vmstats.stats_current_ts = 20.0
+        vmstats.parse_vmstat(to_views(lines), vmstats.stats_current)
+        metrics = dict(zip(vmstats.vmstat_metrics, vmstats.calc_vmstats()))
+        self.assertEqual(metrics['pgfree_per_sec'], 20.0)
+        self.assertEqual(metrics['pgscank_per_sec'], 4.0)
+        self.assertEqual(metrics['pgscand_per_sec'], 4.0)
+        self.assertEqual(metrics['pgsteal_per_sec'], 4.0)
+        self.assertEqual(metrics['pct_vmeff'], 50.0)
+        self.assertTrue(metrics['pgpgin_per_sec'] is None)
+        self.assertTrue(metrics['thp_split_per_sec'] is None)
+
 if __name__ == '__main__':
     suite = unittest.TestLoader().loadTestsFromTestCase(TestVmstats)
     unittest.TextTestRunner(verbosity=2).run(suite)
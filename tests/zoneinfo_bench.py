@@ -0,0 +1,160 @@
+#!/usr/bin/python
+
+##########################################################################
+# Copyright (c) 2015, Salesforce.com, Inc.
+# All rights reserved.
+#
+# Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#
+# Neither the name of Salesforce.com nor the names of its
+# contributors may be used to endorse or promote products
+# derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+##########################################################################
+
+"""
+Timing of the zoneinfo streaming parser against the regex it replaced,
+on a captured /proc/zoneinfo expanded to a multi-node, multi-CPU layout,
+e.g.:
+
+    python zoneinfo_bench.py mocks/proc_zoneinfo_6x 8 64
+
+expands the snapshot to 8 NUMA nodes and 64 CPUs per pageset, which is
+about the size of /proc/zoneinfo on a 2-socket, 8-node server.
+"""
+
+import sys
+import os
+import re
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../plugins"))
+import zoneinfo
+
+MOCKS = os.path.join(os.path.dirname(__file__), 'mocks')
+
+re_zoneinfo=re.compile(r'^\s*Node\s+(?P<node>\d+)'
+                       r',\s+zone\s+(?P<zone>\S+)'
+                       r'(?:\n|\r\n?)'
+                       r'^\s+pages free\s+(?P<zone_free>\d+)'
+                       r'(?:\n|\r\n?)'
+                       r'^\s+min\s+(?P<min>\d+)'
+                       r'(?:\n|\r\n?)'
+                       r'^\s+low\s+(?P<low>\d+)'
+                       r'(?:\n|\r\n?)'
+                       r'^\s+high\s+(?P<high>\d+)'
+                       r'(?:\n|\r\n?)'
+                       r'^\s+scanned\s+(?P<scanned>\d+)'
+                       r'(?:\n|\r\n?)'
+                       r'(^(.+)\n)+?'
+                       r'^\s+nr_free_pages\s+(?P<nr_free_pages>\d+)'
+                       r'(?:\n|\r\n?)'
+                       r'(^(.+)\n)+?'
+                       r'^\s+nr_dirty\s+(?P<nr_dirty>\d+)'
+                       r'(?:\n|\r\n?)'
+                       r'^\s+nr_writeback\s+(?P<nr_writeback>\d+)'
+                       r'(?:\n|\r\n?)'
+                       r'(^(.+)\n)+?'
+                       r'^\s+nr_vmscan_write\s+(?P<nr_vmscan_write>\d+)'
+                       r'(?:\n|\r\n?)'
+                       r'(^(.+)\n)+?'
+                       r'^\s+nr_anon_transparent_hugepages\s+(?P<nr_anon_transparent_hugepages>\d+)'
+                       , re.MULTILINE)
+
+def expand(text, nodes, cpus):
+    """
+    Replicate the zones of node 0 to nodes 0..nodes-1, and the pageset of
+    cpu 0 to cpus 0..cpus-1.
+    """
+    out = []
+    block = None    # lines of cpu 0 while in a pagesets section
+    in_cpu0 = False
+    for line in text.splitlines(True):
+        if line.startswith('Node ') and not line.startswith('Node 0,'):
+            break
+        if block is not None:
+            if line.strip() == 'cpu: 0':
+                in_cpu0 = True
+                continue
+            if line.strip().startswith('cpu: '):
+                in_cpu0 = False
+                continue
+            if line.startswith('   ') or line.startswith('  vm stats'):
+                if in_cpu0:
+                    block.append(line)
+                continue
+            # end of the pagesets section
+            for cpu in range(cpus):
+                out.append('    cpu: %d\n' % (cpu))
+                out.extend(block)
+            block = None
+        if line.strip() == 'pagesets':
+            block = []
+        out.append(line)
+    node0 = ''.join(out)
+    return ''.join(node0.replace('Node 0,', 'Node %d,' % (node))
+                   for node in range(nodes))
+
+def parse_regex(text):
+    nr_zones = 0
+    for m in re.finditer(re_zoneinfo, text):
+        [m.group(k) for k in zoneinfo.white_list]
+        nr_zones += 1
+    return nr_zones
+
+def parse_stream(text):
+    zones, nodes = zoneinfo.parse_zoneinfo(text, False)
+    for node, zone, stats in zones:
+        zoneinfo.get_zone_metrics(stats)
+    return len(zones)
+
+def parse_stream_pagesets(text):
+    zones, nodes = zoneinfo.parse_zoneinfo(text, True)
+    return len(zones)
+
+def bench(name, func, text, iterations):
+    nr_zones = func(text)
+    start = time.time()
+    for i in range(iterations):
+        func(text)
+    elapsed = time.time() - start
+    print('%-16s %10.2f usec/parse %4d zones' %
+          (name, elapsed * 1e6 / iterations, nr_zones))
+
+def main():
+    fnames = [sys.argv[1]] if len(sys.argv) > 1 else \
+        [os.path.join(MOCKS, 'proc_zoneinfo_3x'),
+         os.path.join(MOCKS, 'proc_zoneinfo_6x')]
+    nodes = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    cpus = int(sys.argv[3]) if len(sys.argv) > 3 else 64
+    iterations = 200
+    for fname in fnames:
+        with open(fname) as f:
+            text = expand(f.read(), nodes, cpus)
+
+        print('%s: %d nodes, %d cpus, %d lines, %d iterations' %
+              (fname, nodes, cpus, text.count('\n'), iterations))
+        bench('regex', parse_regex, text, iterations)
+        bench('streaming', parse_stream, text, iterations)
+        bench('with pagesets', parse_stream_pagesets, text, iterations)
+
+if __name__ == "__main__":
+    main()
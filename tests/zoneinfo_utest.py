@@ -41,11 +41,19 @@ import unittest
 from mock import Mock, patch
 
 import collectd
-sys.path.append(os.path.join(os.path.dirname(__file__), "../plugins"))
+# ahead of the standard library zoneinfo module (python 3.9+)
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../plugins"))
 import zoneinfo
 
 PROCFS_ZONEINFO = os.path.abspath(os.path.join(os.path.dirname(__file__),
                                                 'mocks/proc_zoneinfo'))
+# 6.x kernel: per-node stats, no 'scanned'
+PROCFS_ZONEINFO_6X = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                  'mocks/proc_zoneinfo_6x'))
+
+# 3.x kernel layout: all counters per zone, 2 nodes
+PROCFS_ZONEINFO_3X = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                  'mocks/proc_zoneinfo_3x'))
 
 # Expected values for verifications
 WHITE_LIST = ['min', 'low', 'high', 'scanned', 'nr_free_pages', 'nr_dirty', 'nr_writeback', 'nr_vmscan_write', 'nr_anon_transparent_hugepages']
@@ -74,6 +82,66 @@ class TestBuddyinfo(unittest.TestCase):
     collectdValues.assert_called_once()
     self.assertTrue(len(zoneinfo.stats_cache) > 0, 'at least one udp counter')
 
+  def parse_fixture(self, fname):
+    with open(fname) as f:
+      return zoneinfo.parse_zoneinfo(f.read())
+
+  def test_4_zoneinfo_parse_3x(self):
+    zones, nodes = self.parse_fixture(PROCFS_ZONEINFO_3X)
+    self.assertEqual([(node, zone) for node, zone, stats in zones],
+                     [('0', 'DMA'), ('0', 'DMA32'), ('0', 'Normal'),
+                      ('1', 'Normal')], 'zones found')
+    self.assertEqual(nodes, {}, 'no per-node stats')
+    stats = zones[2][2]
+    self.assertEqual(zoneinfo.get_zone_metrics(stats),
+                     (WHITE_LIST, [8443, 10553, 12664, 0, 1490, 12, 0, 7, 3]),
+                     'white listed metrics')
+    self.assertEqual(stats['pages_free'], 1490, 'pages free')
+    self.assertEqual(stats['vm_stats_threshold'], 100, 'threshold')
+    self.assertEqual(stats['start_pfn'], 1048576, 'start_pfn')
+    self.assertEqual(stats['pagesets'],
+                     [('0', {'count': 140, 'high': 186, 'batch': 31}),
+                      ('1', {'count': 41, 'high': 186, 'batch': 31})],
+                     'pagesets')
+
+  def test_5_zoneinfo_parse_6x(self):
+    zones, nodes = self.parse_fixture(PROCFS_ZONEINFO_6X)
+    self.assertEqual([zone for node, zone, stats in zones],
+                     ['DMA', 'DMA32', 'Normal', 'Movable', 'Device'],
+                     'zones found')
+    names, vals = zoneinfo.get_zone_metrics(zones[0][2])
+    self.assertEqual(names, ['min', 'low', 'high', 'nr_free_pages'],
+                     'zone metrics without scanned')
+    self.assertEqual(vals, [58, 72, 86, 3840], 'zone values')
+    self.assertFalse('nr_dirty' in zones[0][2], 'per-node counter in zone')
+    self.assertEqual(zoneinfo.get_node_metrics(nodes['0'])[0],
+                     ['nr_dirty', 'nr_writeback', 'nr_vmscan_write',
+                      'nr_anon_transparent_hugepages'], 'per-node metrics')
+
+  def test_6_zoneinfo_optional_metrics(self):
+    zones, nodes = self.parse_fixture(PROCFS_ZONEINFO_3X)
+    try:
+      zoneinfo.protection_enabled = True
+      zoneinfo.pagesets_enabled = True
+      names, vals = zoneinfo.get_zone_metrics(zones[3][2])
+    finally:
+      zoneinfo.protection_enabled = False
+      zoneinfo.pagesets_enabled = False
+    self.assertEqual(names[len(WHITE_LIST):],
+                     ['protection_0', 'protection_1', 'protection_2',
+                      'protection_3', 'pageset_cpu0_count',
+                      'pageset_cpu0_high', 'pageset_cpu0_batch',
+                      'pageset_cpu1_count', 'pageset_cpu1_high',
+                      'pageset_cpu1_batch'], 'optional metrics')
+    self.assertEqual(vals[len(WHITE_LIST):],
+                     [0, 0, 0, 0, 2, 186, 31, 77, 186, 31], 'optional values')
+
+    # pagesets are skipped by the parser unless enabled
+    with open(PROCFS_ZONEINFO_3X) as f:
+      zones, nodes = zoneinfo.parse_zoneinfo(f.read(), False)
+    self.assertFalse('pagesets' in zones[3][2], 'pagesets not parsed')
+    self.assertEqual(zones[3][2]['start_pfn'], 17563648, 'start_pfn')
+
 if __name__ == '__main__':
   suite = unittest.TestLoader().loadTestsFromTestCase(TestBuddyinfo)
   unittest.TextTestRunner(verbosity=2).run(suite)